@@ -1,7 +1,9 @@
-import json
 import os
 import sys
 
+import storage
+from model import Thread
+
 #	Thread / post format is as follows:
 #        index page is a standard Python list, where
 #        index[0] is the first thread with ID 1,
@@ -22,29 +24,40 @@ PORT = "70"
 GOPHER_ROOT = "gopher"
 
 def parse_post(p):
-	if len(p) < 4:
-		name = "Anonymous"
-		time = str(p[0])
-		id_no = str(p[1])
-		body = str(p[2])
+	# p is a model.Post
+	return {"name":str(p.name), "time":str(p.time), "id_no":str(p.id), "body":str(p.text)}
+
+
+def iter_index(index_path):
+	"""Yields the threads of the board one at a time, newest bumped first."""
+	board_path = os.path.dirname(index_path)
+	# Boards using the sharded storage keep every thread in its own file.
+	if os.path.exists(os.path.join(board_path, "manifest")):
+		store = storage.ShardStore(board_path)
+	# Boards using the log storage keep recent posts out of the index.
+	elif os.path.exists(os.path.join(board_path, "log")) or \
+			os.path.exists(os.path.join(board_path, "log.old")):
+		store = storage.LogStore(board_path)
 	else:
-		name = str(p[0])
-		time = str(p[1])
-		id_no = str(p[2])
-		body = str(p[3])
-	return {"name":name, "time":time, "id_no":id_no, "body":body}
+		store = storage.IndexStore(board_path)
+	for thread in store.iter_threads():
+		yield Thread.decode(thread)
 
 
-def index_to_fs(index_path, gopher_out_folder):
-	with open(index_path, 'r') as f:
-		buf = json.load(f)
+def index_to_fs(index_path, gopher_out_folder, thread_id=None):
+	if thread_id is None:
+		buf = iter_index(index_path)
+	else:
+		# Only one thread of a sharded board changed.
+		thread = storage.ShardStore(os.path.dirname(index_path)).get_thread(thread_id)
+		buf = [Thread.decode(thread)] if thread is not None else []
 
 	for n in buf: # Each thread
-		subject = n[1]
-		thread_id = str(n[0])
+		subject = n.subject
+		thread_id = str(n.id)
 		
 		content = subject+"\n"
-		for p in n[2:]:
+		for p in n.posts:
 			post = parse_post(p)
 			content = content + post['id_no'] + "    time:"+post['time']+"    name:"+post['name']+"\n--------\n"+post['body']+"\n\n"
 
@@ -56,38 +69,41 @@ def index_to_fs(index_path, gopher_out_folder):
 
 
 def build_board_root(index_path, gopher_out_folder, board_name):
-	with open(index_path) as f:
-		buf = json.load(f)
-	
-	content = ""
-	for thread in buf: # buf has newest bumped threads first
-		subject = thread[1]
-		if subject == "":
-			subject = "[no subject]"
-		thread_id = str(thread[0])
-		op = parse_post(thread[2])
-		
-		content = content+"\n\n\n0"+subject+"\t/"+board_name+"/"+thread_id+"\t"+HOSTNAME+"\t"+PORT+"\n--------\n"
-		content = content +" "+ op["body"][:255] + "\n"
-		if len(thread) < 4:
-			continue
-		posts = thread[3:]
-		for p in posts[-3:]:
-			p = parse_post(p)
-			content = content + " " + p["body"][:255] + "\n\n"
-			
 	if not os.path.isdir(gopher_out_folder):
 		os.makedirs(gopher_out_folder)
-	
+
+	# Written thread by thread, the board is never in memory as a whole.
 	with open(os.path.join(gopher_out_folder, "root"), "w") as r:
-		r.write(content)
+		for thread in iter_index(index_path): # newest bumped threads first
+			subject = thread.subject
+			if subject == "":
+				subject = "[no subject]"
+			thread_id = str(thread.id)
+			op = parse_post(thread.op)
+			
+			content = "\n\n\n0"+subject+"\t/"+board_name+"/"+thread_id+"\t"+HOSTNAME+"\t"+PORT+"\n--------\n"
+			content = content +" "+ op["body"][:255] + "\n"
+			for p in thread.replies[-3:]:
+				p = parse_post(p)
+				content = content + " " + p["body"][:255] + "\n\n"
+			r.write(content)
 
 if __name__ == "__main__":
 	if len(sys.argv) < 2:
 		print("No path given!")
 		sys.exit()
 	else:
-		index_path = sys.argv[1]
-		board_name = index_path.split("/")[-2] # TODO: this seems fragile
-	index_to_fs(index_path, os.path.join(GOPHER_ROOT, board_name))
+		# Any file of the board will do, e.g. its index, its log or one
+		# of its thread files.
+		board_path = os.path.dirname(sys.argv[1])
+		thread_id = None
+		if os.path.basename(board_path) == "threads":
+			thread_file = os.path.basename(sys.argv[1])
+			if not thread_file.isdigit(): # lock or temporary files
+				sys.exit()
+			thread_id = int(thread_file)
+			board_path = os.path.dirname(board_path)
+		index_path = os.path.join(board_path, "index")
+		board_name = os.path.basename(board_path)
+	index_to_fs(index_path, os.path.join(GOPHER_ROOT, board_name), thread_id)
 	build_board_root(index_path, os.path.join(GOPHER_ROOT, board_name), board_name)
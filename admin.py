@@ -6,7 +6,11 @@ under GNU GPL v2, see LICENSE for details
 """
 
 import logging
+import math
 import sys
+import time
+import archive
+import catalog
 import config
 from boards import Board
 from chan_mark import Marker
@@ -29,7 +33,8 @@ def cmdline(cfg, board, c):
         admin_help(c)
 
     elif cmd_argv[0] in ("list", "ls"):
-        print(board.list_boards())
+        prefix, page = catalog.listing_args(cmd_argv[1:])
+        print(board.list_boards(prefix, page))
 
     elif cmd_argv[0] == "add":
         if len(cmd_argv) > 2:
@@ -84,6 +89,100 @@ board /" + board.name + "/? (y/n): "))
                 "Please specify the board and its new description.",
                 c.BLACK)
 
+    elif cmd_argv[0] == "compact":
+        if len(cmd_argv) > 1:
+            board.name = board.convert_board_name(cmd_argv[1])
+            if board.compact():
+                print(c.GREEN + "Board compacted successfully.", c.BLACK)
+            else:
+                print(c.RED + "Board could not be compacted. Is it using \
+the log storage?", c.BLACK)
+        else:
+            print(c.RED + "Please specify the board you want to compact.",
+                  c.BLACK)
+
+    elif cmd_argv[0] == "archive":
+        if len(cmd_argv) > 1:
+            if board.board_exists(cmd_argv[1]):
+                print(c.GREEN + "Archived " + str(board.archive()) +
+                      " threads.", c.BLACK)
+        else:
+            print(c.RED + "Please specify the board you want to archive.",
+                  c.BLACK)
+
+    elif cmd_argv[0] == "retention":
+        if len(cmd_argv) > 1:
+            try:
+                values = [int(v) for v in cmd_argv[2:4]]
+            except ValueError:
+                values = None
+            if values is None:
+                print(c.RED + "Pages and days must be numbers." + c.BLACK)
+            elif board.board_exists(cmd_argv[1]):
+                if values:
+                    archive.set_retention(board.path,
+                                          **dict(zip(("pages", "days"), values)))
+                retention = archive.get_retention(board.path, cfg)
+                print("pages: " + str(retention["pages"]) + ", days: " +
+                      str(retention["days"]) + ", kept threads: " +
+                      str(len(retention["keep"])))
+        else:
+            print(c.RED + "Please specify the board.", c.BLACK)
+
+    elif cmd_argv[0] == "lsarchive":
+        if len(cmd_argv) < 2:
+            print(c.RED + "Please specify the board.", c.BLACK)
+        elif board.board_exists(cmd_argv[1]):
+            page = 1
+            if len(cmd_argv) > 2 and cmd_argv[2].isdigit():
+                page = max(1, int(cmd_argv[2]))
+            per_page = 20
+            entries, total = board.get_archive().browse((page - 1) * per_page,
+                                                        per_page)
+            for thread_id, subject, bump, posts, segment in entries:
+                print(c.GREEN + str(thread_id).ljust(8) + c.BLACK +
+                      time.strftime("%Y-%m-%d", time.localtime(bump)) +
+                      " " + str(posts).rjust(5) + " posts  " + subject)
+            print(str(total) + " archived threads, page " + str(page) +
+                  " of " + str(max(1, math.ceil(total / per_page))))
+
+    elif cmd_argv[0] == "restore":
+        if len(cmd_argv) >= 3 and cmd_argv[2].isdigit():
+            if board.board_exists(cmd_argv[1]):
+                if board.restore(int(cmd_argv[2])):
+                    print(c.GREEN + "Thread restored.", c.BLACK)
+                else:
+                    print(c.RED + "No such archived thread.", c.BLACK)
+        else:
+            print(c.RED + "Please specify the board and thread number.",
+                  c.BLACK)
+
+    elif cmd_argv[0] == "verify":
+        if len(cmd_argv) > 1:
+            if board.board_exists(cmd_argv[1]):
+                rebuilt = board.verify()
+                if rebuilt:
+                    print(c.YELLOW + "Rebuilt " + ", ".join(rebuilt) + ".",
+                          c.BLACK)
+                else:
+                    print(c.GREEN + "Board is consistent.", c.BLACK)
+        else:
+            print(c.RED + "Please specify the board you want to verify.",
+                  c.BLACK)
+
+    elif cmd_argv[0] == "reindex":
+        if len(cmd_argv) > 1:
+            if board.board_exists(cmd_argv[1]):
+                board.reindex()
+                if board.verify():
+                    print(c.RED + "The search index doesn't match the "
+                          "board.", c.BLACK)
+                else:
+                    print(c.GREEN + "Search index rebuilt.", c.BLACK)
+        else:
+            print(c.RED + "Please specify the board you want to reindex.",
+                  c.BLACK)
+
     elif cmd_argv[0] == "config":
         """Changes a configuration option."""
         if len(cmd_argv) >= 3:
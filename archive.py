@@ -0,0 +1,400 @@
+"""
+Archive of the threads that fell out of a board's retention window.
+
+How much of a board stays live is set per board in boards/<name>/retention,
+    {"pages": 10, "days": 30, "keep": [thread ID, ...]}
+falling back to the archive_pages and archive_days options (0 means no
+limit, which is the default). Threads past either limit, except the kept
+ones, are moved to boards/<name>/archive/ by archive_board(). That runs
+whenever a new thread is posted and from the archive command in admin.py,
+so the live board, and with it everything that reads it, only grows with
+the retention window.
+
+The archive consists of segments and a catalog listing
+    [thread ID, subject, bump time, posts, segment]
+for every archived thread, most recently bumped first. An archiver run adds
+its threads to the newest segment, which is written anew with the blocks it
+already holds copied over, until the segment reaches SEGMENT_BYTES; then a
+new one is started. Lookups by post number go through the segments one by
+one, so they are kept few. Segments are replaced, never changed in place;
+a segment is deleted once none of its threads are listed any more.
+
+A segment, archive/<n>.seg, holds every thread as its own compressed block
+(zlib or lzma, see the archive_compression option) followed by an index:
+
+    header      magic, codec
+    blocks      one compressed JSON thread each
+    by thread   (thread ID, offset, length), sorted by thread ID
+    by post     (post ID, thread ID), sorted by post ID
+    footer      index offset, threads, posts, lowest and highest post ID
+
+so viewing an archived thread or post decompresses just that one block.
+Decompressed blocks are kept in a small cache.
+
+Threads are written to the archive before they are removed from the live
+board, and only threads that didn't change in between are removed, so a
+crash or a late reply never loses a post. A thread left on both sides by a
+crash is simply archived again by the next run.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import lzma
+import mmap
+import os
+import struct
+import time
+import zlib
+
+import fileio
+from changes import ChangeLog, REMOVED
+from search import SearchIndex
+from storage import insert_bumped, post_id, thread_bump
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+MAGIC = b"SCAR"
+HEADER = struct.Struct("<4sB")
+BY_THREAD = struct.Struct("<IQI")
+BY_POST = struct.Struct("<II")
+FOOTER = struct.Struct("<QIIII")
+# Codec byte in the header: (name, compress, decompress).
+CODECS = {0: ("zlib", lambda d: zlib.compress(d, 9), zlib.decompress),
+          1: ("lzma", lzma.compress, lzma.decompress)}
+
+# Size from which an archiver run starts a new segment.
+SEGMENT_BYTES = 1048576
+
+# Decompressed blocks, keyed by (segment path, inode, offset).
+_blocks = collections.OrderedDict()
+BLOCK_CACHE_SIZE = 64
+# Parsed catalogs: {path: (stat stamp, {thread ID: entry})}.
+_catalogs = {}
+
+
+def retention_path(board_path):
+    return os.path.join(board_path, "retention")
+
+
+def get_retention(board_path, config):
+    """Returns the retention settings of a board, {"pages", "days",
+    "keep"}, with the config options filling in what the board doesn't
+    set."""
+    retention = {"pages": int(config.get_cfg_opt("archive_pages", 0)),
+                 "days": int(config.get_cfg_opt("archive_days", 0)),
+                 "keep": []}
+    try:
+        with open(retention_path(board_path), 'r') as r:
+            retention.update(json.load(r))
+    except FileNotFoundError:
+        pass
+    return retention
+
+
+def set_retention(board_path, **values):
+    """Changes the retention settings of a board, e.g. pages=5."""
+    path = retention_path(board_path)
+    with fileio.locked(path):
+        try:
+            with open(path, 'r') as r:
+                retention = json.load(r)
+        except FileNotFoundError:
+            retention = {}
+        retention.update(values)
+        fileio.write_json(path, retention)
+
+
+def archive_board(store, config):
+    """Moves the threads of a board past its retention limits into its
+    archive. Returns the number of threads moved; 0 as well if another
+    process is archiving the board right now."""
+    retention = get_retention(store.path, config)
+    limit = None
+    cutoff = None
+    if retention["pages"] > 0:
+        limit = retention["pages"] * config.threads_per_page
+    if retention["days"] > 0:
+        cutoff = time.time() - retention["days"] * 86400
+    if (limit is None and cutoff is None) or not due(store, limit, cutoff):
+        return 0
+
+    archive = Archive(store.path, config)
+    try:
+        with fileio.locked(archive.path, blocking=False):
+            keep = set(retention["keep"])
+            stale = []
+            for n, thread in enumerate(store.iter_threads()):
+                if thread[0] in keep:
+                    continue
+                if (limit is not None and n >= limit) or \
+                        (cutoff is not None and thread_bump(thread) < cutoff):
+                    stale.append(thread)
+            if not stale:
+                return 0
+            archive.add(stale)
+            removed = store.remove_threads(stale)
+            # Replied to or deleted in the meantime.
+            archive.drop(set(t[0] for t in stale) - set(removed))
+            gone = set(removed)
+            ChangeLog(store).record([(REMOVED, t, t) for t in removed])
+            SearchIndex(store).remove(
+                post_id(p) for t in stale if t[0] in gone for p in t[2:])
+    except BlockingIOError:
+        return 0
+    logging.info("Archived %d threads of %s.", len(removed), store.path)
+    return len(removed)
+
+
+def due(store, limit, cutoff):
+    """Tells without reading the board whether anything is past the
+    limits: the board has too many threads or its last one is too old."""
+    total = store.page(0, 0)[1]
+    if limit is not None and total > limit:
+        return True
+    if cutoff is not None and total:
+        last = store.page(total - 1, 1)[0]
+        return bool(last) and thread_bump(last[0]) < cutoff
+    return False
+
+
+def write_segment(path, threads, codec=0, blocks=()):
+    """Writes threads in list form to a new segment file, after blocks
+    already compressed with codec, (thread ID, block, post IDs) each (see
+    Segment.blocks())."""
+    compress = CODECS[codec][1]
+    buf = bytearray(HEADER.pack(MAGIC, codec))
+    blocks = list(blocks)
+    for thread in threads:
+        blocks.append((thread[0], compress(json.dumps(
+            thread, separators=(',', ':')).encode()),
+            [post_id(p) for p in thread[2:]]))
+    index = []
+    posts = []
+    for thread_id, block, post_ids in blocks:
+        index.append((thread_id, len(buf), len(block)))
+        buf += block
+        posts.extend((p, thread_id) for p in post_ids)
+    blocks = sorted(index)
+    posts.sort()
+    index = len(buf)
+    for block in blocks:
+        buf += BY_THREAD.pack(*block)
+    for post in posts:
+        buf += BY_POST.pack(*post)
+    first, last = (posts[0][0], posts[-1][0]) if posts else (0, 0)
+    buf += FOOTER.pack(index, len(blocks), len(posts), first, last)
+    fileio.atomic_write(path, bytes(buf))
+
+
+def search(m, start, count, record, key):
+    """Binary search for key among count records sorted by their first
+    field, starting at offset start of m. Returns the record or None."""
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        found = record.unpack_from(m, start + mid * record.size)
+        if found[0] == key:
+            return found
+        if found[0] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return None
+
+
+class Segment():
+    """Read access to a mapped segment file."""
+
+    def __init__(self, path, m, ino):
+        self.path = path
+        self.m = m
+        self.ino = ino
+        self.codec = HEADER.unpack_from(m, 0)[1]
+        (self.index, self.threads, self.posts, self.first,
+         self.last) = FOOTER.unpack_from(m, len(m) - FOOTER.size)
+        self.posts_start = self.index + self.threads * BY_THREAD.size
+
+    def blocks(self):
+        """Returns the compressed blocks of the segment, (thread ID,
+        block, post IDs) each, as write_segment() takes them."""
+        post_ids = collections.defaultdict(list)
+        for n in range(0, self.posts):
+            post_no, thread_id = BY_POST.unpack_from(
+                self.m, self.posts_start + n * BY_POST.size)
+            post_ids[thread_id].append(post_no)
+        blocks = []
+        for n in range(0, self.threads):
+            thread_id, offset, length = BY_THREAD.unpack_from(
+                self.m, self.index + n * BY_THREAD.size)
+            blocks.append((thread_id, self.m[offset:offset + length],
+                           post_ids[thread_id]))
+        return blocks
+
+    def find_post(self, post_no):
+        """Returns the ID of the thread holding post_no, or None."""
+        if not self.first <= post_no <= self.last:
+            return None
+        found = search(self.m, self.posts_start, self.posts, BY_POST, post_no)
+        return found[1] if found else None
+
+    def get_thread(self, thread_id):
+        found = search(self.m, self.index, self.threads, BY_THREAD, thread_id)
+        if found is None:
+            return None
+        key = (self.path, self.ino, found[1])
+        data = _blocks.get(key)
+        if data is None:
+            data = CODECS[self.codec][2](self.m[found[1]:found[1] + found[2]])
+            _blocks[key] = data
+            if len(_blocks) > BLOCK_CACHE_SIZE:
+                _blocks.popitem(last=False)
+        else:
+            _blocks.move_to_end(key)
+        # Parsed every time, so callers get a list of their own.
+        return json.loads(data.decode())
+
+
+class Archive():
+
+    def __init__(self, board_path, config=None):
+        self.path = os.path.join(board_path, "archive")
+        self.catalog_path = os.path.join(self.path, "catalog")
+        self.codec = 0
+        if config is not None:
+            name = config.get_cfg_opt("archive_compression", "zlib")
+            codecs = dict((c[0], n) for n, c in CODECS.items())
+            if name not in codecs:
+                logging.error("Unknown archive_compression \"%s\", using "
+                              "zlib.", name)
+            self.codec = codecs.get(name, 0)
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, "%06d.seg" % segment)
+
+    def segments(self):
+        """Returns the numbers of the segments on disk."""
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return [int(name[:-4]) for name in names
+                if name.endswith(".seg") and name[:-4].isdigit()]
+
+    @contextlib.contextmanager
+    def mapped(self, segment):
+        """Gives a Segment, or None if it was deleted in the meantime."""
+        path = self.segment_path(segment)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            yield None
+            return
+        with f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                yield Segment(path, m, os.fstat(f.fileno()).st_ino)
+
+    def read_catalog(self):
+        try:
+            with open(self.catalog_path, 'r') as c:
+                return json.load(c)
+        except FileNotFoundError:
+            return []
+
+    def entries(self):
+        """Returns {thread ID: catalog entry}, parsed again only when the
+        catalog changed."""
+        try:
+            st = os.stat(self.catalog_path)
+        except FileNotFoundError:
+            return {}
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        cached = _catalogs.get(self.catalog_path)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, dict((e[0], e) for e in self.read_catalog()))
+            _catalogs[self.catalog_path] = cached
+        return cached[1]
+
+    def browse(self, start, count):
+        """Returns (entries, total): count catalog entries starting at the
+        start-th one, and the number of archived threads."""
+        catalog = self.read_catalog()
+        return catalog[start:start + count], len(catalog)
+
+    def add(self, threads):
+        """Writes threads (in list form) to the newest segment, or a new
+        one if that is full, and lists them in the catalog. Returns the
+        number of the segment."""
+        os.makedirs(self.path, exist_ok=True)
+        with fileio.locked(self.catalog_path):
+            ids = set(t[0] for t in threads)
+            catalog = [e for e in self.read_catalog() if e[0] not in ids]
+            segment = max(self.segments() + [0])
+            kept = []
+            with self.mapped(segment) as current:
+                if current is not None and current.codec == self.codec and \
+                        len(current.m) < SEGMENT_BYTES:
+                    # Only the threads still listed there are copied.
+                    listed = set(e[0] for e in catalog if e[4] == segment)
+                    kept = [b for b in current.blocks() if b[0] in listed]
+                else:
+                    segment += 1
+            write_segment(self.segment_path(segment), threads, self.codec,
+                          kept)
+            for thread in threads:
+                insert_bumped(catalog, [thread[0], thread[1],
+                                        thread_bump(thread), len(thread) - 2,
+                                        segment], key=lambda e: e[2])
+            fileio.write_json(self.catalog_path, catalog)
+            self.collect(catalog)
+        return segment
+
+    def get_thread(self, thread_id):
+        """Returns an archived thread in list form, or None."""
+        entry = self.entries().get(thread_id)
+        if entry is None:
+            return None
+        with self.mapped(entry[4]) as segment:
+            if segment is None:
+                return None
+            return segment.get_thread(thread_id)
+
+    def find_thread(self, post_no):
+        """Returns the ID of the archived thread holding post_no, or None.
+        Only the post indexes of the segments are searched."""
+        entries = self.entries()
+        for n in sorted(self.segments(), reverse=True):
+            with self.mapped(n) as segment:
+                if segment is None:
+                    continue
+                thread_id = segment.find_post(post_no)
+            # Segments keep threads that were restored since.
+            if thread_id is not None and thread_id in entries and \
+                    entries[thread_id][4] == n:
+                return thread_id
+        return None
+
+    def drop(self, thread_ids):
+        """Takes threads out of the archive, e.g. after a restore."""
+        if not thread_ids:
+            return
+        with fileio.locked(self.catalog_path):
+            catalog = [e for e in self.read_catalog()
+                       if e[0] not in thread_ids]
+            fileio.write_json(self.catalog_path, catalog)
+            self.collect(catalog)
+
+    def collect(self, catalog):
+        """Deletes the segments none of the catalog's threads are in."""
+        used = set(e[4] for e in catalog)
+        for segment in self.segments():
+            if segment not in used:
+                os.remove(self.segment_path(segment))
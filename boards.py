@@ -9,20 +9,47 @@ makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
 under GNU GPL v2, see LICENSE for details
 """
 
+import atexit
 import json
+import math
 import os
 import logging
 import shutil
 import time
 import re
 
+import archive
+import catalog
+import changes
 from config import Colors
+import journal
+from model import Post, Thread
+import remote
+import search
+import storage
+import watch
 
 logging.basicConfig(
     filename="log",
     format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
     level=logging.DEBUG)
 
+# Indices of the boards this process has opened, keyed by board path:
+# {path: (store stamp, index)}. See Board.get_index().
+_index_cache = {}
+_cache_stats = {"hits": 0, "misses": 0}
+
+
+def index_cache_stats():
+    """Returns the hit and miss counts of the index cache."""
+    return dict(_cache_stats)
+
+
+@atexit.register
+def _log_cache_stats():
+    logging.info("Index cache: %d hits, %d misses.",
+                 _cache_stats["hits"], _cache_stats["misses"])
+
 
 class Board():
     """Class holding data of the currently selected board."""
@@ -40,6 +67,7 @@ class Board():
         self.path = os.path.join(self.config.root, "boards", self._name)
         self.index_path = os.path.join(self.path, "index")
         self.boardlist_path = self.config.boardlist_path
+        self.open_store()
 
         if self.add_board():
             logging.info(
@@ -52,16 +80,32 @@ class Board():
         else:
             return False
 
-    def list_boards(self):
-        boardlist = self.config.get_boardlist()
-        postnums = self.config.get_postnums()
-        print(postnums)
+    def open_store(self):
+        """Sets up the storage engine and journal of the board, bringing
+        old boards up to date first."""
+        self.store = storage.get_store(self.path, self.config)
+        if self._name != '':
+            self.store.upgrade()
+        self.journal = journal.open_journal(self.store, self.config)
+
+    def list_boards(self, prefix="", page=1):
+        """Returns the listing of the boards on page number page of the
+        boards whose names start with prefix (see catalog.py)."""
+        boards, pages = catalog.get_catalog(self.config).listing(prefix, page)
         list_string = ''
-        for board in sorted(boardlist):
-            desc = boardlist[board]
-            postnum = postnums[board]
-            list_string += "/{0}/".format(board).ljust(12) + \
-                "{0}".format(desc) + "{0} posts\n".format(postnum).rjust(12)
+        for info in boards:
+            bump = "-" if info.bump is None else \
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(info.bump))
+            list_string += "/{0}/".format(info.name).ljust(12) + \
+                "{0}".format(info.desc) + \
+                "{0} threads".format(info.threads).rjust(12) + \
+                "{0} posts".format(info.posts).rjust(12) + \
+                "  last post {0}\n".format(bump)
+        if not boards:
+            list_string += "No boards found.\n"
+        if pages > 1:
+            list_string += "Page {0} of {1}, 'ls [prefix] [page]' for " \
+                "more.\n".format(min(page, pages), pages)
         return list_string
 
     def add_board(self):
@@ -73,11 +117,10 @@ class Board():
         created.
         """
 
-        if self._name in self.config.get_boardlist().keys() \
-                or self._name == '':
+        buf = self.config.get_boardlist()
+        if self._name in buf or self._name == '':
             return False
         # Add the board to boardlist.
-        buf = self.config.get_boardlist()
         buf[self._name] = self._desc
         self.config.set_boardlist(buf)
         # Create the board directory.
@@ -86,28 +129,25 @@ class Board():
         except OSError as e:
             logging.error("Board.addBoard(): %s", e)
         # Create the index file.
-        self.set_index([])
-        # Edit postnums.
-        postn = self.config.get_postnums()
-        postn[self._name] = 0
-        self.config.set_postnums(postn)
+        self.store.create()
+        # Start the board's post counter, leaving the others alone.
+        self.config.create_postnum(self._name)
 
         return True
 
     def del_board(self):
         if self._name != "":
-            if os.path.exists(self.index_path) == False:
+            if self.store.exists() == False:
                 return False
-            os.remove(self.index_path)
-            os.rmdir(self.path)
+            search.SearchIndex(self.store).destroy()
+            changes.ChangeLog(self.store).destroy()
+            self.store.destroy()
             # Boardlist
             boardlist = self.config.get_boardlist()
             del boardlist[self._name]
             self.config.set_boardlist(boardlist)
             # Postnums
-            postn = self.config.get_postnums()
-            del postn[self._name]
-            self.config.set_postnums(postn)
+            self.config.remove_postnum(self._name)
             logging.info("Board %s deleted succesfully.", self._name)
             self._name = ""
             self.desc = ""
@@ -117,27 +157,181 @@ class Board():
         else:
             return False
 
-    def get_index_sort_key(self, item):
-        """The key function when sorting the index file.
-        Returns the timestamp of the last post in the thread (item)."""
-        if len(item[-1]) == 4:
-            return item[-1][1]
-        else:
-            return item[-1][0]
-
     def get_index(self):
-        """Returns a list containing the board's index."""
-        with open(self.index_path, 'r') as i:
-            buf = json.load(i)
-            buf.sort(key=self.get_index_sort_key, reverse=True)
+        """Returns the board's threads as a read-only sequence of
+        model.Thread objects, most recently bumped first.
+
+        Every storage engine keeps its threads in bump order, so nothing
+        is sorted here. Where the engine can, the board is mapped from the
+        files shared by every session (see shared.py) and threads are only
+        parsed when they are accessed; otherwise the parsed index is kept
+        in memory. Either way it is only opened again once the store's
+        stamp changes (a stat() per call for the file engines)."""
+        stamp = self.store.stamp()
+        cached = _index_cache.get(self.store.path)
+        if cached is not None and cached[0] == stamp:
+            _cache_stats["hits"] += 1
+            return cached[1]
+
+        _cache_stats["misses"] += 1
+        buf = self.store.shared_index()
+        if buf is None:
+            buf = [Thread.decode(t) for t in self.store.load()]
+        _index_cache[self.store.path] = (stamp, buf)
         return buf
 
+    def get_thread(self, thread_id, replies=None):
+        """Returns a single model.Thread of the board, or None if it
+        doesn't exist. Unlike get_index() this doesn't read the whole
+        board with storage engines that keep threads apart.
+
+        With replies set, only the OP and the last replies replies are
+        read and the rest is counted in the thread's omitted field."""
+        if replies is None:
+            thread, omitted = self.store.get_thread(thread_id), 0
+        else:
+            thread, omitted = self.store.get_thread_tail(thread_id, replies)
+        if thread is None:
+            return None
+        thread = Thread.decode(thread)
+        thread.omitted = omitted
+        return thread
+
+    def get_posts_after(self, thread_id, post_no):
+        """Returns the posts (model.Post) of a thread numbered above
+        post_no, oldest first, or None if the thread is gone. Only the new
+        posts are read where the storage engine allows."""
+        posts = self.store.get_posts_after(thread_id, post_no)
+        if posts is None:
+            return None
+        return [Post.decode(p) for p in posts]
+
+    def watch(self):
+        """Returns a watch.Watcher telling when the board changes."""
+        return watch.Watcher(self.store.stamp_paths())
+
+    def version(self):
+        """The version of the board, which goes up with every change made
+        to it; see changes.py."""
+        return changes.ChangeLog(self.store).version()
+
+    def changes_since(self, version):
+        """Returns (current version, changes): what was done to the board
+        after version, as changes.Change tuples, oldest first. changes is
+        None if the board's change log doesn't go back that far; the
+        board has to be read again then."""
+        return changes.ChangeLog(self.store).since(version)
+
+    def iter_threads(self):
+        """Yields the board's threads as model.Thread objects, most
+        recently bumped first. Unlike get_index() only one thread is in
+        memory at a time, so scans and exports start at once and don't
+        grow with the board."""
+        for thread in self.store.iter_threads():
+            yield Thread.decode(thread)
+
+    def iter_posts(self, thread_id=None):
+        """Yields the posts (model.Post) of one thread, or of the whole
+        board if thread_id is None."""
+        if thread_id is not None:
+            thread = self.get_thread(thread_id)
+            if thread is not None:
+                yield from thread.posts
+            return
+        for thread in self.iter_threads():
+            yield from thread.posts
+
+    def get_page(self, page, per_page, preview_replies=3):
+        """Returns (threads, pages): the threads on page number page
+        (counting from 1), cut down to the OP and the last preview_replies
+        replies (see model.Thread.preview()), and the number of pages.
+
+        Storage engines that can read part of a board only read the
+        threads on the page; the others page through the cached index.
+        Pages before the first are the first."""
+        page = max(1, page)
+        start = (page - 1) * per_page
+        if self.store.paged:
+            raw, total = self.store.page(start, per_page)
+            threads = [Thread.decode(t) for t in raw]
+        else:
+            index = self.get_index()
+            threads, total = index[start:start + per_page], len(index)
+        pages = max(1, math.ceil(total / per_page))
+        return [t.preview(preview_replies) for t in threads], pages
+
     def set_index(self, values):
-        """Update the board's index with new values."""
-        with open(self.index_path, 'w') as i:
-            json.dump(values, i, indent=4)
+        """Update the board's index with new values (model.Thread
+        objects)."""
+        return self.store.save([t.encode() for t in values])
+
+    def compact(self):
+        """Rebuilds the index snapshot of a board using the log storage."""
+        if isinstance(self.store, remote.RemoteStore):
+            return self.store.compact()
+        if not isinstance(self.store, storage.LogStore):
+            return False
+        return self.store.compact()
+
+    def archive(self):
+        """Moves the threads past the board's retention limits into its
+        archive, see archive.py. Returns the number of threads moved."""
+        if self._name == '':
+            return 0
+        if isinstance(self.store, remote.RemoteStore):
+            return self.store.archive()
+        return archive.archive_board(self.store, self.config)
+
+    def get_archive(self):
+        return archive.Archive(self.path, self.config)
+
+    def get_archived(self, post_id, replies=None):
+        """Returns the archived thread (a model.Thread) holding post_id,
+        cut down to the OP and the last replies replies if given, or None
+        if no archived thread holds it."""
+        board_archive = self.get_archive()
+        thread_id = board_archive.find_thread(post_id)
+        if thread_id is None:
+            return None
+        thread = board_archive.get_thread(thread_id)
+        if thread is None:
+            return None
+        thread = Thread.decode(thread)
+        if replies is not None:
+            thread = thread.preview(replies)
+        return thread
+
+    def restore(self, thread_id):
+        """Moves an archived thread back onto the board and keeps it from
+        being archived again. Returns False if it isn't archived."""
+        board_archive = self.get_archive()
+        thread = board_archive.get_thread(thread_id)
+        if thread is None:
+            return False
+        keep = archive.get_retention(self.path, self.config)["keep"]
+        if thread_id not in keep:
+            archive.set_retention(self.path, keep=keep + [thread_id])
+        if self.store.restore_threads([thread]):
+            changes.ChangeLog(self.store).record(
+                [(changes.CREATED, thread_id, thread_id)])
+        search.SearchIndex(self.store).add(search.thread_posts(thread))
+        board_archive.drop(set([thread_id]))
+        logging.info("Restored thread %d of %s.", thread_id, self.path)
         return True
 
+    def verify(self):
+        """Checks the derived files of the board (see the verify() methods
+        in storage.py) and its search index, and rebuilds the broken ones.
+        Returns their names."""
+        rebuilt = self.store.verify()
+        if search.SearchIndex(self.store).verify():
+            rebuilt.append("search index")
+        return rebuilt
+
+    def reindex(self):
+        """Builds the search index of the board from scratch."""
+        search.SearchIndex(self.store).rebuild()
+
     @property
     def name(self):
         """Getter for name field."""
@@ -155,6 +349,7 @@ class Board():
         self.path = os.path.join(self.config.root, "boards", self._name)
         self.index_path = os.path.join(self.path, "index")
         self.boardlist_path = self.config.boardlist_path
+        self.open_store()
 
     @property
     def desc(self):
@@ -193,19 +388,13 @@ number." + self.c.BLACK)
 
     def collect_post_ids(self, thread):
         '''Returns all the post_ids within the thread group 'thread'''
-        thread_post_ids = []
-        for y in range(2, len(thread)):
-            if len(thread[y]) == 3:
-                thread_post_ids.append(thread[y][1])
-            elif len(thread[y]) == 4:
-                thread_post_ids.append(thread[y][2])
-        return thread_post_ids
+        return [post.id for post in thread.posts]
 
     def board_exists(self, board):
         board = self.convert_board_name(board)
-        _index_path = os.path.join(self.config.root, "boards", board, "index")
-        if not os.path.exists(_index_path):
-            print(self.c.RED + 'Board /' + self.name + '/ does not exist.' + self.c.BLACK)
+        _path = os.path.join(self.config.root, "boards", board)
+        if not storage.get_store(_path, self.config).exists():
+            print(self.c.RED + 'Board /' + board + '/ does not exist.' + self.c.BLACK)
             self.name = '' 
             self.thread = 0
             return False
@@ -224,31 +413,24 @@ number." + self.c.BLACK)
         if post_id == False:
             return -1
 
-        index_page = self.get_index()
-        for x in range(0, len(index_page)):
-            thread = index_page[x]
-            if post_id == thread[0]: # If the post_id is the thread_id
-                if return_id:
-                    return thread[0]
-                else:
-                    return index_page.index(thread)
-            else:
-                thread_post_ids = self.collect_post_ids(thread)
-                if post_id in thread_post_ids:
-                    if return_id:
-                        return thread[0]
-                    else:
-                        return index_page.index(thread)
-        return -1 
+        thread_id = self.store.find_thread(post_id)
+        if thread_id is None:
+            return -1
+        if return_id:
+            return thread_id
+
+        # Stops reading at the thread, no need for the whole index.
+        for x, thread in enumerate(self.store.iter_threads()):
+            if thread[0] == thread_id:
+                return x
+        return -1
 
     def add_post(self, post_text, name="Anonymous", subject="", thread_id=-1):
         """Posts a thread or a reply to a thread.
 
         If thread_id is not specified (i.e. = -1), a new thread
-        is created. Posting depends on the file (rootdir)/postnums
-        which has the following JSON structure:
-        [{'a': max_post_no}, {'b': max_post_no}, ...]
-        where max_post_no is the current highest post number.
+        is created. The post number comes from the board's own counter,
+        see Config.reserve_postnums().
 
         Thread / post format is as follows:
         index page is a standard Python list, where
@@ -262,39 +444,34 @@ number." + self.c.BLACK)
             index[n][2][2] is the ID (post number)
             index[n][2][3] is the text (body)
         index[n][k], where k > 1, is the k-th reply to n-th thread
-        """
-        index_page = self.get_index()
-        success = False
-
-        postnums = self.config.get_postnums()
-        max_post_no = postnums[self._name]
-        timestamp = int(time.time())
-
-        if thread_id == -1:
-            # Add a new thread.
-            index_page.append(
-                [max_post_no + 1, subject,
-                 [name, timestamp, max_post_no + 1, post_text]])
-            self.set_index(index_page)
-            postnums[self._name] += 1
-            self.config.set_postnums(postnums)
-            success = True
-        else:
-            # Add reply to an existing thread.
-            thread_id = abs(thread_id)
-            # Maybe get a better search algorithm?
-            for x in range(0, len(index_page)):
-                thread = index_page[x]
-                cur_thread_id = thread[0]
 
-                if cur_thread_id == thread_id:
-                    thread.append([name, timestamp, max_post_no + 1, post_text])
-                    self.set_index(index_page)
-                    postnums[self._name] += 1
-                    self.config.set_postnums(postnums)
-                    success = True
+        How the index is kept on disk depends on the storage engine, see
+        storage.py. With the file engines the post goes through the
+        board's journal first, see journal.py. The post is added to the
+        board's search index and change log as well, see search.py and
+        changes.py.
 
-        return success
+        Returns the post number, or False if the post failed.
+        """
+        if thread_id != -1:
+            thread_id = abs(thread_id)
+        if self.journal is not None:
+            added = self.journal.add_post(post_text, name, subject, thread_id,
+                                          int(time.time()))
+        else:
+            added = self.store.add_post(post_text, name, subject, thread_id,
+                                        int(time.time()))
+        if added:
+            changes.ChangeLog(self.store).record(
+                [(changes.CREATED, added, added) if thread_id == -1 else
+                 (changes.ADDED, thread_id, added)])
+            search.SearchIndex(self.store).add(
+                [(added, added if thread_id == -1 else thread_id,
+                  search.tokenize(subject + "\n" + post_text))])
+        if added and thread_id == -1:
+            # A new thread may push old ones past the retention limits.
+            self.archive()
+        return added
 
     def rm_post(self, board, post_id):
         """Removes the post with post_id on board."""
@@ -305,39 +482,39 @@ number." + self.c.BLACK)
         if post_id == False:
             return False
 
-        index = self.get_index()
-        thread_index = self.thread_exists(post_id)
-        if thread_index == -1:
+        location = self.store.locate(post_id)
+        if location is None:
             print(self.c.RED + "Could not find post." + self.c.BLACK)
             return False
+        thread_id, position = location
+
+        thread = self.get_thread(thread_id)
+        if thread is None:
+            print(self.c.RED + "Could not find post." + self.c.BLACK)
+            return False
+        post_text = thread.posts[position].text
+
+        print(self.c.YELLOW + "Deleting post:\n" + self.c.BLACK + \
+        "Post no.: " + str(post_id) + "\n" + \
+        "Post content:\n" + post_text[:500] + "\n")
+        answer = str(input(self.c.GREEN + "y" + self.c.BLACK + "/" + \
+                 self.c.RED + "n" + self.c.BLACK + "? "))
+
+        if answer != "y":
+            print(self.c.YELLOW + "Deletion aborted." + self.c.BLACK)
+            return False
+
+        if not self.store.remove_post(post_id):
+            # Removed by somebody else in the meantime.
+            print(self.c.RED + "Could not find post." + self.c.BLACK)
+            return False
+        changes.ChangeLog(self.store).record(
+            [(changes.REMOVED, thread_id, post_id)])
+        if position == 0:
+            # The OP takes the thread with it.
+            search.SearchIndex(self.store).remove(
+                post.id for post in thread.posts)
         else:
-            thread = index[thread_index]
-
-        for x in range(2, len(thread)):
-            post = thread[x]
-            if len(post) == 3: # Old json strucutre
-                this_post_id = post[1]
-                post_text = post[2]
-            elif len(post) == 4: # New json strucutre
-                this_post_id = post[2]
-                post_text = post[3]
-
-            if this_post_id == post_id:
-                print(self.c.YELLOW + "Deleting post:\n" + self.c.BLACK + \
-                "Post no.: " + str(this_post_id) + "\n" + \
-                "Post content:\n" + post_text[:500] + "\n")
-                answer = str(input(self.c.GREEN + "y" + self.c.BLACK + "/" + \
-                         self.c.RED + "n" + self.c.BLACK + "? "))
-
-                if answer != "y":
-                    print(self.c.YELLOW + "Deletion aborted." + self.c.BLACK)
-                    return False 
-
-                if x == 2: # If it is the OP post, delete the entire thread
-                    del index[thread_index]
-                else:
-                    del index[thread_index][x]
-
-                self.set_index(index)
-                print(self.c.GREEN + "Post removed successfully." + self.c.BLACK)
-                break
+            search.SearchIndex(self.store).remove([post_id])
+        print(self.c.GREEN + "Post removed successfully." + self.c.BLACK)
+        return True
@@ -0,0 +1,148 @@
+"""
+The catalog of boards: name, description, post count, thread count and
+last bump of every board, for the board listings of both interfaces.
+
+The boardlist is only read again when its stamp changes (a stat() of the
+boardlist file, or the data_version of the SQLite database), and the
+figures of a board only when the stamp of its store does, so listing the
+boards doesn't read every board on every key press. Listings are paged
+and can be narrowed down to the boards whose names start with a prefix;
+only the boards on the page asked for are looked at, so instances with
+thousands of boards list as fast as small ones.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import bisect
+import collections
+import logging
+import os
+
+from model import Thread
+import storage
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+# bump is the time of the last post on the board, None if it's empty.
+BoardInfo = collections.namedtuple(
+    "BoardInfo", ["name", "desc", "posts", "threads", "bump"])
+
+# One catalog per config file and process.
+_catalogs = {}
+
+
+def get_catalog(config):
+    """Returns the catalog of the boards of config."""
+    if config.path not in _catalogs:
+        _catalogs[config.path] = Catalog(config)
+    return _catalogs[config.path]
+
+
+def listing_args(args):
+    """Parses the arguments of the ls commands, [prefix] [page], into
+    (prefix, page)."""
+    prefix, page = "", 1
+    for arg in args:
+        if arg.isdigit():
+            page = max(1, int(arg))
+        else:
+            prefix = arg.strip("/").lower()
+    return prefix, page
+
+
+class Catalog():
+
+    def __init__(self, config):
+        self.config = config
+        self._stamp = None
+        # {name: description}, and the names in sorted order.
+        self._boards = {}
+        self._names = []
+        # {name: store}
+        self._stores = {}
+        # {name: (store stamp, posts, threads, bump)}
+        self._figures = {}
+
+    def refresh(self):
+        """Reads the boardlist again if it changed."""
+        stamp = self.config.boardlist_stamp()
+        if stamp is not None and stamp == self._stamp:
+            return
+        self._boards = self.config.get_boardlist()
+        self._names = sorted(self._boards)
+        self._stamp = stamp
+        for name in list(self._stores):
+            if name not in self._boards:
+                del self._stores[name]
+                self._figures.pop(name, None)
+
+    def __contains__(self, name):
+        self.refresh()
+        return name in self._boards
+
+    def __len__(self):
+        self.refresh()
+        return len(self._names)
+
+    def names(self, prefix=""):
+        """The board names starting with prefix, in sorted order."""
+        self.refresh()
+        if not prefix:
+            return list(self._names)
+        start = bisect.bisect_left(self._names, prefix)
+        end = start
+        while end < len(self._names) and \
+                self._names[end].startswith(prefix):
+            end += 1
+        return self._names[start:end]
+
+    def desc(self, name):
+        self.refresh()
+        return self._boards.get(name)
+
+    def info(self, name):
+        """Returns the BoardInfo of a board, or None if there is no such
+        board."""
+        self.refresh()
+        if name not in self._boards:
+            return None
+        store = self._stores.get(name)
+        if store is None:
+            store = storage.get_store(
+                os.path.join(self.config.root, "boards", name), self.config)
+            self._stores[name] = store
+        stamp = store.stamp()
+        figures = self._figures.get(name)
+        if figures is None or figures[0] != stamp:
+            figures = (stamp,) + self.count(name, store)
+            self._figures[name] = figures
+        return BoardInfo(name, self._boards[name], *figures[1:])
+
+    def count(self, name, store):
+        """Returns (posts, threads, bump) of a board. Only the most
+        recently bumped thread is read."""
+        threads, bump = 0, None
+        try:
+            if store.exists():
+                raw, threads = store.page(0, 1)
+                if raw:
+                    bump = Thread.decode(raw[0]).bump
+        except (OSError, ValueError) as e:
+            logging.error("Catalog: could not read /%s/: %s", name, e)
+        return self.config.get_postnum(name), threads, bump
+
+    def listing(self, prefix="", page=1, per_page=None):
+        """Returns (boards, pages): the BoardInfo of the boards on page
+        number page (counting from 1) of the boards whose names start
+        with prefix, and the number of pages. per_page defaults to the
+        boards_per_page option."""
+        per_page = per_page or self.config.boards_per_page
+        names = self.names(prefix)
+        pages = max(1, -(-len(names) // per_page))
+        start = (page - 1) * per_page
+        return [self.info(n) for n in names[start:start + per_page]], pages
@@ -0,0 +1,174 @@
+"""
+The change log of a board: the latest changes made to it, numbered.
+
+Every change to a board is appended to boards/<name>/changes as a line
+    [version, kind, thread ID, post ID]
+where kind is one of
+    created     a thread was created (or restored from the archive); the
+                post is its OP
+    added       a reply was added to a thread
+    removed     a post was removed; the thread is gone with it when the
+                post is its OP (the post was deleted or the thread was
+                archived)
+Versions go up by one with every change and are never handed out twice,
+so a client that remembers the version it last saw can ask for just what
+changed since (Board.changes_since()) and read only the threads that
+changed, instead of the whole board. Clients should take the version
+before reading the board: a change seen twice does no harm, a change
+missed does.
+
+The log only keeps the last LOG_SIZE changes or so; once it holds twice as
+many the older ones are dropped. A client further behind than that, or
+holding a version the board never got to (the board was deleted and made
+anew), is told to read the whole board again.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import collections
+import json
+import logging
+import os
+
+import fileio
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+CREATED = "created"
+ADDED = "added"
+REMOVED = "removed"
+
+# Number of changes kept in the log.
+LOG_SIZE = 1000
+# Bytes read from the end of the log at first, see ChangeLog.tail().
+CHUNK = 4096
+
+Change = collections.namedtuple(
+    "Change", ["version", "kind", "thread", "post"])
+
+
+def parse(lines):
+    """The changes in lines (bytes) of the log. A line cut short by a crash
+    is skipped."""
+    changes = []
+    for line in lines:
+        try:
+            changes.append(Change(*json.loads(line.decode())))
+        except (ValueError, TypeError):
+            continue
+    return changes
+
+
+class ChangeLog():
+    """The change log of one board. It is only appended to under its
+    lock."""
+
+    def __init__(self, store):
+        self.store = store
+        self.path = os.path.join(store.path, "changes")
+
+    def tail(self, since=None):
+        """Returns the changes at the end of the log, oldest first: at
+        least every change after version since, or at least the last one
+        if since is None. The log is read backwards, in chunks that double
+        in size, so only about as much of it is read as asked for."""
+        try:
+            log = open(self.path, 'rb')
+        except FileNotFoundError:
+            return []
+        with log:
+            end = log.seek(0, os.SEEK_END)
+            start, size = end, CHUNK
+            changes = []
+            while start > 0:
+                start = max(0, start - size)
+                size *= 2
+                log.seek(start)
+                lines = log.read(end - start).split(b"\n")
+                if start > 0:
+                    # Most likely the tail of a line that starts earlier.
+                    lines = lines[1:]
+                changes = parse(lines)
+                if changes and (since is None or
+                                changes[0].version <= since + 1):
+                    break
+        return changes
+
+    def version(self):
+        """The version of the board: that of its last change, 0 if none
+        was recorded yet."""
+        changes = self.tail()
+        return changes[-1].version if changes else 0
+
+    def since(self, version):
+        """Returns (current version, changes after version, oldest
+        first). The changes are None if the log doesn't reach back to
+        version anymore, or never got as far: the client has to read the
+        board again."""
+        changes = self.tail(version)
+        current = changes[-1].version if changes else 0
+        if version > current or \
+                (changes and changes[0].version > version + 1):
+            return current, None
+        return current, [c for c in changes if c.version > version]
+
+    def record(self, changes):
+        """Appends changes, (kind, thread ID, post ID) each, under the next
+        versions. Returns the version of the board afterwards, or None if
+        the log couldn't be written."""
+        changes = list(changes)
+        try:
+            os.makedirs(self.store.path, exist_ok=True)
+            with fileio.locked(self.path):
+                version = self.version()
+                if not changes:
+                    return version
+                lines = []
+                for kind, thread_id, post_id in changes:
+                    version += 1
+                    lines.append(json.dumps([version, kind, thread_id,
+                                             post_id]) + "\n")
+                data = "".join(lines).encode()
+                with open(self.path, 'a+b') as log:
+                    if log.seek(0, os.SEEK_END) > 0:
+                        log.seek(-1, os.SEEK_END)
+                        if log.read(1) != b"\n":
+                            # Left cut short by a crash.
+                            data = b"\n" + data
+                    log.write(data)
+                if version - self.first() >= 2 * LOG_SIZE:
+                    self.trim()
+                return version
+        except OSError:
+            logging.exception("Could not record changes of %s.",
+                              self.store.path)
+            return None
+
+    def first(self):
+        """The version of the oldest change in the log."""
+        with open(self.path, 'rb') as log:
+            for line in log:
+                changes = parse([line])
+                if changes:
+                    return changes[0].version
+        return 0
+
+    def trim(self):
+        """Drops all but the last LOG_SIZE changes. The caller must hold
+        the lock."""
+        with open(self.path, 'rb') as log:
+            lines = [l for l in log.read().split(b"\n") if l]
+        fileio.atomic_write(self.path, b"\n".join(lines[-LOG_SIZE:]) + b"\n",
+                            sync=False)
+
+    def destroy(self):
+        for path in (self.path, self.path + ".lock"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
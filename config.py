@@ -12,6 +12,13 @@ import os
 import sys
 import json
 import logging
+import shutil
+import signal
+import types
+
+import fileio
+import sqlite_store
+from counters import PostCounters
 
 logging.basicConfig(
     filename="log",
@@ -49,9 +56,25 @@ class Config():
                 "version": "0.1",
                 "name": "sshchan",
                 "prompt": "sshchan",
-                "display_legacy": "False"}
+                "display_legacy": "False",
+                "storage": "index",
+                "sqlite_path": "/srv/sshchan/sshchan.db",
+                "log_compact_bytes": "1048576",
+                "journal_fsync": "batch",
+                "journal_window_ms": "2",
+                "threads_per_page": "10",
+                "boards_per_page": "20",
+                "archive_pages": "0",
+                "archive_days": "0",
+                "archive_compression": "zlib",
+                "daemon": "False",
+                "daemon_socket": "/srv/sshchan/sshchand.sock",
+                "zygote_socket": "/srv/sshchan/zygote.sock"}
 
-    def __init__(self, cfg_path=""):
+    def __init__(self, cfg_path="", reload_on_hup=False):
+        """reload_on_hup makes SIGHUP re-read the config file. Only
+        long-running processes should ask for it: sshd sends SIGHUP to
+        user sessions when the connection drops."""
         # Find config file.
 
         self.path = self.look_for_config(
@@ -59,31 +82,72 @@ class Config():
             os.getcwd() + "/sshchan.conf",
             os.getenv('HOME', default="~") + "/sshchan.conf",
             "/etc/sshchan.conf")
+        # Read-only view of the parsed config file, see snapshot().
+        self._snapshot = None
+        self._stamp = None
+        if reload_on_hup:
+            signal.signal(signal.SIGHUP, self.reload)
 
         self.root = self.get_cfg_opt("rootdir", "/srv/sshchan", fatal=True)
         self.boardlist_path = self.get_cfg_opt(
             "boardlist_path", self.root + "/boardlist")
         self.postnums_path = self.get_cfg_opt(
             "postnums_path", self.root + "/postnums")
-        self.version = self.get_cfg_opt("version", "0.0")
-        self.motd = self.get_cfg_opt("motd_path", "/etc/motd")
-        self.server_name = self.get_cfg_opt("name", "an sshchan server")
+        # Per-board post counters; the postnums file is only read to seed
+        # boards that don't have a counter yet.
+        self.counters = PostCounters(
+            self.postnums_path + ".d", self.postnums_path)
         self.username = os.getenv("USERNAME", default="anonymous")
         self.max_boards = 10  # How many boards can be displayed in top bar.
         self.display_legacy = self.get_cfg_opt("display_legacy", "False")
-        self.prompt = self.get_cfg_opt("prompt", "sshchan")
+        # Storage engine used for boards, see storage.py.
+        self.storage = self.get_cfg_opt("storage", "index")
+        self.sqlite_path = self.get_cfg_opt(
+            "sqlite_path", self.root + "/sshchan.db")
+        # Unix socket of sshchand, see sshchand.py.
+        self.daemon_socket = self.get_cfg_opt(
+            "daemon_socket", self.root + "/sshchand.sock")
+        # Unix socket of the zygote, see zygote.py and login.py.
+        self.zygote_socket = self.get_cfg_opt(
+            "zygote_socket", self.root + "/zygote.sock")
         # self.admin = settings["admin"]
         # self.salt = settings["salt"]
         # self.passwd = settings["password"]
 
         # Max threads on page.
         self.max_threads = 14
-        # Terminal size.
-        self.tty_cols = os.get_terminal_size()[0]
-        self.tty_lines = os.get_terminal_size()[1]
+        # Terminal size; 80x24 when there is no terminal, as in sshchand.
+        self.tty_cols = shutil.get_terminal_size()[0]
+        self.tty_lines = shutil.get_terminal_size()[1]
         # Used for laprint() from Display.
         self.lines_printed = 0
 
+    # Options that may change while sshchan is running are properties, so
+    # edits to the config file show up without a restart.
+    @property
+    def version(self):
+        return self.get_cfg_opt("version", "0.0")
+
+    @property
+    def motd(self):
+        return self.get_cfg_opt("motd_path", "/etc/motd")
+
+    @property
+    def server_name(self):
+        return self.get_cfg_opt("name", "an sshchan server")
+
+    @property
+    def prompt(self):
+        return self.get_cfg_opt("prompt", "sshchan")
+
+    @property
+    def threads_per_page(self):
+        return max(1, int(self.get_cfg_opt("threads_per_page", 10)))
+
+    @property
+    def boards_per_page(self):
+        return max(1, int(self.get_cfg_opt("boards_per_page", 20)))
+
     def look_for_config(self, *args):
         '''Looks for the config in the paths specified in *args until
         one that works is found.'''
@@ -107,7 +171,7 @@ class Config():
         fatal, if True, means that a failure to read the option must
         terminate sshchan.
         """
-        config = self.load()
+        config = self.snapshot()
         try:
             answer = config[opt_name]
             return answer
@@ -126,7 +190,7 @@ class Config():
 
     def set_cfg_opt(self, opt_name, new_value):
         """Set configuration option opt_name to new_value."""
-        config = self.load()
+        config = dict(self.snapshot())
         if opt_name not in self.defaults.keys():
             logging.error(
                 "\"{0}\" is not a configuration option.".format(opt_name))
@@ -135,6 +199,33 @@ class Config():
         self.save(config)
         return True
 
+    def file_stamp(self):
+        """(st_mtime_ns, st_size, st_ino) of the config file."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def snapshot(self):
+        """Return the parsed config file as a read-only mapping.
+
+        The file is parsed once and only again when its stat() changes
+        or after reload()."""
+        stamp = self.file_stamp()
+        if self._snapshot is None or stamp != self._stamp:
+            config = self.load()
+            # Swap in the new snapshot with a single assignment.
+            self._stamp = stamp
+            self._snapshot = types.MappingProxyType(config)
+        return self._snapshot
+
+    def reload(self, *args):
+        """Drop the snapshot so the next read parses the file again.
+        Also used as the SIGHUP handler."""
+        self._snapshot = None
+        logging.info("Reloading config file %s.", self.path)
+
     def load(self):
         """Load a JSON configuration file, or return default values."""
         try:
@@ -145,21 +236,42 @@ class Config():
         except FileNotFoundError:
             logging.warning("Config file at %s not found, returning defaults.",
                             self.path)
-            return Config.defaults
+            return dict(Config.defaults)
 
     def save(self, values):
         """Save new or udpated settings to a JSON file."""
-        with open(self.path, 'w') as c:
-            json.dump(values, c, indent=4)
+        fileio.write_json(self.path, values, indent=4)
+        self._stamp = self.file_stamp()
+        self._snapshot = types.MappingProxyType(dict(values))
         logging.info("Dumped new settings into %s.", self.path)
         return True
 
+    def database(self):
+        """Return the database of the sqlite storage, or None if the
+        boards are kept in JSON files."""
+        if self.storage != "sqlite":
+            return None
+        return sqlite_store.connect(self.sqlite_path)
+
     def get_boardlist(self):
         """Return the boardlist as a Python dictionary."""
+        if self.database() is not None:
+            return self.database().get_boardlist()
         with open(self.boardlist_path, 'r') as b:
             buf = json.load(b)
         return buf
 
+    def boardlist_stamp(self):
+        """Changes whenever the boardlist may have changed, see
+        catalog.py."""
+        if self.database() is not None:
+            return self.database().stamp()
+        try:
+            st = os.stat(self.boardlist_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
     def set_boardlist(self, values):
         """Update/create the boardlist with values.
 
@@ -168,20 +280,59 @@ class Config():
         where boardname should be just the name without any slashes
         (but they are not forbidden).
         """
-        with open(self.boardlist_path, 'w') as b:
-            json.dump(values, b, indent=4)
+        if self.database() is not None:
+            return self.database().set_boardlist(values)
+        fileio.write_json(self.boardlist_path, values, indent=4)
         logging.info("Updated boardlist file.")
         return True
 
     def get_postnums(self):
-        """Return the postnums file as a Python dictionary."""
-        with open(self.postnums_path, 'r') as p:
-            buf = json.load(p)
-        return buf
+        """Return the post counts of all boards as a Python dictionary."""
+        if self.database() is not None:
+            return self.database().get_postnums()
+        return self.counters.read_all(self.get_boardlist().keys())
+
+    def get_postnum(self, board):
+        """Return the highest post number handed out on board."""
+        if self.database() is not None:
+            return self.database().get_postnum(board)
+        return self.counters.read(board)
 
     def set_postnums(self, values):
-        """Update/create the postnums for board name with value."""
-        with open(self.postnums_path, 'w') as p:
-            json.dump(values, p, indent=4)
-        logging.info("Updated postnums file.")
+        """Update/create the postnums for board name with value.
+        Counters of boards missing from values are removed.
+
+        This rewrites every counter from values, rolling back posts made
+        since values were read; adding or removing a single board goes
+        through create_postnum() and remove_postnum() instead."""
+        if self.database() is not None:
+            return self.database().set_postnums(values)
+        for board in self.counters.boards():
+            if board not in values:
+                self.counters.remove(board)
+        for board, value in values.items():
+            if self.counters.read(board) != value:
+                self.counters.set(board, value)
+        logging.info("Updated post counters.")
+        return True
+
+    def create_postnum(self, board):
+        """Start the post counter of the new board board at 0."""
+        if self.database() is not None:
+            return self.database().set_postnums({board: 0})
+        self.counters.create(board)
         return True
+
+    def remove_postnum(self, board):
+        """Remove the post counter of the deleted board board. The
+        database drops it together with the board's row."""
+        if self.database() is None:
+            self.counters.remove(board)
+        return True
+
+    def reserve_postnums(self, board, count=1):
+        """Reserve count consecutive post numbers on board and return the
+        first one. Bulk importers can claim a whole block at once."""
+        if self.database() is not None:
+            return self.database().reserve_postnums(board, count)
+        return self.counters.reserve(board, count)
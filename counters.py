@@ -0,0 +1,106 @@
+"""
+Per-board post number counters.
+
+Every board has its own counter file, <postnums_path>.d/<board>, holding
+the highest post number handed out on that board. Numbers are reserved
+under the fileio writer lock of the counter and the new value is written
+with fileio.atomic_write(), so a crash can skip numbers but
+never hand one out twice. Boards that don't have a counter file yet start
+from their value in the old shared postnums file.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import json
+import os
+
+import fileio
+
+
+class PostCounters():
+
+    def __init__(self, path, legacy_path=None):
+        self.path = path
+        self.legacy_path = legacy_path
+        # {board: (stamp, value)}, see read_all().
+        self._cache = {}
+
+    def counter_path(self, board):
+        return os.path.join(self.path, board)
+
+    def legacy_value(self, board):
+        """Returns the board's count from the old postnums file."""
+        try:
+            with open(self.legacy_path, 'r') as p:
+                return json.load(p).get(board, 0)
+        except (TypeError, FileNotFoundError, ValueError):
+            return 0
+
+    def read(self, board):
+        """Returns the highest post number handed out on board."""
+        try:
+            with open(self.counter_path(board), 'r') as c:
+                return int(c.read())
+        except FileNotFoundError:
+            return self.legacy_value(board)
+
+    def write(self, board, value):
+        fileio.atomic_write(self.counter_path(board), str(value))
+
+    def lock(self, board):
+        os.makedirs(self.path, exist_ok=True)
+        return fileio.locked(self.counter_path(board))
+
+    def reserve(self, board, count=1):
+        """Reserves count consecutive post numbers on board and returns
+        the first one."""
+        with self.lock(board):
+            first = self.read(board) + 1
+            self.write(board, first + count - 1)
+        return first
+
+    def set(self, board, value):
+        with self.lock(board):
+            self.write(board, value)
+
+    def create(self, board):
+        """Starts a new board's counter at 0. Other boards' counters are
+        never touched, see remove()."""
+        self.set(board, 0)
+        self._cache.pop(board, None)
+
+    def remove(self, board):
+        for p in (self.counter_path(board), self.counter_path(board) + ".lock"):
+            if os.path.exists(p):
+                os.remove(p)
+        self._cache.pop(board, None)
+
+    def boards(self):
+        """Returns the names of all boards with a counter file."""
+        try:
+            files = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return [f for f in files if "." not in f]
+
+    def read_all(self, boards):
+        """Returns {board: count} for boards.
+
+        Values are cached and a counter file is only opened again when its
+        stat() changes."""
+        counts = {}
+        for board in boards:
+            try:
+                st = os.stat(self.counter_path(board))
+                stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+            except FileNotFoundError:
+                stamp = None
+            cached = self._cache.get(board)
+            if cached is not None and cached[0] == stamp:
+                counts[board] = cached[1]
+                continue
+            counts[board] = self.read(board)
+            self._cache[board] = (stamp, counts[board])
+        return counts
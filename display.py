@@ -19,6 +19,11 @@ import logging
 import time
 import urwid as ur
 
+import catalog
+import changes
+import search
+import watch
+
 
 logging.basicConfig(
     filename="log",
@@ -36,6 +41,20 @@ class CleanButton(ur.Button):
         self._w = ur.SelectableIcon(caption, 0)
 
 
+class SearchEdit(ur.Edit):
+    """Edit box that calls callback(edit) when Enter is pressed."""
+
+    def __init__(self, caption, callback):
+        super(SearchEdit, self).__init__(caption, wrap="clip")
+        self.callback = callback
+
+    def keypress(self, size, key):
+        if key == "enter":
+            self.callback(self)
+            return None
+        return super(SearchEdit, self).keypress(size, key)
+
+
 class MyOverlay(ur.Overlay):
 
     def __init__(
@@ -145,6 +164,11 @@ class Loop(ur.MainLoop):
     def stack_len(self):
         return len(self._widget_stack)
 
+    def on_stack(self, widget):
+        """Whether widget is still on the stack, i.e. shown or one ESC away
+        from being shown."""
+        return any(w is widget for w in self._widget_stack)
+
     @property
     def frameBody(self):
         """Returns body (a list of widgets in the form of
@@ -166,6 +190,8 @@ class Display:
         self.div = ur.Divider()
         # Used in list_boards().
         self.boards_count = 0
+        self.boards_page = 0
+        self.catalog = catalog.get_catalog(config)
 
         self.loop = Loop(None, self.unhandled)
         # Calculate min_width and left/right margins for Padding widgets.
@@ -179,6 +205,20 @@ class Display:
         # Another flag, this one is for board list display - it should only
         # be printed in the main menu/MOTD screen, nowhere else.
         self.motd_flag = False
+        # Same as help_flag, for the search screen.
+        self.search_flag = False
+        # (query, hits, page) of the last search, see run_search().
+        self.search_results = None
+        # Watches the board the views on the stack show, see watch_view().
+        self.watcher = None
+        self.watched = None
+        self.watch_handle = None
+        self.update_pending = False
+        # [(frame, update)] of the views that follow the board.
+        self.views = []
+        # Post number of the board when the current view was shown, for
+        # the count of new posts in the footer.
+        self.shown_postnum = None
 
     def run(self):
         """This method needs to be called to actually start the display.
@@ -210,9 +250,8 @@ class Display:
             self.margin, self.margin)
 
         # TODO: add currently online users to the footer.
-        self.footer = ur.AttrMap(ur.Text(
-            " " + self.config.server_name + " " + self.config.version +
-            " | Press H for help", align="center"), "reverse", None)
+        self.footer = ur.AttrMap(ur.Text("", align="center"), "reverse", None)
+        self.set_footer()
 
         try:
             with open(self.config.motd, 'r') as m:
@@ -225,6 +264,80 @@ class Display:
 
         return ur.Frame(mid, self.header, self.footer, focus_part="body")
 
+    def set_footer(self):
+        """Shows the server, and how many posts came in on the board since
+        the current view was shown."""
+        text = " " + self.config.server_name + " " + self.config.version + \
+            " | Press H for help"
+        if self.watcher is not None and self.shown_postnum is not None:
+            new = self.config.get_postnum(self.watched) - self.shown_postnum
+            if new > 0:
+                text += " | {0} new post{1}".format(new, "" if new == 1
+                                                    else "s")
+        self.footer.original_widget.set_text(text)
+
+    def watch_view(self, frame, update):
+        """Calls update() whenever the current board changes, for as long
+        as frame is on the widget stack (see BoardView). The board is
+        watched through its files (see watch.py), so a view that is just
+        being looked at costs nothing until someone posts."""
+        if self.watched != self.board.name:
+            self.unwatch()
+            self.watcher = self.board.watch()
+            self.watched = self.board.name
+            if self.watcher.fileno() is not None:
+                self.watch_handle = self.loop.watch_file(
+                    self.watcher.fileno(), self.board_changed)
+            else:
+                self.watch_handle = self.loop.set_alarm_in(
+                    self.watcher.interval, self.board_polled)
+        self.views.append((frame, update))
+        self.shown_postnum = self.config.get_postnum(self.watched)
+        self.set_footer()
+
+    def unwatch(self):
+        if self.watcher is None:
+            return
+        if self.watcher.fileno() is not None:
+            self.loop.remove_watch_file(self.watch_handle)
+        else:
+            self.loop.remove_alarm(self.watch_handle)
+        self.watcher.close()
+        self.watcher = None
+        self.watched = None
+        self.views = []
+
+    def board_changed(self):
+        """The watcher's descriptor is readable."""
+        if self.watcher.changed() and not self.update_pending:
+            # Give the writer time to finish, see watch.SETTLE.
+            self.update_pending = True
+            self.loop.set_alarm_in(watch.SETTLE, self.update_views)
+
+    def board_polled(self, loop, data):
+        self.watch_handle = self.loop.set_alarm_in(
+            self.watcher.interval, self.board_polled)
+        if self.watcher.changed():
+            self.update_views()
+
+    def update_views(self, *args):
+        """Brings the views following the board up to date."""
+        self.update_pending = False
+        if not self.prune_views():
+            return
+        for frame, update in self.views:
+            update()
+        self.set_footer()
+
+    def prune_views(self):
+        """Forgets the views that left the stack, and stops watching the
+        board once there are none. Returns whether any are left."""
+        self.views = [(f, u) for f, u in self.views if self.loop.on_stack(f)]
+        if not self.views:
+            self.unwatch()
+            self.set_footer()
+        return bool(self.views)
+
     def make_header(self):
         """Populate the row of board buttons on top."""
         # TODO: make it intelligent so it fits in the terminal window
@@ -234,7 +347,7 @@ class Display:
         longest = 0
         btn_list = []
 
-        for board in sorted(self.config.get_boardlist().keys()):
+        for board in self.catalog.names():
             # This `if` block should be removed when the function learns to
             # calculate horizontal space required.
             if i >= self.config.max_boards:
@@ -256,7 +369,7 @@ class Display:
         @data - (string) additional data provided by calling button
             instance, used to define what action should be taken.
         """
-        if data in self.config.get_boardlist().keys():
+        if data in self.catalog:
             # Board button was pressed.
             # If the board was entered from any view other than MOTD
             # (e.g. other board view), pop the widget from stack, so
@@ -265,17 +378,25 @@ class Display:
                 del self.loop.Widget
             self.motd_flag = False
             self.help_flag = False
+            self.search_flag = False
             self.board.name = data
             # Transfer control to BoardView instance.
             BoardView(self.loop, self.config, self.board, self)
         elif data == "back":
             # Clear the help flag, to avoid bugs.
             self.help_flag = False
+            self.search_flag = False
             # Go back, restore saved widgets from previous screen.
             del self.loop.Widget
+            self.prune_views()
             # Check if we're on the main screen to avoid bugs.
             if self.loop.stack_len == 1:
                 self.motd_flag = True
+        elif data == "more":
+            # Swap the "more" button for the next page of the board list.
+            self.loop.frameBody.pop()
+            self.boards_count -= 1
+            self.loop.frameBody.extend(self.list_boards(self.boards_page + 1))
         elif data == "quit":
             # Bai
             raise ur.ExitMainLoop()
@@ -308,11 +429,16 @@ class Display:
             self.motd_flag = False
             if not self.help_flag:
                 self.loop.Widget = self.show_help()
+        elif key in ("S", "s"):
+            self.motd_flag = False
+            if not self.search_flag:
+                self.loop.Widget = self.show_search()
         elif key in ("B", "b"):
             if not self.list_visible and self.motd_flag:
                 # If board list isn't currently being displayed, let's show it.
                 self.list_visible = True
-                self.loop.frameBody.extend(self.list_boards())
+                self.boards_count = 0
+                self.loop.frameBody.extend(self.list_boards(1))
             elif self.list_visible and self.motd_flag:
                 # Board list was being displayed, get rid of it.
                 for i in range(self.boards_count):
@@ -368,6 +494,8 @@ browsing and posting."], "center")
         pg5 = ur.Text(
             [("green", "B b"), (None, " - view available boards")])
         pg6 = ur.Text(
+            [("green", "S s"), (None, " - search the posts of every board")])
+        pg7 = ur.Text(
             [("green", "ESC"),
              (
                  None,
@@ -378,25 +506,101 @@ browsing and posting."], "center")
 
         help_body = ur.Padding(ur.ListBox(ur.SimpleListWalker([
             self.div, help_header, self.div, pg1, self.div, pg2,
-            pg3, pg4, pg5, pg6, self.div, back_btn])),
+            pg3, pg4, pg5, pg6, pg7, self.div, back_btn])),
             "center", self.width, 0, self.margin, self.margin)
 
         return ur.AttrMap(ur.Frame(help_body, self.header, self.footer,
                                    "body"), "bg")
 
-    def list_boards(self):
-        """Display a column of buttons listing all available boards."""
-        boards = self.config.get_boardlist()
+    def show_search(self):
+        """Create and return Frame object with a search box; the results
+        are listed below it (see run_search())."""
+        self.search_flag = True
+
+        search_header = ur.Text(("green", "SEARCH"), "center")
+        hint = ur.Text("Words to look for; \"quote\" words to find them "
+                       "in that order. Enter searches.", "center")
+        query = SearchEdit(("blue", "Search: "), self.run_search)
+        self.search_body = ur.SimpleFocusListWalker(
+            [self.div, search_header, self.div, hint, self.div, query,
+             self.div])
+
+        body = ur.Padding(ur.ListBox(self.search_body),
+                          "center", self.width, 0, self.margin, self.margin)
+        body.original_widget.set_focus(5)
+
+        return ur.AttrMap(ur.Frame(body, self.header, self.footer,
+                                   "body"), "bg")
+
+    def run_search(self, edit):
+        """Callback of the search box: lists the first page of results."""
+        # Everything below the search box goes.
+        del self.search_body[7:]
+        query = edit.edit_text
+        hits, total = search.search_boards(
+            self.config, query, self.catalog.names())
+        self.search_results = (query, hits, 0)
+        self.search_body.append(ur.Text(
+            ("yellow", "{0} posts found.".format(total))))
+        self.search_body.append(self.div)
+        self.search_body.extend(self.search_page(1))
+
+    def search_page(self, page):
+        """Return buttons for the results on page number page of the last
+        search, followed by a button for the next page if there is one."""
+        query, hits, _ = self.search_results
+        shown, pages = search.results_page(hits, page)
+        self.search_results = (query, hits, page)
 
         btn_list = []
-        for board, desc in sorted(boards.items()):
+        for hit in shown:
+            thread, post = search.find_post(self.config, hit)
+            if post is None:
+                continue
             btn_list.append(ur.AttrMap(ur.Button(
-                "/" + board + "/   -   " + desc, self.button_press, board),
+                "/" + hit.board + "/ No. " + str(post.id) + "   " +
+                search.snippet(post.text, query), self.open_result, hit),
                 None, "reverse"))
             btn_list.append(self.div)
+        if page < pages:
+            btn_list.append(ur.AttrMap(ur.Button(
+                "More results...", self.more_results, None),
+                None, "reverse"))
+        return btn_list
+
+    def more_results(self, button, data):
+        # Swap the "more" button for the next page of results.
+        self.search_body.pop()
+        self.search_body.extend(self.search_page(self.search_results[2] + 1))
+
+    def open_result(self, button, hit):
+        """Shows the thread of a search result."""
+        self.search_flag = False
+        self.board.name = hit.board
+        view = BoardView(self.loop, self.config, self.board, self)
+        view.print_thread(None, str(hit.post))
+
+    def list_boards(self, page):
+        """Return a column of buttons listing one page of the boards,
+        followed by a button for the next page if there is one."""
+        boards, pages = self.catalog.listing(page=page)
+
+        btn_list = []
+        for info in boards:
+            btn_list.append(ur.AttrMap(ur.Button(
+                "/" + info.name + "/   -   " + info.desc + "   (" +
+                str(info.threads) + " threads, " + str(info.posts) +
+                " posts)", self.button_press, info.name),
+                None, "reverse"))
+            btn_list.append(self.div)
+        if page < pages:
+            btn_list.append(ur.AttrMap(ur.Button(
+                "More boards...", self.button_press, "more"),
+                None, "reverse"))
 
         # boards_count is here so the list can be dynamically displayed.
-        self.boards_count = len(btn_list)
+        self.boards_page = page
+        self.boards_count += len(btn_list)
         return btn_list
 
 
@@ -423,93 +627,161 @@ class BoardView:
             time.localtime(int(stamp))))
 
     def parse_post(self, post):
-        """Read post JSON and return values in easily-readable dictionary."""
-        # Old json - without name field
-        if len(post) == 3:
-            parsed_post = {
-                "name": "Anonymous",
-                "stamp": self.convert_time(post[0]),
-                "id": str(post[1]),
-                "text": ur.Text(post[2])
-            }
-        else:
-            parsed_post = {
-                "name": post[0],
-                "stamp": self.convert_time(post[1]),
-                "id": str(post[2]),
-                "text": ur.Text(post[3])
-            }
-
-        return parsed_post
-
-    def show_board(self):
-        index = self.board.get_index()
+        """Turn a model.Post into an easily-readable dictionary."""
+        return {
+            "name": post.name,
+            "stamp": self.convert_time(post.time),
+            "id": str(post.id),
+            "text": ur.Text(post.text)
+        }
+
+    def show_board(self, page=1):
+        # Taken first, so nothing posted while the page is read is missed.
+        version = [self.board.version()]
+        threads, pages = self.board.get_page(
+            page, self.config.threads_per_page, preview_replies=3)
         new_btn = ur.AttrMap(
             ur.Button("New thread", self.reply_box, -1), "green", "b_green")
         thread_list = ur.SimpleFocusListWalker(
             [ur.Padding(new_btn, "center", ("relative", 40)), self.parent.div])
-
-        for thread in index:
-            # Check subject, because empty subject with set color attribute
-            # produces wrong output.
-            subject = ("reverse_red", thread[1])
-            if subject[1] == "":
-                subject = (None, "")
-
-            op = self.parse_post(thread[2])
-
-            post_info = ur.Text([("reverse_green", op["name"]),
-                                 " " + op["stamp"] + " ", subject, " No. " +
-                                 op["id"]])
-            reply_btn = ur.AttrMap(CleanButton(
-                "Reply", self.print_thread, op["id"]), None, "reverse")
-
-            replies = []
-            if len(thread) > 3:
-                for i in range(3, 6):
-                    try:
-                        reply = self.parse_post(thread[i])
-                        replies_info = ur.Text(
-                            [("green", reply["name"]), " " + reply["stamp"]])
-                        no_btn = CleanButton(
-                            "No. " + reply["id"],
-                            self.print_thread,
-                            reply["id"])
-
-                        replies_header = ur.Padding(ur.Columns(
-                            [("pack", replies_info), ("pack", no_btn)],
-                            1), left=1)
-                        reply_text = ur.Padding(reply["text"], left=1)
-
-                        replies.extend(
-                            [replies_header, reply_text, self.parent.div])
-                    except IndexError:
-                        break
-
-            header = ur.AttrMap(ur.Columns(
-                [("pack", post_info), ("pack", reply_btn)], 1), "reverse")
-
-            thread_buf = [header, op["text"], self.parent.div]
-            thread_buf.extend(replies)
-            thread_list.extend(thread_buf)
+        # {thread ID: [last post shown, its text widget]}, see update_board().
+        shown = {}
+
+        for thread in threads:
+            thread_list.extend(self.thread_widgets(thread, shown))
+
+        # Page buttons.
+        page_btns = []
+        if page > 1:
+            page_btns.append(ur.AttrMap(ur.Button(
+                "Previous page", self.turn_page, page - 1), None, "reverse"))
+        if page < pages:
+            page_btns.append(ur.AttrMap(ur.Button(
+                "Next page", self.turn_page, page + 1), None, "reverse"))
+        if page_btns:
+            thread_list.extend([ur.Columns(page_btns, 1), ur.Text(
+                "Page {0} of {1}".format(page, pages), "center")])
 
         body = ur.ListBox(thread_list)
         if len(thread_list) > 0:
             body.set_focus(0)
 
-        self.loop.Widget = ur.Frame(
-            body, self.parent.header, self.parent.footer, "body")
+        frame = ur.Frame(body, self.parent.header, self.parent.footer, "body")
+        self.loop.Widget = frame
+        self.parent.watch_view(
+            frame, lambda: self.update_board(thread_list, page, shown,
+                                             version))
+
+    def thread_widgets(self, thread, shown):
+        """Returns the widgets of a thread on a board page, and records its
+        last post in shown."""
+        # Check subject, because empty subject with set color attribute
+        # produces wrong output.
+        subject = ("reverse_red", thread.subject)
+        if subject[1] == "":
+            subject = (None, "")
+
+        op = self.parse_post(thread.op)
+
+        post_info = ur.Text([("reverse_green", op["name"]),
+                             " " + op["stamp"] + " ", subject, " No. " +
+                             op["id"]])
+        reply_btn = ur.AttrMap(CleanButton(
+            "Reply", self.print_thread, op["id"]), None, "reverse")
+
+        header = ur.AttrMap(ur.Columns(
+            [("pack", post_info), ("pack", reply_btn)], 1), "reverse")
+
+        thread_buf = [header, op["text"], self.parent.div]
+        shown[thread.id] = [thread.op.id, op["text"]]
+        # get_page() already cut the thread down to its last replies.
+        for post in thread.replies:
+            replies = self.preview_widgets(post)
+            thread_buf.extend(replies)
+            shown[thread.id] = [post.id, replies[1]]
+        return thread_buf
+
+    def preview_widgets(self, post):
+        """The widgets of a reply on a board page: header, text and a
+        divider."""
+        reply = self.parse_post(post)
+        replies_info = ur.Text(
+            [("green", reply["name"]), " " + reply["stamp"]])
+        no_btn = CleanButton(
+            "No. " + reply["id"],
+            self.print_thread,
+            reply["id"])
+
+        replies_header = ur.Padding(ur.Columns(
+            [("pack", replies_info), ("pack", no_btn)],
+            1), left=1)
+        reply_text = ur.Padding(reply["text"], left=1)
+        return [replies_header, reply_text, self.parent.div]
+
+    def update_board(self, thread_list, page, shown, version):
+        """Splices the posts that came in since show_board() into the page:
+        new replies under their threads and, on the first page, new
+        threads on top. Threads stay where they are, and so does the
+        user's place on the page. Only the threads the board's change log
+        names are read, unless it doesn't go back to version[0]."""
+        version[0], changed = self.board.changes_since(version[0])
+        if changed is None:
+            replied, created = list(shown), True
+        else:
+            replied = set(c.thread for c in changed
+                          if c.kind == changes.ADDED).intersection(shown)
+            created = any(c.kind == changes.CREATED for c in changed)
+        for thread_id in replied:
+            last = shown[thread_id]
+            posts = self.board.get_posts_after(thread_id, last[0])
+            if not posts:
+                continue
+            # Right after the divider under the last post shown.
+            at = thread_list.index(last[1]) + 2
+            for post in posts:
+                widgets = self.preview_widgets(post)
+                thread_list[at:at] = widgets
+                at += len(widgets)
+                shown[thread_id] = last = [post.id, widgets[1]]
+        if page != 1 or not created:
+            return
+        threads = self.board.get_page(
+            1, self.config.threads_per_page, preview_replies=3)[0]
+        # Thread IDs are the post numbers of their OPs, so new threads
+        # have higher ones.
+        newest = max(shown) if shown else 0
+        widgets = []
+        for thread in threads:
+            if thread.id > newest:
+                widgets.extend(self.thread_widgets(thread, shown))
+        # Below the "New thread" button.
+        thread_list[2:2] = widgets
+
+    def turn_page(self, button, page):
+        # Replace the current page instead of stacking pages up, so ESC
+        # still leads back out of the board.
+        del self.loop.Widget
+        self.show_board(page)
 
     def print_thread(self, button, thread):
-        thr_no = self.board.thread_exists(int(thread))
-        thr_body = self.board.get_index()[thr_no]
+        thr_no = self.board.thread_exists(int(thread), return_id=True)
+        thr_body = self.board.get_thread(thr_no)
+        archived = thr_body is None
+        if archived:
+            # Removed or archived since the page linking to it was shown.
+            thr_body = self.board.get_archived(int(thread))
+        if thr_body is None:
+            self.loop.Widget = ur.Frame(
+                ur.Filler(ur.Text(("red", "Thread not found."), "center")),
+                self.parent.header, self.parent.footer, "body")
+            return
         replies = ur.SimpleFocusListWalker([])
 
-        subject = ("reverse_red", thr_body[1])
+        subject = ("reverse_red", thr_body.subject)
         if subject[1] == "":
             subject = (None, "")
 
-        op = self.parse_post(thr_body[2])
+        op = self.parse_post(thr_body.op)
         op_info = ur.Text([("reverse_green", op["name"]),
                            " " + op["stamp"] + " ", subject])
         op_btn = CleanButton(
@@ -520,26 +792,45 @@ class BoardView:
 
         replies.extend([op_widget, op["text"], self.parent.div])
 
-        if len(thr_body) > 3:
-            for postno in range(3, len(thr_body)):
-                reply = self.parse_post(thr_body[postno])
-
-                reply_info = ur.Text(
-                    [("green", reply["name"]), " " + reply["stamp"]])
-                reply_btn = CleanButton(
-                    "No. " + reply["id"], self.reply_box, reply["id"])
-
-                reply_widget = ur.Columns(
-                    [("pack", reply_info), ("pack", reply_btn)],
-                    1)
-
-                replies.extend([reply_widget, reply["text"], self.parent.div])
+        for post in thr_body.replies:
+            replies.extend(self.reply_widgets(post))
 
         contents = ur.ListBox(replies)
         contents.set_focus(0)
 
-        self.loop.Widget = ur.Frame(
+        frame = ur.Frame(
             contents, self.parent.header, self.parent.footer, "body")
+        self.loop.Widget = frame
+        if archived:
+            # Archived threads don't change.
+            return
+        # The last post shown, see update_thread().
+        last = [thr_body.posts[-1].id]
+        self.parent.watch_view(
+            frame, lambda: self.update_thread(replies, thr_no, last))
+
+    def reply_widgets(self, post):
+        """The widgets of a reply in a thread: header, text and a
+        divider."""
+        reply = self.parse_post(post)
+
+        reply_info = ur.Text(
+            [("green", reply["name"]), " " + reply["stamp"]])
+        reply_btn = CleanButton(
+            "No. " + reply["id"], self.reply_box, reply["id"])
+
+        reply_widget = ur.Columns(
+            [("pack", reply_info), ("pack", reply_btn)],
+            1)
+        return [reply_widget, reply["text"], self.parent.div]
+
+    def update_thread(self, replies, thread_id, last):
+        """Adds the posts that came in since print_thread() to the end of
+        the thread; the focus, and with it the user's place, stays put."""
+        posts = self.board.get_posts_after(thread_id, last[0])
+        for post in posts or []:
+            replies.extend(self.reply_widgets(post))
+            last[0] = post.id
 
     def reply_box(self, button, thr_id):
         subject = ur.Edit(("blue", "Subject: "), wrap="clip")
@@ -5,7 +5,6 @@ Copyright (c) 2016
 chibi <http://neetco.de/chibi>, makos <https://github.com/makos/>
 under GNU GPL v2, see LICENSE for details
 """
-import math
 import os
 import re
 import string
@@ -15,8 +14,10 @@ from sys import exit
 
 # Help texts and user guides
 import helptexts
+import search
 
-THREADSPERPAGE = 10 # TODO - Move to the conf file
+# Returned by display_thread() for a thread found in the board's archive.
+ARCHIVED = "archived"
 
 class DisplayLegacy:
 
@@ -160,100 +161,121 @@ class DisplayLegacy:
         if self.board.board_exists(self.board.name) == False:
             return False
 
-        index = self.board.get_index()
-
         # Pagination
-        hidden_pages = 0
-        threads_number = len(index)
-        last_page = 0
-        if type(THREADSPERPAGE) == int and THREADSPERPAGE != 0:
-            first_thread_to_display = (THREADSPERPAGE * page) - THREADSPERPAGE
-            last_thread_to_display = (THREADSPERPAGE * page)
-            if last_thread_to_display > threads_number: # Less than THREADPERPAGE threads on the board
-                last_thread_to_display = threads_number
-                first_thread_to_display = threads_number - THREADSPERPAGE
-                if threads_number < THREADSPERPAGE:
-                    first_thread_to_display = 0
-            else:
-                last_page = math.ceil(threads_number / THREADSPERPAGE)
-                hidden_pages = last_page - page
-        else:
-            first_thread_to_display = 0
-            last_thread_to_display = len(index)
-        
-        for x in reversed(range(first_thread_to_display, last_thread_to_display)): # reversed() makes newest threads appear at the bottom.
-            thread = index[x]
-            thread_id = thread[0]
-            del thread
-            self.display_thread(thread_id, index=index, op_only=True)
+        page = max(1, page)
+        threads, last_page = self.board.get_page(
+            page, self.config.threads_per_page, preview_replies=1)
+        if page > last_page: # Past the end, show the last page instead.
+            page = last_page
+            threads, last_page = self.board.get_page(
+                page, self.config.threads_per_page, preview_replies=1)
+        hidden_pages = last_page - page
+
+        for thread in reversed(threads): # reversed() makes newest threads appear at the bottom.
+            self.print_thread(thread, op_only=True)
         self.layout()
 
-        if hidden_pages >= last_page:
+        if hidden_pages == 0:
             print(self.c.RED + "No more pages to display")
-        elif hidden_pages > 0:
+        else:
             print(self.c.RED + str(hidden_pages) + " more pages, enter " + self.c.GREEN + "'p " + str((page + 1)) + "'" + self.c.RED + " to see the next page.")
 
 
-    def display_thread(self, thread_id, index=None, op_only=False, replies=1000):
+    def display_thread(self, thread_id, op_only=False, replies=1000):
         """Displays a thread.
         thread_id is self-explanatory.
-        index: the thread index. It is an argument to cut down on reading
-         the index file for every thread.
         op_only: if True, print only the OP post.
-        replies is the number of replies to print."""
-        if index == None:
-            index = self.board.get_index()
+        replies is the number of replies to print.
+        Returns True if the thread was shown, ARCHIVED if it was shown
+        from the board's archive (it can't be replied to) and False if
+        there is no such thread."""
+        # thread_id may also be the number of a reply in the thread.
+        post_no = abs(int(thread_id))
+        thread_id = self.board.thread_exists(post_no, return_id=True)
 
-        post_line_limit = None
-        lst = "    "
-        # The index of the thread in the index file
-        thread_pos = self.board.thread_exists(int(thread_id))
+        if op_only == True:
+            replies = 1
+
+        thread = None
+        if thread_id != -1: # -1 is the false return value for thread_exists()
+            # Only read the posts we are going to print.
+            thread = self.board.get_thread(thread_id, replies=replies)
+        else:
+            # It may have been moved to the board's archive.
+            thread = self.board.get_archived(post_no, replies=replies)
+            if thread is not None:
+                print(self.c.YELLOW + "This thread is archived and can't " \
+                    "be replied to." + self.c.BLACK)
 
-        if thread_pos == -1: # -1 is the false return value for thread_exists()
+        if thread is None:
             print(self.c.RED + 'Thread not found.' + self.c.BLACK)
             return False
-        
+
+        self.print_thread(thread, op_only=op_only)
+        return True if thread_id != -1 else ARCHIVED
+
+    def display_search(self, query, hits, total, page):
+        """Prints page number page of the results of a search (see
+        search.py); total is the number of posts found."""
+        shown, pages = search.results_page(hits, page)
+        self.laprint(self.c.GREEN + "SEARCH: " + self.c.BLACK + query)
+        if not hits:
+            self.laprint(self.c.RED + "Nothing found." + self.c.BLACK)
+            return
+        for hit in shown:
+            thread, post = search.find_post(self.config, hit)
+            if post is None:
+                continue
+            self.laprint(self.c.YELLOW + "/" + hit.board + "/" + \
+                self.c.GREEN + " No." + str(post.id) + self.c.BLACK + \
+                " in thread " + str(thread.id) + ", " + \
+                self.convert_time(post.time))
+            self.laprint(search.snippet(post.text, query), linestart="    ")
+        if page < pages:
+            self.laprint(self.c.GREEN + "Page " + str(page) + " of " + \
+                str(pages) + ", " + str(total) + " posts. Type \'search\' " \
+                "for the next page." + self.c.BLACK)
         else:
-            thread = index[thread_pos]
+            self.laprint(self.c.GREEN + str(total) + " posts found." + \
+                self.c.BLACK)
 
+    def print_thread(self, thread, op_only=False):
+        """Prints a thread (a model.Thread, usually cut down with
+        preview()). op_only shortens the posts for board pages."""
+        post_line_limit = None
+        lst = "    "
         if op_only == True:
-            replies = 1
             post_line_limit = 5
-        
-        posts = [thread[2]] + thread[3:][-replies:]
-        
+
         op = True # Used to prepend lines with lst
         
         # print the subject
-        self.laprint(self.c.RED + str(thread[1]) + self.c.BLACK)
-
-        for reply in posts: # reversed() would the newest posts appear at the bottom
-            if len(reply) == 3: # The old json format - just date, post_no and post_text
-                name = "Anonymous"
-                date = self.convert_time(int(reply[0]))
-                post_no = str(reply[1])
-                post_text = str(reply[2]).rstrip()
-            else:
-                name = reply[0] 
-                date = self.convert_time(int(reply[1]))
-                post_no = str(reply[2])
-                post_text = str(reply[3]).rstrip()
-            
+        self.laprint(self.c.RED + str(thread.subject) + self.c.BLACK)
+
+        for reply in thread.posts: # reversed() would the newest posts appear at the bottom
             if not op:
                 lst = ""
-            
-            self.laprint(self.c.YELLOW + name, end=' ', linestart=lst)
-            self.laprint(self.c.GREEN + date + self.c.BLACK + ' No.' + post_no, end=' ')
-            self.laprint()
-            self.laprint(post_text, markup=True, line_limit=post_line_limit, linestart=lst)
-            
+            self.print_post(reply, linestart=lst, line_limit=post_line_limit)
             op = False
 
         if op_only == True:
-            self.laprint(self.c.GREEN + str(len(thread) - 3), "replies \
-hidden. Type \'v " + str(thread_id) + "\' to view them.\n")
-
-        return True
+            self.laprint(self.c.GREEN + str(thread.omitted), "replies \
+hidden. Type \'v " + str(thread.id) + "\' to view them.\n")
+
+    def print_post(self, post, linestart="", line_limit=None):
+        """Prints one post (a model.Post)."""
+        self.laprint(self.c.YELLOW + post.name, end=' ', linestart=linestart)
+        self.laprint(self.c.GREEN + self.convert_time(int(post.time)) + \
+            self.c.BLACK + ' No.' + str(post.id), end=' ')
+        self.laprint()
+        self.laprint(str(post.text).rstrip(), markup=True,
+                     line_limit=line_limit, linestart=linestart)
+
+    def flush(self):
+        """Prints the buffer as it is, without filling the screen up like
+        layout() does."""
+        print(self.buf, end='', flush=True)
+        self.buf = ''
 
     def post_menu(self, thread_id=-1):
         """Get post from the user and send it to addPost()."""
@@ -301,7 +323,7 @@ self.config.username + self.c.BLACK + "] "))
 
         success = self.board.add_post(post_text, name=name, \
                   subject=subject, thread_id=thread_id)
-        if success == True:
+        if success:
             print(self.c.GREEN + "Post successful!" + self.c.BLACK)
         else:
             print(self.c.RED + "Post failed." + self.c.BLACK)
@@ -1,3 +1,16 @@
+import re
+
+import catalog
+import display_legacy
+import search
+
+# Replies shown before follow waits for new ones.
+FOLLOW_CONTEXT = 5
+# Seconds after which follow looks for new posts even if the board's files
+# didn't seem to change.
+FOLLOW_RECHECK = 30
+
+
 class DisplayLegacyCmdline:
     """
     This class defines how the CLI operates.
@@ -12,6 +25,9 @@ class DisplayLegacyCmdline:
         self.config = config
         self.dl = dl # DisplayLegacy functions
         self.marker = marker
+        # (query, hits, total, page) of the last search, for paging
+        # through it.
+        self.last_search = None
 
     def run(self):
         self.dl.display_home()
@@ -79,7 +95,12 @@ class DisplayLegacyCmdline:
 
         try:
             success = self.dl.display_thread(cmd_argv[1])
-            if success == True:
+            if success == display_legacy.ARCHIVED:
+                # Not a thread of the board anymore: 're' and 'rt' act on
+                # the board, like the prompt says.
+                self.board.thread = 0
+                self.dl.layout()
+            elif success == True:
                 self.board.thread = self.board.thread_exists(cmd_argv[1], return_id=True)
                 self.dl.layout()
 
@@ -87,6 +108,80 @@ class DisplayLegacyCmdline:
             print(self.c.RED + cmd_argv[1], "is not a thread or post number.")
             self.dl.display_help(cmd="view")
 
+    def cmdline_search(self, line):
+        """The 'search' command: search <terms> [/board/]. On its own it
+        shows the next page of the last search."""
+        self.dl.buf = '' # Renew buffer
+        args = line.split()[1:]
+        if not args:
+            if self.last_search is None:
+                self.dl.display_help(cmd="search")
+                return False
+            query, hits, total, page = self.last_search
+            # Stay on the last page once there.
+            page = min(page + 1, search.results_page(hits, 1)[1])
+        else:
+            names = None
+            if len(args) > 1 and re.match(r"^/[^/]+/$", args[-1]):
+                board = self.board.convert_board_name(args[-1])
+                # Not board_exists(), which would also move us there.
+                if board not in catalog.get_catalog(self.config):
+                    print(self.c.RED + 'Board /' + board + '/ does not exist.' + self.c.BLACK)
+                    return False
+                names = [board]
+                args = args[:-1]
+            if names is None:
+                names = catalog.get_catalog(self.config).names()
+            query = " ".join(args)
+            hits, total = search.search_boards(self.config, query, names)
+            page = 1
+        self.last_search = (query, hits, total, page)
+        self.dl.display_search(query, hits, total, page)
+        self.dl.layout()
+
+    def cmdline_follow(self, cmd_argv):
+        """The 'follow' command: prints the posts of a thread as they come
+        in, until ^C. It sleeps until the board's files change (see
+        watch.py), then reads only the posts after the last one shown."""
+        if self.board.name == '':
+            print(self.c.RED + "You are not on a board. Use \'cd\' to change boards."\
+            + self.c.BLACK)
+            return False
+        if len(cmd_argv) > 1:
+            thread_id = self.board.thread_exists(cmd_argv[1], return_id=True)
+        else:
+            thread_id = self.board.thread or -1
+        thread = None
+        if thread_id != -1:
+            thread = self.board.get_thread(thread_id, replies=FOLLOW_CONTEXT)
+        if thread is None:
+            print(self.c.RED + "Thread not found." + self.c.BLACK)
+            self.dl.display_help(cmd="follow")
+            return False
+
+        self.board.thread = thread_id
+        self.dl.buf = '' # Renew buffer
+        self.dl.print_thread(thread)
+        self.dl.laprint(self.c.GREEN + "Following thread " + str(thread_id) + \
+            ". Press Ctrl-C to stop." + self.c.BLACK)
+        self.dl.flush()
+        last = thread.posts[-1].id
+        with self.board.watch() as watcher:
+            try:
+                while True:
+                    watcher.wait(FOLLOW_RECHECK)
+                    posts = self.board.get_posts_after(thread_id, last)
+                    if posts is None:
+                        print(self.c.RED + "The thread is gone." + self.c.BLACK)
+                        return False
+                    for post in posts:
+                        self.dl.print_post(post)
+                        last = post.id
+                    self.dl.flush()
+            except KeyboardInterrupt:
+                print()
+        return True
+
     def cmdline(self):
         """The command line that controls sshchan's behaviour."""
         # Printing out prompt
@@ -97,8 +192,8 @@ class DisplayLegacyCmdline:
         print(self.c.BLUE + self.config.prompt + "/" + self.board.name + "/" +\
             self.c.PURPLE + prompt_thread + self.c.BLUE + "/>" + self.c.BLACK, end=' ')
 
-        cmd = str(input())
-        cmd = self.marker.esc(cmd)
+        line = str(input())
+        cmd = self.marker.esc(line)
         cmd_argv = cmd.split()
 
         if len(cmd_argv) == 0:
@@ -127,7 +222,8 @@ class DisplayLegacyCmdline:
         elif cmd_argv[0] in ("ls", "list"):
             self.dl.buf = ''
             self.dl.laprint(self.c.GREEN + "BOARDS:" + self.c.BLACK)
-            self.dl.laprint(self.board.list_boards())
+            prefix, page = catalog.listing_args(cmd_argv[1:])
+            self.dl.laprint(self.board.list_boards(prefix, page))
             self.dl.layout()
 
         elif cmd_argv[0] in ("page", "p"):
@@ -139,10 +235,12 @@ class DisplayLegacyCmdline:
                 self.dl.display_help()
             else:
                 try:
-                    self.cmdline_board(board=self.board.name, page=int(cmd_argv[1]))
+                    page = int(cmd_argv[1])
                 except ValueError:
                     print(self.c.RED + cmd_argv[1], "is not a number.")
                     self.dl.display_help(cmd="page")
+                else:
+                    self.cmdline_board(board=self.board.name, page=page)
                     
 
         elif cmd_argv[0] in ("re", "reply"):
@@ -160,6 +258,12 @@ class DisplayLegacyCmdline:
         elif cmd_argv[0] in ("v", "view"):
             self.cmdline_view(cmd_argv)
 
+        elif cmd_argv[0] in ("s", "search"):
+            self.cmdline_search(line)
+
+        elif cmd_argv[0] in ("f", "follow"):
+            self.cmdline_follow(cmd_argv)
+
         else:
             print(self.c.RED + "Command \'" + cmd_argv[0] + "\' not found." + self.c.BLACK)
             self.dl.display_help()
@@ -0,0 +1,94 @@
+"""
+Safe file writing shared by everything that persists sshchan data.
+
+atomic_write() writes to a temporary file, fsyncs it and renames it over
+the target, so a reader in another ssh session sees either the old or the
+new contents, never a truncated file. Readers don't need to lock anything.
+
+Writers serialize on an advisory exclusive lock (fcntl.flock) on
+<path>.lock. locked() is reentrant within a process, so code that holds the
+lock for a read-modify-write cycle can still call atomic_write() on the
+same path.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import threading
+
+# {lock file path: [threading.RLock, open lock file or None, depth]}
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+@contextlib.contextmanager
+def locked(path, blocking=True):
+    """Holds the exclusive writer lock of path (the file <path>.lock).
+
+    With blocking=False, BlockingIOError is raised if another process or
+    thread holds the lock."""
+    lock_path = path + ".lock"
+    with _locks_guard:
+        if lock_path not in _locks:
+            _locks[lock_path] = [threading.RLock(), None, 0]
+        entry = _locks[lock_path]
+
+    if not entry[0].acquire(blocking):
+        raise BlockingIOError("lock {0} is held".format(lock_path))
+    try:
+        if entry[2] == 0:
+            lock = open(lock_path, 'a')
+            try:
+                flags = fcntl.LOCK_EX
+                if not blocking:
+                    flags |= fcntl.LOCK_NB
+                fcntl.flock(lock, flags)
+            except OSError:
+                lock.close()
+                raise BlockingIOError("lock {0} is held".format(lock_path))
+            entry[1] = lock
+        entry[2] += 1
+        try:
+            yield
+        finally:
+            entry[2] -= 1
+            if entry[2] == 0:
+                entry[1].close()
+                entry[1] = None
+    finally:
+        entry[0].release()
+
+
+def atomic_write(path, data, sync=True):
+    """Replaces the file at path with data (str or bytes).
+
+    sync=False skips the fsyncs: the file is still never seen half
+    written, but may be lost in a crash."""
+    mode = 'wb' if isinstance(data, (bytes, bytearray)) else 'w'
+    tmp_path = path + ".tmp"
+    with locked(path):
+        with open(tmp_path, mode) as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if sync:
+            # Make the rename itself durable.
+            dir_fd = os.open(os.path.dirname(os.path.abspath(path)),
+                             os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+    return True
+
+
+def write_json(path, values, indent=None, sync=True):
+    """atomic_write() of values dumped as JSON."""
+    return atomic_write(path, json.dumps(values, indent=indent), sync)
@@ -7,18 +7,32 @@ c.RED + "sshchan-admin help\n" \
 + c.GREEN + "add" + c.YELLOW + " [name] [description]\n" \
 + c.BLACK + "adds a board with [name] and [description]\n\
 don't use slashes, they're added automatically.\n" \
++ c.GREEN + "archive" + c.YELLOW + " [name]\n" \
++ c.BLACK + "moves threads past the retention limits of board [name] to its archive\n" \
++ c.GREEN + "compact" + c.YELLOW + " [name]\n" \
++ c.BLACK + "folds the post log of board [name] into its index\n" \
 + c.GREEN + "config" + c.YELLOW + " [option] [new value]\n" \
 + c.BLACK + "changes [option]'s value to [new value] in the sshchan.conf config file.\n" \
-+ c.GREEN + "list|ls\n" \
-+ c.BLACK + "lists boards\n" \
++ c.GREEN + "list|ls" + c.YELLOW + " [prefix] [page]\n" \
++ c.BLACK + "lists boards, or those whose names start with [prefix]\n" \
++ c.GREEN + "lsarchive" + c.YELLOW + " [name] [page]\n" \
++ c.BLACK + "lists the archived threads of board [name]\n" \
 + c.GREEN + "lsconfig\n" \
 + c.BLACK + "lists current configuration options\n" \
++ c.GREEN + "reindex" + c.YELLOW + " [name]\n" \
++ c.BLACK + "rebuilds the search index of board [name] from scratch and verifies it\n" \
 + c.GREEN + "rename" + c.YELLOW + " [name] [new description]\n" \
 + c.BLACK + "changes the description of board [name] to [new description]\n" \
++ c.GREEN + "restore" + c.YELLOW + " [name] [thread no.]\n" \
++ c.BLACK + "moves an archived thread back onto board [name] for good\n" \
++ c.GREEN + "retention" + c.YELLOW + " [name] [pages] [days]\n" \
++ c.BLACK + "shows or sets how many pages and days of threads board [name] keeps live, 0 for no limit\n" \
 + c.GREEN + "rm" + c.YELLOW + " [board] [post no.]\n" \
 + c.BLACK + "removes the post with post no. on board\n" \
 + c.GREEN + "rmboard" + c.YELLOW + " [name]\n" \
 + c.BLACK + "deletes board [name]\n" \
++ c.GREEN + "verify" + c.YELLOW + " [name]\n" \
++ c.BLACK + "checks the offset table, post map and search index of board [name] and rebuilds them if needed\n" \
 + c.GREEN + "exit\n" \
 + c.BLACK + "exits sshchan-admin"
 
@@ -26,6 +40,8 @@ display_legacy_helptext = \
 {"exit": ["exit | q | quit", "",  "Quits sshchan. Takes no arguments."],\
  "help": ["h | help", "[] | [command]", "Prints a help message."],\
  "cd": ["b | board | cd", "[board name]", "Displays the given board."],\
+ "ls": ["ls | list", "[] | [prefix] [page]",\
+ "Lists the boards, a page at a time, or the boards whose names start with [prefix]."],\
  "page": ["p | page", "[page no.]", "Choose which page of a board to display."],\
  "view": ["v | view", "[thread/post no.]", "Displays a thread."],\
 \
@@ -37,7 +53,13 @@ sshchan/board/> re " + c.GREEN + "# Posts a new thread to /board/\n" \
 "# Replies to thread no.1 with the given text." + c.BLACK \
 ],\
  "refresh": ["refresh | rb", "", "Refreshes the current board."],\
+ "search": ["s | search", "[] | [terms] [[/board/]]",\
+ "Searches the posts of every board, or just /board/, for all of the terms;\n\
+\"quote\" words to find them in that order. On its own, shows the next page of results."],\
  "rt": ["rt", "", "Refreshes the current thread."],\
+ "follow": ["f | follow", "[] | [thread/post no.]",\
+ "Shows the current thread, or the given one, and then its new posts as they\n\
+come in, until Ctrl-C."],\
 }
 
 markup_helptext = \
@@ -0,0 +1,193 @@
+"""
+Group-commit write-ahead journal in front of a board's storage.
+
+New posts are not written to the board right away. Each poster appends
+one line to boards/<name>/journal:
+    [thread ID, subject, post]
+where a new thread has the ID of its own first post. Whoever then gets the
+commit lock first becomes the leader: it makes everything appended so far
+durable, hands the whole batch to the store in one write (see
+IndexStore.add_posts()) and records how far the journal has been applied
+in journal.head, [generation, offset]. Posters that appended while the
+leader was busy find their entry already applied once they get the lock,
+so a burst of replies costs one board write instead of one per post.
+
+Once everything is applied the journal is emptied and the generation in
+journal.head goes up by one. Entries left behind by a crash are replayed
+the next time the board is opened; the store skips posts it already
+holds, so replaying twice is harmless.
+
+When an entry counts as durable depends on the journal_fsync option:
+    always      every poster fsyncs its own entry
+    batch       the leader fsyncs once for the whole batch (default)
+    never       the journal is never fsynced, the OS writes it out
+
+The SQLite engine has a write-ahead log of its own and is not journaled.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import json
+import logging
+import os
+import time
+
+import fileio
+import storage
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+POLICIES = ("always", "batch", "never")
+
+
+def open_journal(store, config):
+    """Returns the journal of a board's store, or None if the engine isn't
+    journaled. Unapplied entries are replayed first."""
+    if not isinstance(store, storage.IndexStore):
+        return None
+    journal = Journal(store, config)
+    journal.replay()
+    return journal
+
+
+def replay_all(config):
+    """Replays the journal of every board, e.g. when sshchan starts."""
+    for name in config.get_boardlist():
+        path = os.path.join(config.root, "boards", name)
+        open_journal(storage.get_store(path, config, local=True), config)
+
+
+class Journal():
+
+    def __init__(self, store, config):
+        self.store = store
+        self.path = os.path.join(store.path, "journal")
+        self.head_path = self.path + ".head"
+        # Held by the leader while it applies a batch, see wait().
+        self.commit_path = self.path + ".commit"
+
+        self.fsync = config.get_cfg_opt("journal_fsync", "batch")
+        if self.fsync not in POLICIES:
+            logging.error("Unknown journal_fsync \"%s\", using batch.",
+                          self.fsync)
+            self.fsync = "batch"
+        # How long a leader waits for more posts before committing.
+        self.window = int(config.get_cfg_opt("journal_window_ms", 2)) / 1000
+
+    def read_head(self):
+        """Returns (generation, applied offset) of the journal."""
+        try:
+            with open(self.head_path, 'r') as h:
+                generation, offset = json.load(h)
+                return generation, offset
+        except (FileNotFoundError, ValueError):
+            return 0, 0
+
+    def write_head(self, generation, offset):
+        fileio.write_json(self.head_path, [generation, offset],
+                          sync=self.fsync != "never")
+
+    def pending(self):
+        """Whether the journal holds entries that aren't applied yet."""
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return False
+        return size > self.read_head()[1]
+
+    def add_post(self, post_text, name, subject, thread_id, timestamp):
+        """Journals a new thread (thread_id == -1) or a reply and returns
+        once it is on the board. Returns the post number, or False if the
+        post couldn't be stored."""
+        store = self.store
+        if thread_id != -1 and store.find_thread(thread_id) != thread_id:
+            return False
+        # Post numbers are handed out under the journal lock, so the
+        # journal is always in post number order.
+        with fileio.locked(self.path):
+            post_no = store.config.reserve_postnums(store.name)
+            if store.locate(post_no) is not None:
+                # The board's counter went back; the store would skip the
+                # post as one it already holds.
+                logging.error("Post number %d is taken on %s.",
+                              post_no, store.path)
+                return False
+            if thread_id == -1:
+                thread_id = post_no
+            line = json.dumps([thread_id, subject,
+                               [name, timestamp, post_no, post_text]],
+                              separators=(',', ':')) + "\n"
+            with open(self.path, 'a') as j:
+                j.write(line)
+                j.flush()
+                if self.fsync == "always":
+                    os.fsync(j.fileno())
+                end = j.tell()
+            generation = self.read_head()[0]
+
+        self.wait(generation, end)
+        location = store.locate(post_no)
+        if location is None or location[0] != thread_id:
+            return False
+        return post_no
+
+    def wait(self, generation, end):
+        """Blocks until the entry ending at offset end of the given
+        journal generation is applied, committing it if nobody else
+        has."""
+        if self.window:
+            time.sleep(self.window)
+        with fileio.locked(self.commit_path):
+            applied_generation, applied = self.read_head()
+            if applied_generation > generation or applied >= end:
+                return
+            self.commit()
+
+    def replay(self):
+        """Applies entries left over from a crashed writer. Returns the
+        number of posts added to the board."""
+        if not self.pending():
+            return 0
+        try:
+            with fileio.locked(self.commit_path, blocking=False):
+                added = self.commit()
+        except BlockingIOError:
+            # Somebody else is committing them right now.
+            return 0
+        if added:
+            logging.info("Replayed %d journaled posts into %s.",
+                         added, self.store.path)
+        return added
+
+    def commit(self):
+        """Applies every unapplied entry to the board. The caller must
+        hold the commit lock."""
+        generation, start = self.read_head()
+        with fileio.locked(self.path):
+            try:
+                with open(self.path, 'rb') as j:
+                    j.seek(start)
+                    data = j.read()
+                    if self.fsync == "batch":
+                        os.fsync(j.fileno())
+            except FileNotFoundError:
+                return 0
+        end = start + len(data)
+
+        entries = [json.loads(line) for line in data.decode().splitlines()]
+        added = self.store.add_posts(entries)
+
+        with fileio.locked(self.path):
+            if os.path.getsize(self.path) == end:
+                # Everything is applied. The head goes first: a crash in
+                # between only makes the next start replay (and skip) it.
+                self.write_head(generation + 1, 0)
+                os.truncate(self.path, 0)
+            else:
+                self.write_head(generation, end)
+        return added
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+What sshd runs for every login when the sshchan zygote is used (see
+zygote.py): it hands the terminal over to the zygote, which forks a
+session on it, and waits for the session to end. If the zygote isn't
+running, it runs sshchan.py instead.
+
+This runs on every login before anything else, so it imports as little as
+it can; in the sshd_config:
+    ForceCommand 'python3 -S /usr/local/share/sshchan/login.py'
+Arguments are the same as sshchan.py's.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Passed on to the session, see forward().
+FORWARDED_SIGNALS = (signal.SIGINT, signal.SIGQUIT, signal.SIGTERM,
+                     signal.SIGHUP, signal.SIGWINCH)
+
+
+def socket_path(args):
+    """The zygote_socket option, read from the config file the same way
+    config.Config finds it (importing config would cost what we save)."""
+    for path in (args[0] if args else "",
+                 os.getcwd() + "/sshchan.conf",
+                 os.getenv('HOME', default="~") + "/sshchan.conf",
+                 "/etc/sshchan.conf"):
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    settings = json.load(f)
+            except (OSError, ValueError):
+                return None
+            return settings.get(
+                "zygote_socket",
+                settings.get("rootdir", "/srv/sshchan") + "/zygote.sock")
+    return None
+
+
+def run_sshchan(args):
+    """Falls back to starting sshchan the slow way."""
+    script = os.path.join(HERE, "sshchan.py")
+    os.execv(sys.executable, [sys.executable, script] + args)
+
+
+def forward(pid):
+    def handler(signum, frame):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+    for signum in FORWARDED_SIGNALS:
+        signal.signal(signum, handler)
+
+
+def wait(pid):
+    """Waits for a session the zygote can no longer report on."""
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return
+        time.sleep(0.5)
+
+
+def main(args):
+    path = socket_path(args)
+    if path is None:
+        run_sshchan(args)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        request = json.dumps({"env": dict(os.environ)}).encode() + b"\n"
+        socket.send_fds(sock, [request], [0, 1, 2])
+    except OSError:
+        sock.close()
+        run_sshchan(args)
+
+    answers = sock.makefile('rb')
+    line = answers.readline()
+    if not line:
+        # The zygote turned us away.
+        sock.close()
+        run_sshchan(args)
+    pid = json.loads(line.decode())["pid"]
+    forward(pid)
+
+    line = answers.readline()
+    if not line:
+        # The zygote stopped; the session goes on without it.
+        wait(pid)
+        return 0
+    status = json.loads(line.decode())["status"]
+    # Died of a signal: exit the way shells report it.
+    return status if status >= 0 else 128 - status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
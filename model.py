@@ -0,0 +1,79 @@
+"""
+Post and Thread classes used when reading boards.
+
+On disk a thread is a JSON list, [ID, subject, post, post...], and a post
+is [name, timestamp, ID, text]. Posts written by old versions of sshchan
+have no name field: [timestamp, ID, text]. Post.decode() is the only place
+that tells the two apart; everything past it works on Post and Thread
+objects. Both use __slots__, so a big board takes noticeably less memory
+than the nested lists it is read from.
+
+Boards still holding 3 field posts are rewritten once, see
+storage.IndexStore.upgrade().
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+
+class Post():
+
+    __slots__ = ("name", "time", "id", "text")
+
+    def __init__(self, name, time, id, text):
+        self.name = name
+        self.time = time
+        self.id = id
+        self.text = text
+
+    @classmethod
+    def decode(cls, raw):
+        """Builds a Post from its list form, in either structure."""
+        if len(raw) == 3:
+            return cls("Anonymous", raw[0], raw[1], raw[2])
+        return cls(raw[0], raw[1], raw[2], raw[3])
+
+    def encode(self):
+        """Returns the post in its (4 field) list form."""
+        return [self.name, self.time, self.id, self.text]
+
+
+class Thread():
+
+    __slots__ = ("id", "subject", "posts", "omitted")
+
+    def __init__(self, id, subject, posts, omitted=0):
+        self.id = id
+        self.subject = subject
+        # The OP first, then the replies.
+        self.posts = posts
+        # Replies left out of a preview, see preview().
+        self.omitted = omitted
+
+    @classmethod
+    def decode(cls, raw):
+        """Builds a Thread from its list form."""
+        return cls(raw[0], raw[1], [Post.decode(p) for p in raw[2:]])
+
+    def encode(self):
+        return [self.id, self.subject] + [p.encode() for p in self.posts]
+
+    @property
+    def op(self):
+        return self.posts[0]
+
+    @property
+    def replies(self):
+        return self.posts[1:]
+
+    def preview(self, replies):
+        """Returns the thread cut down to the OP and its last replies."""
+        shown = self.posts[1:][-replies:] if replies > 0 else []
+        return Thread(self.id, self.subject, [self.posts[0]] + shown,
+                      self.omitted + len(self.posts) - 1 - len(shown))
+
+    @property
+    def bump(self):
+        """Timestamp of the latest post."""
+        return self.posts[-1].time
@@ -0,0 +1,139 @@
+"""
+Byte offsets of every thread and post in a board's index file.
+
+boards/<name>/offsets is a binary file read through mmap, so the index
+storage can seek straight to the thread or posts it needs instead of
+parsing the whole board. It is rewritten with every index (see
+IndexStore.write_index()):
+
+    header      magic, version, st_ino and st_size of the index it describes,
+                number of threads, number of posts
+    threads     (thread ID, offset, length, first post, posts), bump order
+    by ID       (thread ID, slot in the thread table), sorted by thread ID
+    posts       (post ID, offset, length), thread after thread
+
+Readers check the header against the index file they opened; a table that
+doesn't match (e.g. written by a crashed writer, or a board edited by hand)
+is ignored and the board is read the slow way until the verify command in
+admin.py rebuilds it.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import contextlib
+import mmap
+import os
+import struct
+
+import fileio
+
+MAGIC = b"SCOF"
+VERSION = 1
+HEADER = struct.Struct("<4sIQQII")
+THREAD = struct.Struct("<IQIII")
+BY_ID = struct.Struct("<II")
+POST = struct.Struct("<IQI")
+
+
+class OffsetTable():
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, stat, threads, posts):
+        """Writes the table for the index file with the given stat().
+
+        threads holds (thread ID, offset, length, first post, posts) in
+        bump order, posts (post ID, offset, length)."""
+        by_id = sorted((t[0], slot) for slot, t in enumerate(threads))
+        buf = bytearray(HEADER.size + THREAD.size * len(threads) +
+                        BY_ID.size * len(by_id) + POST.size * len(posts))
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, stat.st_ino, stat.st_size,
+                         len(threads), len(posts))
+        pos = HEADER.size
+        for record, packer in ((threads, THREAD), (by_id, BY_ID),
+                               (posts, POST)):
+            for r in record:
+                packer.pack_into(buf, pos, *r)
+                pos += packer.size
+        # Derived data, so a lost write only costs a rebuild.
+        fileio.atomic_write(self.path, bytes(buf), sync=False)
+
+    @contextlib.contextmanager
+    def mapped(self, index_file):
+        """Gives a Table for the open index_file, or None if there is no
+        table or it describes a different version of the file."""
+        table = self.open(index_file)
+        try:
+            yield table
+        finally:
+            if table is not None:
+                table.close()
+
+    def open(self, index_file):
+        """Like mapped(), but the Table stays mapped until it is closed
+        (or garbage collected)."""
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # Empty file.
+                return None
+        table = Table(m)
+        if table.describes(os.fstat(index_file.fileno())):
+            return table
+        m.close()
+        return None
+
+
+class Table():
+    """Read access to a mapped offset table."""
+
+    def __init__(self, m):
+        self.m = m
+        if len(m) < HEADER.size:
+            self.header = None
+            return
+        self.header = HEADER.unpack_from(m, 0)
+        self.threads = self.header[4]
+        self.posts = self.header[5]
+        self.by_id_start = HEADER.size + THREAD.size * self.threads
+        self.posts_start = self.by_id_start + BY_ID.size * self.threads
+
+    def close(self):
+        self.m.close()
+
+    def describes(self, st):
+        if self.header is None or self.header[:2] != (MAGIC, VERSION):
+            return False
+        return self.header[2:4] == (st.st_ino, st.st_size) and \
+            len(self.m) == self.posts_start + POST.size * self.posts
+
+    def thread(self, slot):
+        """(thread ID, offset, length, first post, posts) of the slot-th
+        thread in bump order."""
+        return THREAD.unpack_from(self.m, HEADER.size + slot * THREAD.size)
+
+    def post(self, n):
+        """(post ID, offset, length) of the n-th post."""
+        return POST.unpack_from(self.m, self.posts_start + n * POST.size)
+
+    def find(self, thread_id):
+        """Returns the slot of a thread, None if it isn't on the board."""
+        lo, hi = 0, self.threads
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found, slot = BY_ID.unpack_from(
+                self.m, self.by_id_start + mid * BY_ID.size)
+            if found == thread_id:
+                return slot
+            if found < thread_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
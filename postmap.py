@@ -0,0 +1,138 @@
+"""
+Persistent post number -> (thread ID, position) map of a board.
+
+The map is a binary file, boards/<name>/postmap, made of fixed-width
+records. Post numbers are handed out one by one, so the record of post
+number n simply sits at byte n * RECORD.size and resolving a post is a
+single read, whatever the size of the board.
+
+    record 0        (covered, 0, 0)
+    record n        (thread ID, position, posts)
+
+covered is the highest post number the map knows about. position is the
+post's place in its thread (0 for the OP) and posts, only kept in the OP's
+record, is the number of posts in the thread. Records of missing or
+deleted posts are all zeros.
+
+Writers hold the fileio lock of the map; readers don't lock.
+
+The map is derived data: if it is missing, or a post newer than covered is
+asked for, it is rebuilt from the board's index.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import struct
+
+import fileio
+
+RECORD = struct.Struct("<III")
+EMPTY = (0, 0, 0)
+
+
+def _post_id(post):
+    if len(post) == 3:
+        return post[1]
+    return post[2]
+
+
+class PostMap():
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, post_no):
+        """Returns the raw record of post_no."""
+        try:
+            with open(self.path, 'rb') as m:
+                m.seek(post_no * RECORD.size)
+                buf = m.read(RECORD.size)
+        except FileNotFoundError:
+            return None
+        if len(buf) < RECORD.size:
+            return EMPTY
+        return RECORD.unpack(buf)
+
+    def covered(self):
+        """Returns the highest post number in the map, None if there's
+        no map at all."""
+        header = self.read(0)
+        if header is None:
+            return None
+        return header[0]
+
+    def lookup(self, post_no):
+        """Returns (thread ID, position) of post_no, or None if there is
+        no such post."""
+        record = self.read(post_no)
+        if record is None or record[0] == 0:
+            return None
+        return record[0], record[1]
+
+    def thread_size(self, thread_id):
+        """Returns the number of posts in a thread, 0 if it is missing."""
+        record = self.read(thread_id)
+        if record is None or record[0] != thread_id:
+            return 0
+        return record[2]
+
+    def count(self):
+        """Returns the number of posts in the map."""
+        try:
+            with open(self.path, 'rb') as m:
+                buf = m.read()
+        except FileNotFoundError:
+            return 0
+        end = len(buf) - len(buf) % RECORD.size
+        return sum(1 for r in RECORD.iter_unpack(buf[RECORD.size:end])
+                   if r[0] != 0)
+
+    def write(self, records):
+        """Writes (post_no, record) pairs into the map."""
+        with open(self.path, 'r+b') as m:
+            for post_no, record in records:
+                m.seek(post_no * RECORD.size)
+                m.write(RECORD.pack(*record))
+
+    def add(self, post_no, thread_id, position):
+        """Adds a new post at the end of its thread."""
+        records = [(post_no, (thread_id, position, 1 if position == 0 else 0))]
+        if position > 0:
+            records.append((thread_id, (thread_id, 0, position + 1)))
+        with fileio.locked(self.path):
+            if post_no > self.covered():
+                records.append((0, (post_no, 0, 0)))
+            self.write(records)
+
+    def remove(self, thread, post_no):
+        """Updates the map after post_no was removed from thread, which is
+        the thread as it was before the removal."""
+        ids = [_post_id(p) for p in thread[2:]]
+        if post_no == thread[0]:
+            records = [(i, EMPTY) for i in ids]
+        else:
+            position = ids.index(post_no)
+            records = [(post_no, EMPTY),
+                       (thread[0], (thread[0], 0, len(ids) - 1))]
+            # Every later post moves one place up.
+            for y in range(position + 1, len(ids)):
+                records.append((ids[y], (thread[0], y - 1, 0)))
+        with fileio.locked(self.path):
+            self.write(records)
+
+    def rebuild(self, index, covered=0):
+        """Writes a fresh map for the board index."""
+        records = {}
+        for thread in index:
+            ids = [_post_id(p) for p in thread[2:]]
+            for y in range(0, len(ids)):
+                records[ids[y]] = (thread[0], y, len(ids) if y == 0 else 0)
+        covered = max([covered] + list(records.keys()))
+
+        buf = bytearray(RECORD.size * (covered + 1))
+        RECORD.pack_into(buf, 0, covered, 0, 0)
+        for post_no, record in records.items():
+            RECORD.pack_into(buf, post_no * RECORD.size, *record)
+        fileio.atomic_write(self.path, buf)
@@ -0,0 +1,137 @@
+"""
+Client side of sshchand, the resident sshchan daemon (see sshchand.py).
+
+With the "daemon" option on, storage.get_store() hands out RemoteStore
+objects instead of opening the board files: they have the interface of the
+storage engines in storage.py, but every call is forwarded to the daemon
+over its Unix socket. If the daemon isn't running, sessions fall back to
+reading the files themselves.
+
+Messages are JSON, one per line. A request is
+    [method, board name, [argument, ...]]
+and the answer is ["ok", result] or ["error", message]. Calls that yield
+(iter_threads) first answer with one ["item", value] per value.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+
+import shared
+import storage
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+# Store methods the daemon answers, see sshchand.Daemon.call().
+FORWARDED = ("exists", "stamp", "create", "upgrade", "destroy", "load",
+             "page", "get_thread", "get_thread_tail", "get_posts_after",
+             "find_thread", "locate", "stamp_paths",
+             "add_post", "remove_post", "remove_threads", "restore_threads",
+             "save", "verify", "compact", "archive", "shared_path")
+STREAMED = ("iter_threads",)
+
+# One connection per socket path and process; a forked child (see
+# zygote.py) opens its own rather than talk over its parent's.
+_connections = {}
+os.register_at_fork(after_in_child=_connections.clear)
+
+
+class DaemonError(Exception):
+    """The daemon failed to carry out a call."""
+
+
+def send(f, message):
+    f.write(json.dumps(message, separators=(',', ':')).encode() + b"\n")
+    f.flush()
+
+
+def receive(f):
+    line = f.readline()
+    if not line:
+        raise ConnectionError("sshchand closed the connection")
+    return json.loads(line.decode())
+
+
+def open_connection(path):
+    """Returns the connection to the daemon listening on path. Raises
+    OSError if there is none."""
+    if path not in _connections:
+        _connections[path] = Connection(path)
+    return _connections[path]
+
+
+class Connection():
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.f = self.sock.makefile('rwb')
+        # One call at a time; urwid callbacks may come from other threads.
+        self.lock = threading.RLock()
+
+    def call(self, method, board, args):
+        with self.lock:
+            send(self.f, [method, board, args])
+            return self.result(receive(self.f))
+
+    def stream(self, method, board, args):
+        with self.lock:
+            send(self.f, [method, board, args])
+            finished = False
+            try:
+                while True:
+                    answer = receive(self.f)
+                    if answer[0] != "item":
+                        finished = True
+                        self.result(answer)
+                        return
+                    yield answer[1]
+            finally:
+                # Left early: drain the rest, so the next call gets its
+                # own answer.
+                while not finished:
+                    finished = receive(self.f)[0] != "item"
+
+    def result(self, answer):
+        if answer[0] == "error":
+            raise DaemonError(answer[1])
+        return answer[1]
+
+
+class RemoteStore():
+    """A board kept by sshchand."""
+
+    # The daemon pages with the board's own engine.
+    paged = True
+
+    def __init__(self, path, config, connection):
+        self.path = path
+        self.config = config
+        self.name = os.path.basename(path)
+        self.connection = connection
+
+    def __getattr__(self, method):
+        if method in FORWARDED:
+            return lambda *args: self.connection.call(method, self.name,
+                                                      list(args))
+        if method in STREAMED:
+            return lambda *args: self.connection.stream(method, self.name,
+                                                        list(args))
+        raise AttributeError(method)
+
+    def shared_index(self):
+        """Maps the board like the engines in storage.py do, from the
+        files the daemon keeps up to date."""
+        path = self.shared_path()
+        if path is None:
+            return None
+        return shared.SharedIndex.open(storage.IndexStore(path))
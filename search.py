@@ -0,0 +1,901 @@
+"""
+Full-text search of the boards.
+
+Every board has an inverted index in boards/<name>/search/: for every
+token (a lowercased word, see tokenize()) the posts it occurs in, with its
+positions in each of them. A query only reads the lists of its own tokens,
+so searching a board with hundreds of thousands of posts takes
+milliseconds instead of a scan of the whole board.
+
+A query is made of words and "quoted phrases", and a post has to contain
+all of them; a phrase also has to appear in that order. The posts found
+are ranked with BM25: rare words count for more than common ones, and a
+word counts for more in a short post than in a long one.
+
+The index consists of read-only segments, search/<n>.idx, listed in
+search/manifest. The index is kept up to date as the board changes, the
+way an LSM tree is (see Board.add_post() and rm_post()):
+
+  - every new post is written to a segment of its own, so posting costs
+    the same however big the index is;
+  - removed posts are listed as deleted in the manifest ("tombstones")
+    and left out of the results;
+  - once FANOUT segments of about the same size have piled up, they are
+    merged into one in a background thread, leaving out the deleted
+    posts, so a board has a few dozen segments at most.
+
+The manifest also records the post numbers the index covers. Posts that
+never made it into the index (say, the session posting them was killed)
+are indexed by the next search, or the whole board again if there are
+more than CATCH_UP of them. The "reindex" command of admin.py rebuilds an
+index from scratch and "verify" checks it against the board.
+
+A segment is laid out as
+
+    header      magic, version, terms, posts, total tokens, offsets
+    postings    per term: post IDs, thread IDs, occurrences, post
+                lengths and positions, each an array of uint32
+    posts       post IDs, thread IDs and lengths of the posts in the
+                segment, sorted by post ID, each an array of uint32
+    dictionary  (term offset, term length, postings offset, posts) per
+                term, sorted by term
+    terms       the terms themselves, UTF-8
+
+and is mapped into memory; a term is found by a binary search of the
+dictionary.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import array
+import bisect
+import collections
+import heapq
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+
+import fileio
+from model import Thread
+import storage
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+MAGIC = b"SCSI"
+VERSION = 2
+# magic, version, terms, posts, total tokens, and the offsets of the
+# posts, the dictionary and the terms
+HEADER = struct.Struct("<4sIIIQQQQ")
+# term offset, term length, postings offset, posts
+ENTRY = struct.Struct("<QIQI")
+
+TOKEN = re.compile(r"\w+")
+# Longer "words" are mostly links and base64, not worth indexing.
+MAX_TOKEN = 40
+
+RESULTS_PER_PAGE = 10
+# Only the best results are kept; nobody pages through more.
+MAX_RESULTS = 1000
+
+# Segments merged at once, and the ratio between the sizes of segments
+# merged at one level and the next.
+FANOUT = 8
+# Unindexed posts a search indexes itself before it rebuilds the index.
+CATCH_UP = 1000
+# Seconds after which a half-written segment (see SearchIndex.part_path())
+# must have been left behind by a process that died.
+STALE_PART = 3600
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+Hit = collections.namedtuple("Hit", ["score", "board", "post", "thread"])
+
+# Open segments: {path: (stat() of the file, Segment)}. A file never
+# changes once written, but a board deleted and created again reuses the
+# names.
+_segments = {}
+# Names of the segments being written by this process.
+_parts = itertools.count()
+
+
+def tokenize(text):
+    """Splits text into lowercase words."""
+    return [t for t in TOKEN.findall(text.lower()) if len(t) <= MAX_TOKEN]
+
+
+def parse_query(query):
+    """Splits a query into phrases, lists of tokens: "quoted text" is one
+    phrase, as is a word with punctuation in it ("foo-bar"), and every
+    other word a phrase of its own."""
+    phrases = []
+    for quoted, word in re.findall(r'"([^"]*)"|(\S+)', query):
+        tokens = tokenize(quoted or word)
+        if tokens:
+            phrases.append(tokens)
+    return phrases
+
+
+def post_tokens(thread, post):
+    """The tokens of a post (model.Post) of thread; the subject counts as
+    part of the OP."""
+    text = post.text
+    if post is thread.posts[0] and thread.subject:
+        text = thread.subject + "\n" + text
+    return tokenize(text)
+
+
+def _uint32(data):
+    a = array.array('I')
+    a.frombytes(data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def _pack(values):
+    a = array.array('I', values)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tobytes()
+
+
+def write_segment(path, posts):
+    """Writes a segment indexing posts, an iterable of
+    (post ID, thread ID, tokens). Returns the number of posts."""
+    # {term: [post IDs, thread IDs, occurrences, lengths, positions]}
+    terms = {}
+    docs = []
+    for post_id, thread_id, tokens in posts:
+        docs.append((post_id, thread_id, len(tokens)))
+        positions = {}
+        for n, token in enumerate(tokens):
+            positions.setdefault(token, []).append(n)
+        for token, where in positions.items():
+            entry = terms.get(token)
+            if entry is None:
+                entry = terms[token] = [[], [], [], [], []]
+            entry[0].append(post_id)
+            entry[1].append(thread_id)
+            entry[2].append(len(where))
+            entry[3].append(len(tokens))
+            entry[4].append(where)
+
+    def columns():
+        for term in sorted(terms, key=lambda t: t.encode()):
+            post_ids, thread_ids, counts, lengths, positions = terms[term]
+            # Posts in post ID order, so lookups can bisect.
+            order = sorted(range(len(post_ids)), key=post_ids.__getitem__)
+            yield (term.encode(),
+                   [post_ids[x] for x in order],
+                   [thread_ids[x] for x in order],
+                   [counts[x] for x in order],
+                   [lengths[x] for x in order],
+                   itertools.chain.from_iterable(
+                       positions[x] for x in order))
+
+    docs.sort()
+    _write(path, columns(), [[d[n] for d in docs] for n in range(3)])
+    return len(docs)
+
+
+def _write(path, terms, docs):
+    """Writes a segment: terms are (term in UTF-8, post IDs, thread IDs,
+    occurrences, lengths, positions) in term order, docs the post IDs,
+    thread IDs and lengths of the posts in post ID order."""
+    body = bytearray(HEADER.size)
+    dictionary = bytearray()
+    names = bytearray()
+    count = 0
+    for name, *values in terms:
+        offset = len(body)
+        for column in values:
+            body += _pack(column)
+        dictionary += ENTRY.pack(len(names), len(name), offset,
+                                 len(values[0]))
+        names += name
+        count += 1
+    docs_offset = len(body)
+    for column in docs:
+        body += _pack(column)
+    dictionary_offset = len(body)
+    body += dictionary
+    body[0:HEADER.size] = HEADER.pack(
+        MAGIC, VERSION, count, len(docs[0]), sum(docs[2]), docs_offset,
+        dictionary_offset, len(body))
+    body += names
+    # path is a part of this writer's own (see SearchIndex.part_path()),
+    # only renamed into place once whole, so it needs no lock.
+    with open(path, 'wb') as f:
+        f.write(body)
+
+
+def merge_segments(path, segments, deleted):
+    """Writes the posts in segments, less the deleted ones, to a new
+    segment at path. A post found in more than one segment is taken from
+    the last. Returns the number of posts written."""
+    owner = {}
+    for n, segment in enumerate(segments):
+        for post_id in segment.docs()[0]:
+            owner[post_id] = n
+    for post_id in deleted:
+        owner.pop(post_id, None)
+    docs = []
+    # Whether all the posts of a segment are kept; their postings are
+    # copied without looking at every one.
+    whole = []
+    for n, segment in enumerate(segments):
+        post_ids, thread_ids, lengths = segment.docs()
+        kept = [x for x, post_id in enumerate(post_ids)
+                if owner.get(post_id) == n]
+        whole.append(len(kept) == len(post_ids))
+        docs.extend((post_ids[x], thread_ids[x], lengths[x]) for x in kept)
+    if not docs:
+        return 0
+    docs.sort()
+
+    def columns():
+        entries = [segment.entries(n) for n, segment in enumerate(segments)]
+        for name, group in itertools.groupby(heapq.merge(*entries),
+                                             key=lambda e: e[0]):
+            parts = []
+            for _, n, offset, count in group:
+                postings = Postings(segments[n].m, offset, count)
+                if whole[n]:
+                    rows = range(count)
+                else:
+                    rows = [x for x, post_id in enumerate(postings.post_ids)
+                            if owner.get(post_id) == n]
+                if rows:
+                    parts.append(postings.select(rows))
+            if parts:
+                yield (name,) + _concatenate(parts)
+
+    _write(path, columns(), [[d[n] for d in docs] for n in range(3)])
+    return len(docs)
+
+
+def _concatenate(parts):
+    """Joins the columns of several postings, as returned by
+    Postings.select(), into one, in post ID order."""
+    if all(a[0][-1] < b[0][0] for a, b in zip(parts, parts[1:])):
+        # The usual case: the segments hold consecutive posts.
+        joined = [array.array('I') for column in range(5)]
+        for part in parts:
+            for column, values in zip(joined, part):
+                column.extend(values)
+        return tuple(joined)
+    rows = sorted((post_id, p, x) for p, part in enumerate(parts)
+                  for x, post_id in enumerate(part[0]))
+    joined = [[], [], [], []]
+    positions = array.array('I')
+    for post_id, p, x in rows:
+        part = parts[p]
+        for column in range(4):
+            joined[column].append(part[column][x])
+        positions.extend(part[4][part[5][x]:part[5][x + 1]])
+    return tuple(joined) + (positions,)
+
+
+class Postings():
+    """The posts one term occurs in, by post ID."""
+
+    def __init__(self, m, offset, count):
+        self.count = count
+        size = 4 * count
+        self.post_ids = _uint32(m[offset:offset + size])
+        self.threads = _uint32(m[offset + size:offset + 2 * size])
+        self.counts = _uint32(m[offset + 2 * size:offset + 3 * size])
+        self.lengths = _uint32(m[offset + 3 * size:offset + 4 * size])
+        self._positions_offset = offset + 4 * size
+        self._m = m
+        self._starts = None
+
+    def find(self, post_id):
+        """Returns the row of post_id, or None."""
+        x = bisect.bisect_left(self.post_ids, post_id)
+        if x < self.count and self.post_ids[x] == post_id:
+            return x
+        return None
+
+    def positions(self, row):
+        self.load_positions()
+        return self._positions[self._starts[row]:self._starts[row + 1]]
+
+    def load_positions(self):
+        if self._starts is None:
+            self._starts = list(itertools.accumulate(
+                itertools.chain([0], self.counts)))
+            total = self._starts[-1]
+            self._positions = _uint32(self._m[
+                self._positions_offset:self._positions_offset + 4 * total])
+
+    def select(self, rows):
+        """Returns the columns of the given rows: post IDs, thread IDs,
+        occurrences, lengths, positions, and where the positions of each
+        row start in them."""
+        self.load_positions()
+        if len(rows) == self.count:
+            return (self.post_ids, self.threads, self.counts, self.lengths,
+                    self._positions, self._starts)
+        positions = array.array('I')
+        for x in rows:
+            positions.extend(self.positions(x))
+        return tuple(array.array('I', (column[x] for x in rows))
+                     for column in (self.post_ids, self.threads,
+                                    self.counts, self.lengths)) + \
+            (positions, list(itertools.accumulate(
+                itertools.chain([0], (self.counts[x] for x in rows)))))
+
+
+class Segment():
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, self.terms, self.posts, self.tokens,
+             self.docs_offset, self.dictionary_offset, self.names_offset) = \
+                HEADER.unpack_from(self.m, 0)
+        except struct.error:
+            magic = version = None
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(path + " is not a search index segment")
+
+    def docs(self):
+        """The post IDs, thread IDs and lengths of the posts in the
+        segment, by post ID."""
+        size = 4 * self.posts
+        start = self.docs_offset
+        return tuple(_uint32(self.m[start + n * size:start + (n + 1) * size])
+                     for n in range(3))
+
+    def entries(self, tag=None):
+        """Yields (term in UTF-8, tag, postings offset, posts) for every
+        term, in term order."""
+        for n in range(self.terms):
+            name_offset, name_length, offset, count = ENTRY.unpack_from(
+                self.m, self.dictionary_offset + n * ENTRY.size)
+            yield (self.m[self.names_offset + name_offset:
+                          self.names_offset + name_offset + name_length],
+                   tag, offset, count)
+
+    def lookup(self, term):
+        """Returns the Postings of term, or None if no post has it."""
+        key = term.encode()
+        lo, hi = 0, self.terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name_offset, name_length, offset, count = ENTRY.unpack_from(
+                self.m, self.dictionary_offset + mid * ENTRY.size)
+            name = self.m[self.names_offset + name_offset:
+                          self.names_offset + name_offset + name_length]
+            if name < key:
+                lo = mid + 1
+            elif name > key:
+                hi = mid
+            else:
+                return Postings(self.m, offset, count)
+        return None
+
+
+def open_segment(path):
+    info = os.stat(path)
+    stat = (info.st_ino, info.st_mtime_ns, info.st_size)
+    cached = _segments.get(path)
+    if cached is None or cached[0] != stat:
+        cached = _segments[path] = (stat, Segment(path))
+    return cached[1]
+
+
+def forget_segments(directory, keep=()):
+    """Closes the open segments in directory but those named in keep."""
+    for path in list(_segments):
+        if os.path.dirname(path) == directory and \
+                os.path.basename(path) not in keep:
+            del _segments[path]
+
+
+def _holds(post_ids, post_id):
+    """Whether post_id is in the sorted array post_ids."""
+    x = bisect.bisect_left(post_ids, post_id)
+    return x < len(post_ids) and post_ids[x] == post_id
+
+
+def level(posts):
+    """The tier of a segment with that many posts: segments on the same
+    level are merged together."""
+    n = 0
+    while posts >= FANOUT:
+        posts //= FANOUT
+        n += 1
+    return n
+
+
+def merge_due(manifest):
+    """The segments of the lowest level that has FANOUT of them, or
+    None."""
+    levels = {}
+    for segment in manifest["segments"]:
+        levels.setdefault(level(segment[1]), []).append(segment)
+    for n in sorted(levels):
+        if len(levels[n]) >= FANOUT:
+            return levels[n]
+    return None
+
+
+def thread_posts(raw):
+    """Yields (post ID, thread ID, tokens) of the posts of a thread in
+    list form."""
+    thread = Thread.decode(raw)
+    for post in thread.posts:
+        yield post.id, thread.id, post_tokens(thread, post)
+
+
+def has_phrase(postings, rows, phrase):
+    """Whether the tokens of phrase follow each other in a post; rows
+    are the post's rows in the postings of each token."""
+    starts = set(postings[phrase[0]].positions(rows[0]))
+    for n, token in enumerate(phrase[1:], 1):
+        following = set(p - n for p in postings[token].positions(rows[n]))
+        starts &= following
+        if not starts:
+            return False
+    return True
+
+
+class SearchIndex():
+    """The inverted index of one board.
+
+    The manifest lists the segments as [file name, posts], and holds the
+    number of the next segment ("next"), the highest post number up to
+    which every post was indexed ("covered"), the posts above it that
+    were ("ahead") and the posts deleted since ("deleted"). It is only
+    changed under its lock; merges and rebuilds also hold the merge lock,
+    so there is one at a time."""
+
+    def __init__(self, store):
+        self.store = store
+        self.path = os.path.join(store.path, "search")
+        self.manifest_path = os.path.join(self.path, "manifest")
+        self.merge_path = os.path.join(self.path, "merge")
+
+    def manifest(self):
+        """The manifest, or None if the index wasn't built yet (or by a
+        version of sshchan that didn't keep it up to date)."""
+        try:
+            with open(self.manifest_path, 'r') as m:
+                manifest = json.load(m)
+        except (FileNotFoundError, ValueError):
+            return None
+        if "covered" not in manifest:
+            return None
+        return manifest
+
+    def empty(self):
+        """The manifest of an index without segments."""
+        number = 1 + max([int(s.split(".")[0])
+                          for s in self.segment_files()] or [0])
+        return {"segments": [], "next": number, "covered": 0, "ahead": [],
+                "deleted": []}
+
+    def segment_files(self):
+        try:
+            return [f for f in os.listdir(self.path) if f.endswith(".idx")]
+        except FileNotFoundError:
+            return []
+
+    def part_path(self):
+        """A path to write a new segment to; it is renamed to <n>.idx once
+        listed in the manifest, see install()."""
+        return os.path.join(self.path, "{0}.{1}.{2}.part".format(
+            os.getpid(), threading.get_ident(), next(_parts)))
+
+    def install(self, manifest, part, posts):
+        """Adds the segment written to part to manifest."""
+        name = "{0}.idx".format(manifest["next"])
+        os.rename(part, os.path.join(self.path, name))
+        manifest["segments"].append([name, posts])
+        manifest["next"] += 1
+
+    def board_posts(self):
+        for raw in self.store.iter_threads():
+            yield from thread_posts(raw)
+
+    def postnum(self):
+        return self.store.config.get_postnum(self.store.name)
+
+    def add(self, posts, covers=None):
+        """Indexes new posts, (post ID, thread ID, tokens) each, in a
+        segment of their own; posts that were deleted are live again.
+        covers are the post numbers to record as indexed, the IDs of the
+        posts by default. Nothing is done if the index wasn't built yet:
+        the first search builds it."""
+        posts = list(posts)
+        if covers is None:
+            covers = [p[0] for p in posts]
+        if not os.path.isdir(self.path):
+            return
+        try:
+            part = None
+            if posts:
+                part = self.part_path()
+                count = write_segment(part, posts)
+            with fileio.locked(self.manifest_path):
+                manifest = self.manifest()
+                if manifest is None:
+                    if part is not None:
+                        os.remove(part)
+                    return
+                if part is not None:
+                    self.install(manifest, part, count)
+                    manifest["deleted"] = sorted(
+                        set(manifest["deleted"]).difference(
+                            p[0] for p in posts))
+                self.cover(manifest, covers)
+                fileio.write_json(self.manifest_path, manifest, sync=False)
+        except OSError:
+            logging.exception("Could not index posts of %s.", self.store.path)
+            return
+        if merge_due(manifest) is not None:
+            threading.Thread(target=self.merge, daemon=True).start()
+
+    def cover(self, manifest, post_ids):
+        """Records post_ids as indexed in manifest."""
+        ahead = set(manifest["ahead"]).union(post_ids)
+        covered = manifest["covered"]
+        while covered + 1 in ahead:
+            covered += 1
+        manifest["covered"] = covered
+        manifest["ahead"] = sorted(p for p in ahead if p > covered)
+
+    def remove(self, post_ids):
+        """Leaves posts removed from the board out of the results from
+        now on."""
+        if not os.path.isdir(self.path):
+            return
+        try:
+            with fileio.locked(self.manifest_path):
+                manifest = self.manifest()
+                if manifest is None:
+                    return
+                manifest["deleted"] = sorted(
+                    set(manifest["deleted"]).union(post_ids))
+                fileio.write_json(self.manifest_path, manifest, sync=False)
+        except OSError:
+            logging.exception("Could not remove posts of %s from its "
+                              "search index.", self.store.path)
+
+    def destroy(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        forget_segments(self.path)
+
+    def catch_up(self, manifest, postnum):
+        """Indexes the posts up to postnum that aren't yet. Posts no
+        longer (or not yet) on the board are skipped; a post being
+        written right now is indexed by its own session."""
+        ahead = set(manifest["ahead"])
+        numbers = range(manifest["covered"] + 1, postnum + 1)
+        threads = {}
+        posts = []
+        for post_no in numbers:
+            if post_no in ahead:
+                continue
+            location = self.store.locate(post_no)
+            if location is None:
+                continue
+            thread_id = location[0]
+            if thread_id not in threads:
+                raw = self.store.get_thread(thread_id)
+                threads[thread_id] = dict(
+                    (p[0], p) for p in thread_posts(raw)) if raw else {}
+            if post_no in threads[thread_id]:
+                posts.append(threads[thread_id][post_no])
+        self.add(posts, covers=numbers)
+        logging.info("Indexed %d posts of %s missing from its search index.",
+                     len(posts), self.store.path)
+
+    def rebuild(self):
+        """Indexes the whole board again. Posts added or removed in the
+        meantime are kept track of as usual, so posting doesn't wait for
+        it."""
+        os.makedirs(self.path, exist_ok=True)
+        with fileio.locked(self.merge_path):
+            before = self.manifest()
+            postnum = self.postnum()
+            part = self.part_path()
+            count = write_segment(part, self.board_posts())
+            with fileio.locked(self.manifest_path):
+                manifest = self.manifest()
+                if manifest is None or before is None:
+                    manifest = self.empty()
+                    kept = []
+                else:
+                    kept = [s for s in manifest["segments"]
+                            if s not in before["segments"]]
+                    # Those were gone before the board was read.
+                    manifest["deleted"] = sorted(
+                        set(manifest["deleted"]) - set(before["deleted"]))
+                manifest["segments"] = kept
+                self.install(manifest, part, count)
+                self.cover(manifest, range(manifest["covered"] + 1,
+                                           postnum + 1))
+                fileio.write_json(self.manifest_path, manifest, sync=False)
+            self.clean(manifest)
+        logging.info("Search index of %s rebuilt.", self.store.path)
+
+    def clean(self, manifest):
+        """Removes the segment files manifest doesn't list, and segments
+        left half-written (with the lock and temporary files older
+        versions wrote next to them). Called under the merge lock."""
+        listed = set(s[0] for s in manifest["segments"])
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if name.endswith(".idx") and name not in listed:
+                    os.remove(path)
+                elif name.endswith((".part", ".part.lock", ".part.tmp")) \
+                        and os.stat(path).st_mtime < time.time() - STALE_PART:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+        forget_segments(self.path, listed)
+
+    def merge(self):
+        """Merges segments of about the same size, FANOUT at a time,
+        until no level has FANOUT of them. Returns False if another
+        merge is running."""
+        try:
+            with fileio.locked(self.merge_path, blocking=False):
+                while True:
+                    manifest = self.manifest()
+                    group = manifest and merge_due(manifest)
+                    if not group:
+                        return True
+                    self.merge_group(manifest, group)
+        except BlockingIOError:
+            return False
+        except (OSError, ValueError):
+            logging.exception("Could not merge the search index of %s.",
+                              self.store.path)
+            return False
+
+    def merge_group(self, manifest, group):
+        deleted = set(manifest["deleted"])
+        segments = [open_segment(os.path.join(self.path, name))
+                    for name, posts in group]
+        # Oldest posts first, so the postings can be joined end to end.
+        segments.sort(key=lambda s: s.docs()[0][0] if s.posts else 0)
+        part = self.part_path()
+        count = merge_segments(part, segments, deleted)
+        # The deleted posts no other segment holds are gone for good.
+        others = [open_segment(os.path.join(self.path, s[0])).docs()[0]
+                  for s in manifest["segments"] if s not in group]
+        gone = set(p for p in deleted
+                   if not any(_holds(docs, p) for docs in others))
+        with fileio.locked(self.manifest_path):
+            manifest = self.manifest()
+            if manifest is None:
+                os.remove(part)
+                return
+            manifest["segments"] = [s for s in manifest["segments"]
+                                    if s not in group]
+            manifest["deleted"] = sorted(set(manifest["deleted"]) - gone)
+            if count:
+                self.install(manifest, part, count)
+            else:
+                os.remove(part)
+            fileio.write_json(self.manifest_path, manifest, sync=False)
+        for name, posts in group:
+            os.remove(os.path.join(self.path, name))
+        forget_segments(self.path, set(s[0] for s in manifest["segments"]))
+        logging.info("Merged %d segments of the search index of %s.",
+                     len(group), self.store.path)
+
+    def current(self):
+        """The manifest of the index, built or caught up with the board
+        first if needed."""
+        manifest = self.manifest()
+        if manifest is None:
+            self.rebuild()
+            manifest = self.manifest()
+        postnum = self.postnum()
+        if postnum > manifest["covered"]:
+            if postnum - manifest["covered"] - len(manifest["ahead"]) > \
+                    CATCH_UP:
+                self.rebuild()
+            else:
+                self.catch_up(manifest, postnum)
+            manifest = self.manifest()
+        return manifest
+
+    def segments(self):
+        """The segments of the index, brought up to date, and the IDs of
+        the posts deleted from them."""
+        for attempt in range(3):
+            manifest = self.current()
+            names = [s[0] for s in manifest["segments"]]
+            try:
+                segments = [open_segment(os.path.join(self.path, name))
+                            for name in names]
+            except FileNotFoundError:
+                # Merged by another session in between.
+                continue
+            except ValueError:
+                logging.exception("Broken search index of %s.",
+                                  self.store.path)
+                self.rebuild()
+                continue
+            forget_segments(self.path, names)
+            return segments, set(manifest["deleted"])
+        raise RuntimeError("search index of {0} keeps changing".format(
+            self.store.path))
+
+    def verify(self):
+        """Checks that the index holds exactly the posts on the board and
+        rebuilds it if not. Returns True if it was rebuilt."""
+        try:
+            segments, deleted = self.segments()
+            indexed = set()
+            for segment in segments:
+                indexed.update(segment.docs()[0])
+            indexed -= deleted
+        except (OSError, ValueError, RuntimeError):
+            logging.exception("Broken search index of %s.", self.store.path)
+            indexed = None
+        live = set()
+        for raw in self.store.iter_threads():
+            live.update(post.id for post in Thread.decode(raw).posts)
+        if indexed == live:
+            return False
+        self.rebuild()
+        return True
+
+    def search(self, query, board=""):
+        """Returns (hits, total): the best MAX_RESULTS Hits of query on the
+        board, best first, and the number of posts found."""
+        phrases = parse_query(query)
+        if not phrases:
+            return [], 0
+        terms = set(itertools.chain.from_iterable(phrases))
+        segments, deleted = self.segments()
+        posts = sum(s.posts for s in segments)
+        if posts == 0:
+            return [], 0
+        average = sum(s.tokens for s in segments) / posts
+
+        best, total = [], 0
+        looked_up = [{t: s.lookup(t) for t in terms} for s in segments]
+        frequency = {t: sum(p[t].count for p in looked_up if p[t])
+                     for t in terms}
+        idf = {t: math.log(1 + (posts - frequency[t] + 0.5) /
+                           (frequency[t] + 0.5)) for t in terms}
+        for postings in looked_up:
+            if not all(postings.values()):
+                continue
+            found = list(self.score(postings, phrases, idf, average, board))
+            if deleted or len(segments) > 1:
+                # Left out: removed posts, and those also found in a segment
+                # searched before (see catch_up()).
+                found = [h for h in found if h.post not in deleted]
+                deleted.update(h.post for h in found)
+            total += len(found)
+            # Best first, newest first among equals.
+            best = heapq.nlargest(MAX_RESULTS, best + found)
+        return best, total
+
+    def score(self, postings, phrases, idf, average, board):
+        """Yields the Hits in one segment."""
+        terms = sorted(postings, key=lambda t: postings[t].count)
+        rarest = postings[terms[0]]
+        if len(terms) == 1 and all(len(p) == 1 for p in phrases):
+            # One word: every post it's in is a hit.
+            weight = idf[terms[0]]
+            for post_id, thread_id, count, length in zip(
+                    rarest.post_ids, rarest.threads, rarest.counts,
+                    rarest.lengths):
+                yield Hit(weight * count * (K1 + 1) / (
+                    count + K1 * (1 - B + B * length / average)),
+                    board, post_id, thread_id)
+            return
+
+        # The other terms' rows of a post: bisect their postings if the
+        # rarest term is much rarer, otherwise map them out once.
+        others = []
+        for term in terms[1:]:
+            other = postings[term]
+            if rarest.count * 16 < other.count:
+                others.append((term, other.find))
+            else:
+                others.append((term, dict(zip(
+                    other.post_ids, range(other.count))).get))
+        phrases = [phrase for phrase in phrases if len(phrase) > 1]
+        for row, post_id in enumerate(rarest.post_ids):
+            rows = {terms[0]: row}
+            for term, find in others:
+                rows[term] = find(post_id)
+                if rows[term] is None:
+                    break
+            else:
+                if phrases and not all(
+                        has_phrase(postings, [rows[t] for t in phrase],
+                                   phrase) for phrase in phrases):
+                    continue
+                norm = K1 * (1 - B + B * rarest.lengths[row] / average)
+                score = 0.0
+                for term in terms:
+                    count = postings[term].counts[rows[term]]
+                    score += idf[term] * count * (K1 + 1) / (count + norm)
+                yield Hit(score, board, post_id, rarest.threads[row])
+
+
+def search_boards(config, query, names):
+    """Searches the boards called names. Returns (hits, total) like
+    SearchIndex.search()."""
+    best, total = [], 0
+    for name in names:
+        store = storage.get_store(
+            os.path.join(config.root, "boards", name), config)
+        if store.exists():
+            hits, found = SearchIndex(store).search(query, name)
+            best = heapq.nlargest(MAX_RESULTS, best + hits)
+            total += found
+    return best, total
+
+
+def results_page(hits, page, per_page=RESULTS_PER_PAGE):
+    """Returns (hits, pages): the hits on page number page, counting from
+    1, and the number of pages."""
+    pages = max(1, math.ceil(len(hits) / per_page))
+    start = (page - 1) * per_page
+    return hits[start:start + per_page], pages
+
+
+def find_post(config, hit):
+    """Returns the thread (model.Thread) and post (model.Post) a Hit
+    points to, or (None, None) if it's gone since."""
+    store = storage.get_store(
+        os.path.join(config.root, "boards", hit.board), config)
+    raw = store.get_thread(hit.thread)
+    if raw is None:
+        return None, None
+    thread = Thread.decode(raw)
+    for post in thread.posts:
+        if post.id == hit.post:
+            return thread, post
+    return None, None
+
+
+def snippet(text, query, width=70):
+    """Returns the part of text around the first word of query found in
+    it, at most about width characters long."""
+    text = " ".join(text.split())
+    lowered = text.lower()
+    at = -1
+    for phrase in parse_query(query):
+        match = re.search(r"\b" + re.escape(phrase[0]), lowered)
+        if match is not None:
+            at = match.start()
+            break
+    start = max(0, at - width // 3) if at >= 0 else 0
+    part = text[start:start + width]
+    if start > 0:
+        part = "..." + part
+    if start + width < len(text):
+        part += "..."
+    return part
@@ -0,0 +1,106 @@
+"""
+Memory-mapped board data shared by every sshchan session on a host.
+
+Each ssh user runs a process of their own. Instead of every one of them
+parsing its own copy of a board, the index file and its offset table (see
+offsets.py) are mapped read-only: the pages are held once in the OS page
+cache however many sessions read the board, and a thread is only parsed
+when a session looks at it. SharedIndex presents such a mapping as a
+read-only sequence of model.Thread objects, most recently bumped first.
+
+The log and sharded storage's files can't be mapped that way, so for the
+whole board (Board.get_index()) they publish a View, boards/<name>/view/,
+in the index format. The view is versioned by the stamp of the board it
+was built from (boards/<name>/view/version): the first session to find it
+behind the board rebuilds it, every other session only maps the new file.
+Pages and single threads never go through the view; they are read from
+the board's own files (see LogStore and ShardStore), so a post doesn't
+cost the next reader a rewrite of the board.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import collections.abc
+import json
+import logging
+import mmap
+import os
+
+import fileio
+from model import Thread
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+
+class SharedIndex(collections.abc.Sequence):
+
+    def __init__(self, m, table):
+        self.m = m
+        self.table = table
+
+    @classmethod
+    def open(cls, store):
+        """Maps the index of an IndexStore. Returns None if it has no up
+        to date offset table."""
+        with open(store.index_path, 'rb') as i:
+            table = store.offsets.open(i)
+            if table is None:
+                return None
+            return cls(mmap.mmap(i.fileno(), 0, access=mmap.ACCESS_READ),
+                       table)
+
+    def __len__(self):
+        return self.table.threads
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self[x] for x in range(*n.indices(len(self)))]
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError("thread index out of range")
+        _, offset, length, _, _ = self.table.thread(n)
+        return Thread.decode(json.loads(self.m[offset:offset + length]))
+
+    def close(self):
+        self.table.close()
+        self.m.close()
+
+
+class View():
+    """A copy of a board in the index format, rebuilt whenever the board
+    changes."""
+
+    def __init__(self, store, view_store):
+        # view_store is an IndexStore on boards/<name>/view.
+        self.store = store
+        self.view_store = view_store
+        self.version_path = os.path.join(view_store.path, "version")
+
+    def version(self):
+        try:
+            with open(self.version_path, 'r') as v:
+                return v.read()
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        """Brings the view up to date with the board and returns its
+        store."""
+        stamp = json.dumps(self.store.stamp())
+        if self.version() == stamp:
+            return self.view_store
+        os.makedirs(self.view_store.path, exist_ok=True)
+        with fileio.locked(self.version_path):
+            # Taken before reading, so a post in between leaves the view
+            # behind rather than marked current.
+            stamp = json.dumps(self.store.stamp())
+            if self.version() != stamp:
+                self.view_store.write_index(self.store.load())
+                fileio.atomic_write(self.version_path, stamp, sync=False)
+        return self.view_store
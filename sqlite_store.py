@@ -0,0 +1,527 @@
+"""
+SQLite storage engine for sshchan.
+
+All boards live in a single SQLite database (sqlite_path in sshchan.conf)
+running in WAL mode, so readers in other ssh sessions never block a
+writer. The database also replaces the boardlist and postnums files: the
+Config class reads and writes those through the Database class when
+storage is set to "sqlite".
+
+Run this file directly to copy an existing JSON layout into the database:
+    python3 sqlite_store.py [path to sshchan.conf]
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+# Threads bumped in the same second are ordered by seq, most recently
+# bumped first like the file engines do (see storage.insert_bumped());
+# boards.bumps hands it out.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS boards (
+    name TEXT PRIMARY KEY,
+    desc TEXT NOT NULL DEFAULT '',
+    postnum INTEGER NOT NULL DEFAULT 0,
+    bumps INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS threads (
+    board TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    bump INTEGER NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (board, id)
+);
+CREATE INDEX IF NOT EXISTS threads_order ON threads (board, bump, seq);
+CREATE TABLE IF NOT EXISTS posts (
+    board TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    thread INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (board, id)
+);
+CREATE INDEX IF NOT EXISTS posts_thread ON posts (board, thread, id);
+"""
+
+# One connection per database file and thread (sqlite3 connections can't
+# be shared between threads, which sshchand has one of per session).
+_local = threading.local()
+# Connections inherited by a forked child (see zygote.py). The child
+# mustn't use them, nor close them under its parent, so they are only kept.
+_inherited = []
+
+
+def _forget_connections():
+    _inherited.append(_local.__dict__.pop("databases", None))
+
+
+os.register_at_fork(after_in_child=_forget_connections)
+
+
+def connect(path):
+    """Returns the (shared) Database object for the file at path."""
+    databases = _local.__dict__.setdefault("databases", {})
+    if path not in databases:
+        databases[path] = Database(path)
+    return databases[path]
+
+
+class Database():
+    """Thin wrapper around the sqlite3 connection."""
+
+    def __init__(self, path):
+        self.path = path
+        # Number of write transactions committed through this connection.
+        self.writes = 0
+        # Transactions are managed by hand, see transaction().
+        self.conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def transaction(self, write=False):
+        """Context manager running the block in one transaction.
+
+        Write transactions take the database write lock straight away
+        (BEGIN IMMEDIATE) so read-modify-write sequences can't race."""
+        return _Transaction(self, write)
+
+    def stamp(self):
+        """Changes whenever the database may have changed: data_version
+        moves on commits by other connections, writes on our own."""
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        return (version, self.writes)
+
+    def get_boardlist(self):
+        rows = self.conn.execute("SELECT name, desc FROM boards")
+        return dict(rows.fetchall())
+
+    def set_boardlist(self, values):
+        with self.transaction(write=True) as db:
+            current = dict(db.execute("SELECT name, desc FROM boards"))
+            for name in current:
+                if name not in values:
+                    db.execute("DELETE FROM boards WHERE name = ?", (name,))
+            for name, desc in values.items():
+                if name not in current:
+                    db.execute("INSERT INTO boards (name, desc) VALUES (?, ?)",
+                               (name, desc))
+                elif current[name] != desc:
+                    db.execute("UPDATE boards SET desc = ? WHERE name = ?",
+                               (desc, name))
+        return True
+
+    def get_postnums(self):
+        rows = self.conn.execute("SELECT name, postnum FROM boards")
+        return dict(rows.fetchall())
+
+    def get_postnum(self, name):
+        row = self.conn.execute(
+            "SELECT postnum FROM boards WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def set_postnums(self, values):
+        with self.transaction(write=True) as db:
+            for name, postnum in values.items():
+                db.execute("UPDATE boards SET postnum = ? WHERE name = ?",
+                           (postnum, name))
+        return True
+
+    def reserve_postnums(self, name, count=1):
+        """Reserves count post numbers on board name, returns the first."""
+        with self.transaction(write=True) as db:
+            row = db.execute("SELECT postnum FROM boards WHERE name = ?",
+                             (name,)).fetchone()
+            db.execute("UPDATE boards SET postnum = ? WHERE name = ?",
+                       (row[0] + count, name))
+        return row[0] + 1
+
+
+class _Transaction():
+
+    def __init__(self, db, write):
+        self.db = db
+        self.conn = db.conn
+        self.write = write
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE" if self.write else "BEGIN")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+            if self.write:
+                self.db.writes += 1
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
+
+
+class SQLiteStore():
+    """Board storage backed by the SQLite database."""
+
+    paged = True
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.name = os.path.basename(path)
+
+    @property
+    def db(self):
+        # Looked up on every use: sshchand calls one store from many threads.
+        return connect(self.config.sqlite_path)
+
+    def exists(self):
+        row = self.db.conn.execute(
+            "SELECT 1 FROM boards WHERE name = ?", (self.name,)).fetchone()
+        return row is not None
+
+    def stamp(self):
+        """Changes whenever a board in the database may have changed."""
+        return self.db.stamp()
+
+    def stamp_paths(self):
+        """Files written to when the database changes, to watch (see
+        watch.py); stamp() doesn't look at them."""
+        path = self.config.sqlite_path
+        return [path, path + "-wal"]
+
+    def create(self):
+        # The board row itself is added with the boardlist.
+        return True
+
+    def upgrade(self):
+        # Posts are normalized on the way in, see normalize().
+        return 0
+
+    def destroy(self):
+        with self.db.transaction(write=True) as db:
+            db.execute("DELETE FROM posts WHERE board = ?", (self.name,))
+            db.execute("DELETE FROM threads WHERE board = ?", (self.name,))
+        # Only the archive (see archive.py) lives there.
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+    def load(self):
+        threads = {}
+        index = []
+        with self.db.transaction() as db:
+            for thread_id, subject in db.execute(
+                    "SELECT id, subject FROM threads WHERE board = ? "
+                    "ORDER BY bump DESC, seq DESC", (self.name,)):
+                thread = [thread_id, subject]
+                threads[thread_id] = thread
+                index.append(thread)
+            for thread_id, name, stamp, post_no, text in db.execute(
+                    "SELECT thread, name, time, id, text FROM posts "
+                    "WHERE board = ? ORDER BY id", (self.name,)):
+                threads[thread_id].append([name, stamp, post_no, text])
+        return index
+
+    def page(self, start, count):
+        if start < 0:
+            raise ValueError("negative start {0}".format(start))
+        threads = {}
+        page = []
+        with self.db.transaction() as db:
+            total = db.execute("SELECT COUNT(*) FROM threads WHERE board = ?",
+                               (self.name,)).fetchone()[0]
+            for thread_id, subject in db.execute(
+                    "SELECT id, subject FROM threads WHERE board = ? "
+                    "ORDER BY bump DESC, seq DESC LIMIT ? OFFSET ?",
+                    (self.name, count, start)):
+                thread = [thread_id, subject]
+                threads[thread_id] = thread
+                page.append(thread)
+            if page:
+                marks = ",".join("?" * len(threads))
+                for thread_id, name, stamp, post_no, text in db.execute(
+                        "SELECT thread, name, time, id, text FROM posts "
+                        "WHERE board = ? AND thread IN (" + marks + ") "
+                        "ORDER BY id", [self.name] + list(threads)):
+                    threads[thread_id].append([name, stamp, post_no, text])
+        return page, total
+
+    def shared_index(self):
+        # SQLite has its own page cache; see shared.py for the others.
+        return None
+
+    def iter_threads(self):
+        """Yields the threads one at a time, most recently bumped first."""
+        rows = self.db.conn.execute(
+            "SELECT id FROM threads WHERE board = ? ORDER BY bump DESC, seq DESC",
+            (self.name,)).fetchall()
+        for row in rows:
+            thread = self.get_thread(row[0])
+            # Skip threads deleted since the scan started.
+            if thread is not None:
+                yield thread
+
+    def save(self, index):
+        with self.db.transaction(write=True) as db:
+            db.execute("DELETE FROM posts WHERE board = ?", (self.name,))
+            db.execute("DELETE FROM threads WHERE board = ?", (self.name,))
+            # Below every sequence number handed out later, and in the
+            # order of index.
+            for n, thread in enumerate(index):
+                self.insert_thread(db, thread, seq=-n)
+        return True
+
+    def next_seq(self, db):
+        """Hands out the bump sequence number of a thread bumped now."""
+        db.execute("UPDATE boards SET bumps = bumps + 1 WHERE name = ?",
+                   (self.name,))
+        row = db.execute("SELECT bumps FROM boards WHERE name = ?",
+                         (self.name,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def insert_thread(self, db, thread, seq=None):
+        """Inserts a whole thread in list form. Without seq it goes in
+        front of the threads bumped in the same second."""
+        posts = [self.normalize(p) for p in thread[2:]]
+        if seq is None:
+            seq = self.next_seq(db)
+        db.execute("INSERT INTO threads (board, id, subject, bump, seq) "
+                   "VALUES (?, ?, ?, ?, ?)",
+                   (self.name, thread[0], thread[1], posts[-1][1], seq))
+        for post in posts:
+            db.execute("INSERT INTO posts (board, id, thread, name, time, "
+                       "text) VALUES (?, ?, ?, ?, ?, ?)",
+                       (self.name, post[2], thread[0], post[0], post[1],
+                        post[3]))
+
+    def normalize(self, post):
+        """Turns an old (3 field) post into the new 4 field structure."""
+        if len(post) == 3:
+            return ["Anonymous"] + post
+        return post
+
+    def add_post(self, post_text, name, subject, thread_id, timestamp):
+        """Allocates the post number and stores the post in one
+        transaction. Returns the post number, or False if the board or
+        thread is missing."""
+        with self.db.transaction(write=True) as db:
+            row = db.execute("SELECT postnum FROM boards WHERE name = ?",
+                             (self.name,)).fetchone()
+            if row is None:
+                return False
+            post_no = row[0] + 1
+            seq = self.next_seq(db)
+            if thread_id == -1:
+                db.execute("INSERT INTO threads (board, id, subject, bump, "
+                           "seq) VALUES (?, ?, ?, ?, ?)",
+                           (self.name, post_no, subject, timestamp, seq))
+                thread_id = post_no
+            else:
+                updated = db.execute(
+                    "UPDATE threads SET bump = ?, seq = ? "
+                    "WHERE board = ? AND id = ?",
+                    (timestamp, seq, self.name, thread_id)).rowcount
+                if updated == 0:
+                    return False
+            db.execute("INSERT INTO posts (board, id, thread, name, time, "
+                       "text) VALUES (?, ?, ?, ?, ?, ?)",
+                       (self.name, post_no, thread_id, name, timestamp,
+                        post_text))
+            db.execute("UPDATE boards SET postnum = ? WHERE name = ?",
+                       (post_no, self.name))
+        return post_no
+
+    def get_thread(self, thread_id):
+        with self.db.transaction() as db:
+            return self.read_thread(db, thread_id)
+
+    def read_thread(self, db, thread_id):
+        """Reads a thread inside the transaction db."""
+        row = db.execute(
+            "SELECT id, subject FROM threads WHERE board = ? AND id = ?",
+            (self.name, thread_id)).fetchone()
+        if row is None:
+            return None
+        thread = list(row)
+        for post in db.execute(
+                "SELECT name, time, id, text FROM posts WHERE board = ? "
+                "AND thread = ? ORDER BY id", (self.name, thread_id)):
+            thread.append(list(post))
+        return thread
+
+    def remove_threads(self, threads):
+        removed = []
+        with self.db.transaction(write=True) as db:
+            for thread in threads:
+                if self.read_thread(db, thread[0]) != thread:
+                    continue
+                db.execute("DELETE FROM posts WHERE board = ? AND thread = ?",
+                           (self.name, thread[0]))
+                db.execute("DELETE FROM threads WHERE board = ? AND id = ?",
+                           (self.name, thread[0]))
+                removed.append(thread[0])
+        return removed
+
+    def restore_threads(self, threads):
+        restored = []
+        with self.db.transaction(write=True) as db:
+            for thread in threads:
+                if self.read_thread(db, thread[0]) is None:
+                    self.insert_thread(db, thread)
+                    restored.append(thread[0])
+        return restored
+
+    def get_thread_tail(self, thread_id, replies):
+        """Returns (thread, omitted) with only the OP and the last replies
+        replies read, see IndexStore.get_thread_tail()."""
+        with self.db.transaction() as db:
+            row = db.execute(
+                "SELECT id, subject FROM threads WHERE board = ? AND id = ?",
+                (self.name, thread_id)).fetchone()
+            if row is None:
+                return None, 0
+            thread = list(row)
+            total = db.execute(
+                "SELECT COUNT(*) FROM posts WHERE board = ? AND thread = ?",
+                (self.name, thread_id)).fetchone()[0]
+            shown = min(max(replies, 0), total - 1)
+            op = list(db.execute(
+                "SELECT name, time, id, text FROM posts WHERE board = ? "
+                "AND thread = ? ORDER BY id LIMIT 1",
+                (self.name, thread_id)).fetchone())
+            thread.append(op)
+            tail = db.execute(
+                "SELECT name, time, id, text FROM posts WHERE board = ? "
+                "AND thread = ? AND id != ? ORDER BY id DESC LIMIT ?",
+                (self.name, thread_id, op[2], shown)).fetchall()
+            thread.extend(list(post) for post in reversed(tail))
+        return thread, total - 1 - shown
+
+    def get_posts_after(self, thread_id, post_no):
+        """Returns the posts of a thread numbered above post_no, see
+        IndexStore.get_posts_after()."""
+        with self.db.transaction() as db:
+            row = db.execute(
+                "SELECT 1 FROM threads WHERE board = ? AND id = ?",
+                (self.name, thread_id)).fetchone()
+            if row is None:
+                return None
+            return [list(post) for post in db.execute(
+                "SELECT name, time, id, text FROM posts WHERE board = ? "
+                "AND thread = ? AND id > ? ORDER BY id",
+                (self.name, thread_id, post_no))]
+
+    def verify(self):
+        """Runs SQLite's own consistency check and rebuilds the indexes if
+        it fails. Returns the names of the rebuilt parts."""
+        rows = self.db.conn.execute("PRAGMA quick_check").fetchall()
+        if rows == [("ok",)]:
+            return []
+        logging.error("quick_check of %s: %s", self.db.path,
+                      "; ".join(r[0] for r in rows))
+        with self.db.transaction(write=True) as db:
+            db.execute("REINDEX")
+        return ["database indexes"]
+
+    def find_thread(self, post_no):
+        row = self.db.conn.execute(
+            "SELECT thread FROM posts WHERE board = ? AND id = ?",
+            (self.name, post_no)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def locate(self, post_no):
+        """Returns (thread ID, position in thread) of post_no, or None."""
+        thread_id = self.find_thread(post_no)
+        if thread_id is None:
+            return None
+        row = self.db.conn.execute(
+            "SELECT COUNT(*) FROM posts WHERE board = ? AND thread = ? "
+            "AND id < ?", (self.name, thread_id, post_no)).fetchone()
+        return thread_id, row[0]
+
+    def remove_post(self, post_no):
+        with self.db.transaction(write=True) as db:
+            row = db.execute(
+                "SELECT thread FROM posts WHERE board = ? AND id = ?",
+                (self.name, post_no)).fetchone()
+            if row is None:
+                return False
+            thread_id = row[0]
+            if thread_id == post_no:
+                db.execute("DELETE FROM posts WHERE board = ? AND thread = ?",
+                           (self.name, thread_id))
+                db.execute("DELETE FROM threads WHERE board = ? AND id = ?",
+                           (self.name, thread_id))
+            else:
+                db.execute("DELETE FROM posts WHERE board = ? AND id = ?",
+                           (self.name, post_no))
+                # Moved like storage.rebump() does.
+                db.execute(
+                    "UPDATE threads SET bump = (SELECT MAX(time) FROM posts "
+                    "WHERE board = ? AND thread = ?), seq = ? "
+                    "WHERE board = ? AND id = ?",
+                    (self.name, thread_id, self.next_seq(db), self.name,
+                     thread_id))
+        return True
+
+
+def migrate(config):
+    """Copies boards from the JSON files (boardlist, post counters and
+    every board's index and log, or thread files) into the SQLite
+    database."""
+    # Imported here because storage.py imports this module.
+    import storage
+
+    with open(config.boardlist_path, 'r') as b:
+        boardlist = json.load(b)
+    postnums = config.counters.read_all(boardlist.keys())
+
+    db = connect(config.sqlite_path)
+    for name, desc in sorted(boardlist.items()):
+        path = os.path.join(config.root, "boards", name)
+        old = storage.file_store(path, config)
+        new = SQLiteStore(path, config)
+        count = 0
+        with db.transaction(write=True) as conn:
+            conn.execute("INSERT OR REPLACE INTO boards (name, desc, postnum) "
+                         "VALUES (?, ?, ?)",
+                         (name, desc, postnums.get(name, 0)))
+            conn.execute("DELETE FROM posts WHERE board = ?", (name,))
+            conn.execute("DELETE FROM threads WHERE board = ?", (name,))
+            # One thread at a time, big boards don't fit in memory twice.
+            # They come most recently bumped first, see save().
+            for thread in (old.iter_threads() if old.exists() else []):
+                new.insert_thread(conn, thread, seq=-count)
+                count += 1
+        logging.info("Migrated board /%s/ (%d threads) to SQLite.",
+                     name, count)
+    return sorted(boardlist.keys())
+
+
+if __name__ == "__main__":
+    import config
+
+    if len(sys.argv) > 1:
+        cfg = config.Config(sys.argv[1])
+    else:
+        cfg = config.Config()
+    for board in migrate(cfg):
+        print("Migrated /" + board + "/")
+    print("Set \"storage\" to \"sqlite\" in " + cfg.path + " to use the "
+          "database.")
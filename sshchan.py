@@ -31,17 +31,21 @@ logging.basicConfig(
     format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
     level=logging.DEBUG)
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        if os.path.exists(sys.argv[1]):
-            cfg = config.Config(sys.argv[1])
+
+def get_config(args):
+    """Loads the config file given on the command line, if any."""
+    if len(args) > 0:
+        if os.path.exists(args[0]):
+            return config.Config(args[0])
         else:
             # Change it so it at least tries to read default path/values first.
             print("Invalid configuration file path.")
-            cfg = config.Config()
-    else:
-        cfg = config.Config()
+    return config.Config()
+
 
+def main(cfg):
+    """Runs one session on the terminal at stdin/stdout (see also
+    zygote.py, which calls this in every session it forks)."""
     board = Board(config=cfg)
     c = config.Colors() # terminal colors object
     marker = Marker()
@@ -55,3 +59,7 @@ if __name__ == "__main__":
     else:
         screen = display.Display(cfg, board)
         screen.run()
+
+
+if __name__ == "__main__":
+    main(get_config(sys.argv[1:]))
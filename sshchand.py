@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+"""
+sshchand, the resident sshchan daemon.
+
+Without it, every login starts a fresh Python process that opens the boards
+it reads on its own. sshchand keeps the storage engines of all boards open
+in one long-running process: writes from every session meet in one place,
+where the per-board journals (see journal.py) batch them, whole-board reads
+are parsed once for everybody, and sessions only talk to it over a Unix
+socket (see remote.py for the protocol).
+
+Start it as the user owning the boards, then turn the "daemon" option on:
+    python3 sshchand.py [config path]
+sshchan.py and admin.py then reach the boards through it, and read the
+files themselves again whenever it isn't running. While it runs it also
+answers
+    python3 sshchand.py [config path] status
+    python3 sshchand.py [config path] stop
+and the admin.py commands that work on boards (compact, verify, archive,
+restore, rm...) go through it like everything else.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import json
+import logging
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+import archive
+import config
+import journal
+import remote
+import storage
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+
+class Daemon():
+
+    def __init__(self, cfg):
+        self.config = cfg
+        self.started = time.time()
+        self.requests = 0
+        self.sessions = 0
+        # {board name: (store, journal or None)}
+        self.boards = {}
+        # Parsed boards: {board name: (store stamp, threads)}.
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def board(self, name):
+        with self.lock:
+            if name not in self.boards:
+                path = os.path.join(self.config.root, "boards", name)
+                store = storage.get_store(path, self.config, local=True)
+                self.boards[name] = (store, None)
+                if store.exists():
+                    store.upgrade()
+                    self.boards[name] = (
+                        store, journal.open_journal(store, self.config))
+            return self.boards[name]
+
+    def forget(self, name):
+        with self.lock:
+            self.boards.pop(name, None)
+            self.loaded.pop(name, None)
+
+    def load(self, name, store):
+        """The threads of a board, parsed once per version for every
+        session."""
+        stamp = store.stamp()
+        loaded = self.loaded.get(name)
+        if loaded is None or loaded[0] != stamp:
+            loaded = (stamp, store.load())
+            self.loaded[name] = loaded
+        return loaded[1]
+
+    def call(self, method, name, args):
+        """Carries out one request, see remote.py."""
+        self.requests += 1
+        if name is None:
+            return self.command(method, args)
+        store, board_journal = self.board(name)
+
+        if method == "add_post" and board_journal is not None:
+            return board_journal.add_post(*args)
+        if method in ("create", "destroy"):
+            # Opened again next time, with a journal if it exists now.
+            result = getattr(store, method)(*args)
+            self.forget(name)
+            return result
+        if method == "load":
+            return self.load(name, store)
+        if method == "compact":
+            return isinstance(store, storage.LogStore) and store.compact()
+        if method == "archive":
+            return archive.archive_board(store, self.config)
+        if method == "shared_path":
+            return self.shared_path(store)
+        if method in remote.FORWARDED:
+            return getattr(store, method)(*args)
+        raise ValueError("unknown method " + method)
+
+    def stream(self, method, name, args):
+        store = self.board(name)[0]
+        if method == "iter_threads":
+            return iter(self.load(name, store))
+        raise ValueError("unknown method " + method)
+
+    def shared_path(self, store):
+        """The directory whose index file sessions can map, or None."""
+        view = getattr(store, "view", None)
+        if view is not None:
+            return view.refresh().path
+        if getattr(store, "offsets", None) is not None:
+            return store.path
+        return None
+
+    def command(self, method, args):
+        """Commands that aren't about one board."""
+        if method == "status":
+            return {"pid": os.getpid(),
+                    "uptime": int(time.time() - self.started),
+                    "requests": self.requests,
+                    "sessions": self.sessions,
+                    "boards": sorted(self.boards)}
+        if method == "stop":
+            # shutdown() waits for serve_forever(), which runs elsewhere.
+            threading.Thread(target=self.server.shutdown).start()
+            return True
+        raise ValueError("unknown command " + method)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """One session."""
+
+    def handle(self):
+        daemon = self.server.daemon
+        daemon.sessions += 1
+        try:
+            for line in self.rfile:
+                method, name, args = json.loads(line.decode())
+                try:
+                    if method in remote.STREAMED:
+                        for item in daemon.stream(method, name, args):
+                            remote.send(self.wfile, ["item", item])
+                        result = None
+                    else:
+                        result = daemon.call(method, name, args)
+                    answer = ["ok", result]
+                except Exception as e:
+                    logging.exception("sshchand: %s on /%s/ failed.",
+                                      method, name)
+                    answer = ["error", str(e)]
+                remote.send(self.wfile, answer)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            daemon.sessions -= 1
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(cfg):
+    path = cfg.daemon_socket
+    if os.path.exists(path):
+        try:
+            remote.Connection(path)
+            print("sshchand is already running at " + path)
+            return 1
+        except OSError:
+            os.remove(path) # Left behind by a crash.
+
+    # Replay whatever sessions left in the journals before going up.
+    journal.replay_all(cfg)
+    daemon = Daemon(cfg)
+    server = Server(path, Handler)
+    server.daemon = daemon
+    daemon.server = server
+    signal.signal(signal.SIGTERM, lambda *a: daemon.command("stop", []))
+    logging.info("sshchand listening on %s.", path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+        logging.info("sshchand stopped after %d requests.", daemon.requests)
+    return 0
+
+
+def control(cfg, command):
+    try:
+        connection = remote.Connection(cfg.daemon_socket)
+    except OSError:
+        print("sshchand isn't running.")
+        return 1
+    try:
+        result = connection.call(command, None, [])
+    except ConnectionError:
+        # A stopping daemon may hang up before it answers.
+        if command != "stop":
+            raise
+        return 0
+    if command == "status":
+        for key in sorted(result):
+            print(key.ljust(10) + str(result[key]))
+    return 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    command = None
+    if args and args[-1] in ("status", "stop"):
+        command = args.pop()
+    cfg = config.Config(args[0] if args else "", reload_on_hup=True)
+    if command is None:
+        sys.exit(serve(cfg))
+    sys.exit(control(cfg, command))
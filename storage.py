@@ -0,0 +1,1252 @@
+"""
+Storage engines used by the Board class to keep a board's threads on disk.
+
+IndexStore is the classic layout: the whole board lives in
+boards/<name>/index as one JSON list that is rewritten on every post.
+LogStore keeps that file as a snapshot and appends every new thread, reply
+or deletion as one line to boards/<name>/log, so posting costs the same no
+matter how big the board is. Compaction folds the log back into the
+snapshot. ShardStore gives every thread its own file, boards/<name>/threads/<id>,
+plus a small manifest with the bump order, so viewing or replying to a
+thread only touches that thread.
+
+Every engine keeps the threads in bump order (most recently bumped first)
+as it writes them, so readers never sort; see insert_bumped().
+
+The index file is a JSON list with one thread per line, so iter_threads()
+can hand out one thread at a time and a scan over a board runs in
+constant memory.
+
+The file engines keep a PostMap (see postmap.py) next to the board data so
+a post number can be resolved to its thread without reading the board.
+IndexStore also keeps an OffsetTable (see offsets.py) with the position of
+every thread and post in the index file, so single threads, pages and the
+last replies of a thread are read without parsing the rest.
+
+Every file is replaced through fileio.atomic_write(), so readers never
+lock. Read-modify-write cycles hold the fileio writer lock of the file
+they change.
+
+The engine is picked with the "storage" option in sshchan.conf; the SQLite
+engine lives in sqlite_store.py.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import contextlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+
+import fileio
+import remote
+import shared
+import sqlite_store
+from model import Post
+from offsets import OffsetTable
+from postmap import PostMap
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+# Version of the on-disk layout, kept in boards/<name>/schema. Boards
+# without that file may still hold old 3 field posts, boards before
+# version 3 aren't in bump order and before version 4 the index isn't
+# line-delimited; see upgrade().
+SCHEMA = 4
+
+# Log records this process has read, keyed by log path:
+# {path: (st_ino, first line, bytes read, records)}. See
+# LogStore.read_log().
+_logs = {}
+
+
+def post_id(post):
+    """Returns the post number of a post in either the old (3 field) or
+    the new (4 field) JSON structure."""
+    if len(post) == 3:
+        return post[1]
+    return post[2]
+
+
+def post_time(post):
+    """Returns the timestamp of a post in either JSON structure."""
+    if len(post) == 3:
+        return post[0]
+    return post[1]
+
+
+def thread_bump(thread):
+    """Returns the bump time of a thread in list form."""
+    return post_time(thread[-1])
+
+
+def posts_after(thread, post_no):
+    """The posts of a thread in list form numbered above post_no."""
+    return [p for p in thread[2:] if post_id(p) > post_no]
+
+
+def insert_bumped(threads, thread, key=thread_bump):
+    """Inserts thread into threads, which is in bump order, in its place.
+
+    A binary search over key(), so O(log n) comparisons; a thread bumped
+    now goes in front of threads bumped in the same second."""
+    bump = key(thread)
+    lo, hi = 0, len(threads)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key(threads[mid]) > bump:
+            lo = mid + 1
+        else:
+            hi = mid
+    threads.insert(lo, thread)
+
+
+def rebump(threads, thread):
+    """Moves thread, which changed, to its new place in threads."""
+    threads.remove(thread)
+    insert_bumped(threads, thread)
+
+
+def cut_thread(thread, replies):
+    """Cuts a thread in list form down to its OP and last replies
+    replies. Returns (thread, number of replies left out)."""
+    shown = thread[3:][-replies:] if replies > 0 else []
+    return thread[:3] + shown, len(thread) - 3 - len(shown)
+
+
+class IndexStore():
+    """Whole-board storage in a single JSON index file."""
+
+    # Whether page() reads less than the whole board. If not, the Board
+    # class pages through its cached index instead.
+    paged = True
+
+    def __init__(self, path, config=None):
+        self.path = path
+        self.config = config
+        self.name = os.path.basename(path)
+        self.index_path = os.path.join(path, "index")
+        self.schema_path = os.path.join(path, "schema")
+        # Writers of the board hold the fileio lock of this file.
+        self.writer_path = self.index_path
+        self.postmap = PostMap(os.path.join(path, "postmap"))
+        self.offsets = OffsetTable(os.path.join(path, "offsets"))
+
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    def stamp_paths(self):
+        """Files whose change means the board has changed."""
+        return [self.index_path]
+
+    def stamp(self):
+        """Returns a cheap fingerprint of the board's current state, made
+        of (st_mtime_ns, st_size, st_ino) of each file in stamp_paths()."""
+        stamp = []
+        for p in self.stamp_paths():
+            try:
+                st = os.stat(p)
+                stamp.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def create(self):
+        """Creates an empty board."""
+        self.save([])
+        fileio.atomic_write(self.schema_path, str(SCHEMA))
+
+    def schema(self):
+        """Returns the layout version of the board on disk."""
+        try:
+            with open(self.schema_path, 'r') as s:
+                return int(s.read())
+        except FileNotFoundError:
+            return 1
+
+    def upgrade(self):
+        """Brings a board written by an older sshchan up to date once:
+        rewrites posts still in the old 3 field structure into the current
+        one, puts the threads in bump order and writes the index one thread
+        per line. Afterwards the schema file
+        marks the board as up to date. Returns the number of posts
+        rewritten."""
+        if not self.exists() or self.schema() >= SCHEMA:
+            return 0
+        with fileio.locked(self.writer_path):
+            index = self.load()
+            old = sum(1 for t in index for p in t[2:] if len(p) == 3)
+            index = [t[:2] + [Post.decode(p).encode() for p in t[2:]]
+                     for t in index]
+            index.sort(key=thread_bump, reverse=True)
+            self.save(index)
+            fileio.atomic_write(self.schema_path, str(SCHEMA))
+        logging.info("Upgraded %d old posts in %s.", old, self.path)
+        return old
+
+    def destroy(self):
+        """Removes every file belonging to the board."""
+        shutil.rmtree(self.path)
+
+    def load(self):
+        """Returns the list of threads, most recently bumped first."""
+        with open(self.index_path, 'r') as i:
+            return json.load(i)
+
+    def iter_threads(self):
+        """Yields the threads one at a time, most recently bumped first,
+        without reading the whole board into memory."""
+        with open(self.index_path, 'r') as i:
+            yield from self.read_threads(i)
+
+    def read_threads(self, index_file):
+        """Yields the threads of an open index file, see write_index()."""
+        if self.schema() < 4:
+            # Written pretty-printed by an older sshchan.
+            yield from json.load(index_file)
+            return
+        for line in index_file:
+            line = line.rstrip(",\n")
+            if line not in ("[", "]"):
+                yield json.loads(line)
+
+    def write_index(self, index):
+        """Writes the index as a JSON list with one thread per line:
+            [
+            [1,"subject",["name",1445000000,1,"text"]],
+            ...
+            ]
+        and the offset table describing it. JSON output is plain ASCII, so
+        string lengths are byte lengths."""
+        parts = ["[\n"]
+        pos = 2
+        threads = []
+        posts = []
+        for n in range(0, len(index)):
+            thread = index[n]
+            line = "[" + json.dumps(thread[0]) + "," + json.dumps(thread[1])
+            first = len(posts)
+            for post in thread[2:]:
+                encoded = json.dumps(post, separators=(',', ':'))
+                posts.append((post_id(post), pos + len(line) + 1,
+                              len(encoded)))
+                line += "," + encoded
+            line += "]"
+            threads.append((thread[0], pos, len(line), first,
+                            len(thread) - 2))
+            line += ",\n" if n < len(index) - 1 else "\n"
+            parts.append(line)
+            pos += len(line)
+        parts.append("]\n")
+        fileio.atomic_write(self.index_path, "".join(parts))
+        if self.offsets is not None:
+            self.offsets.write(os.stat(self.index_path), threads, posts)
+        return True
+
+    @contextlib.contextmanager
+    def mapped(self):
+        """Gives (open index file, offset table or None), see offsets.py."""
+        with open(self.index_path, 'rb') as i:
+            if self.offsets is None:
+                yield i, None
+                return
+            with self.offsets.mapped(i) as table:
+                yield i, table
+
+    def read_span(self, index_file, offset, length):
+        """Parses length bytes of the index file starting at offset."""
+        index_file.seek(offset)
+        return json.loads(index_file.read(length).decode())
+
+    def save(self, index):
+        """Replaces the whole board with index, which must be in bump
+        order."""
+        with fileio.locked(self.index_path):
+            self.write_index(index)
+            self.postmap.rebuild(index, self.allocated())
+        return True
+
+    def allocated(self):
+        """Returns the highest post number handed out on this board."""
+        if self.config is None:
+            return 0
+        return self.config.get_postnum(self.name)
+
+    def locate(self, post_no):
+        """Returns (thread ID, position in thread) of post_no, or None."""
+        def stale():
+            covered = self.postmap.covered()
+            return covered is None or covered < post_no <= self.allocated()
+        if stale():
+            # The map is missing or lags behind the board.
+            self.rebuild_postmap(stale)
+        return self.postmap.lookup(post_no)
+
+    def stored(self, post_no):
+        """Whether post_no is on the board. Unlike locate(), a post number
+        the post map hasn't seen yet counts as missing without reading
+        the board."""
+        missing = lambda: self.postmap.covered() is None
+        if missing():
+            self.rebuild_postmap(missing)
+        return self.postmap.lookup(post_no) is not None
+
+    def rebuild_postmap(self, stale):
+        """Rebuilds the post map from the board under the writer lock, so
+        no post is stored and mapped between reading the board and
+        writing the map. stale() is asked again once the lock is held:
+        someone else may have rebuilt the map in the meantime."""
+        with fileio.locked(self.writer_path):
+            if stale():
+                self.postmap.rebuild(self.load(), self.allocated())
+
+    def map_post(self, post_no, thread_id, position):
+        """Records a freshly stored post in the post map."""
+        with fileio.locked(self.writer_path):
+            if self.postmap.covered() is None:
+                self.postmap.rebuild(self.load(), self.allocated())
+            else:
+                self.postmap.add(post_no, thread_id, position)
+
+    def add_post(self, post_text, name, subject, thread_id, timestamp):
+        """Stores a new thread (thread_id == -1) or a reply under the next
+        post number of the board. Returns the post number, or False if
+        the post couldn't be stored."""
+        if thread_id != -1 and self.find_thread(thread_id) != thread_id:
+            return False
+        post_no = self.config.reserve_postnums(self.name)
+        post = [name, timestamp, post_no, post_text]
+
+        if thread_id == -1:
+            added = self.add_thread([post_no, subject, post])
+        else:
+            added = self.add_reply(thread_id, post)
+        return post_no if added else False
+
+    def add_posts(self, entries):
+        """Stores a batch of journaled posts, [thread ID, subject, post]
+        each (see journal.py), with a single write. Posts already on the
+        board, or replying to a missing thread, are skipped. Returns the
+        number of posts added."""
+        with fileio.locked(self.index_path):
+            index = self.load()
+            threads = {}
+            have = set()
+            for thread in index:
+                threads[thread[0]] = thread
+                have.update(post_id(p) for p in thread[2:])
+            added = []
+            for thread_id, subject, post in entries:
+                if post_id(post) in have:
+                    continue
+                if thread_id == post_id(post):
+                    threads[thread_id] = [thread_id, subject, post]
+                    insert_bumped(index, threads[thread_id])
+                elif thread_id in threads:
+                    threads[thread_id].append(post)
+                    rebump(index, threads[thread_id])
+                else:
+                    continue
+                have.add(post_id(post))
+                added.append((post_id(post), thread_id,
+                              len(threads[thread_id]) - 3))
+            if added:
+                self.write_index(index)
+                for post_no, thread_id, position in added:
+                    self.map_post(post_no, thread_id, position)
+        return len(added)
+
+    def page(self, start, count):
+        """Returns (threads, total): count threads in bump order starting
+        at the start-th one, and the number of threads on the board."""
+        if start < 0:
+            raise ValueError("negative start {0}".format(start))
+        if self.offsets is not None:
+            with self.mapped() as (i, table):
+                if table is not None:
+                    threads = []
+                    for slot in range(start, min(start + count, table.threads)):
+                        t = table.thread(slot)
+                        threads.append(self.read_span(i, t[1], t[2]))
+                    return threads, table.threads
+        index = self.load()
+        return index[start:start + count], len(index)
+
+    def get_thread(self, thread_id):
+        """Returns a single thread, or None if there is no such thread."""
+        if self.offsets is not None:
+            with self.mapped() as (i, table):
+                if table is not None:
+                    slot = table.find(thread_id)
+                    if slot is None:
+                        return None
+                    t = table.thread(slot)
+                    return self.read_span(i, t[1], t[2])
+        for thread in self.iter_threads():
+            if thread[0] == thread_id:
+                return thread
+        return None
+
+    def shared_index(self):
+        """Returns the board as a shared.SharedIndex, mapped rather than
+        read, or None if this engine can't be mapped."""
+        if self.offsets is None:
+            return None
+        return shared.SharedIndex.open(self)
+
+    def get_thread_tail(self, thread_id, replies):
+        """Returns (thread, omitted): a thread cut down to its OP and last
+        replies replies, and the number of replies left out; (None, 0) if
+        there is no such thread. With an up to date offset table only
+        those posts are read."""
+        if self.offsets is not None:
+            with self.mapped() as (i, table):
+                if table is not None:
+                    slot = table.find(thread_id)
+                    if slot is None:
+                        return None, 0
+                    _, offset, length, first, count = table.thread(slot)
+                    # [ID,"subject" comes right before the OP.
+                    i.seek(offset)
+                    head = i.read(table.post(first)[1] - offset - 1)
+                    thread = json.loads(head.decode() + "]")
+                    shown = min(max(replies, 0), count - 1)
+                    for n in [first] + list(range(first + count - shown,
+                                                  first + count)):
+                        post = table.post(n)
+                        thread.append(self.read_span(i, post[1], post[2]))
+                    return thread, count - 1 - shown
+        thread = self.get_thread(thread_id)
+        if thread is None:
+            return None, 0
+        return cut_thread(thread, replies)
+
+    def get_posts_after(self, thread_id, post_no):
+        """Returns the posts of a thread numbered above post_no, oldest
+        first, or None if there is no such thread. With an up to date
+        offset table only those posts are read."""
+        if self.offsets is not None:
+            with self.mapped() as (i, table):
+                if table is not None:
+                    slot = table.find(thread_id)
+                    if slot is None:
+                        return None
+                    _, _, _, first, count = table.thread(slot)
+                    # Replies are appended, so a thread is in post number
+                    # order: walk back from its last post.
+                    n = first + count
+                    while n > first and table.post(n - 1)[0] > post_no:
+                        n -= 1
+                    return [self.read_span(i, *table.post(m)[1:])
+                            for m in range(n, first + count)]
+        thread = self.get_thread(thread_id)
+        if thread is None:
+            return None
+        return posts_after(thread, post_no)
+
+    def verify(self):
+        """Checks the files derived from the board's data (offset table,
+        post map) and rebuilds the ones that are off. Returns the names of
+        the rebuilt ones."""
+        rebuilt = []
+        with fileio.locked(self.writer_path):
+            index = self.load()
+            snapshot = self.snapshot(index)
+            if self.offsets is not None and not self.offsets_match(snapshot):
+                # Rewriting the index writes a fresh table for it.
+                self.write_index(snapshot)
+                rebuilt.append("offset table")
+            if not self.postmap_matches(index):
+                self.postmap.rebuild(index, self.allocated())
+                rebuilt.append("post map")
+        if rebuilt:
+            logging.warning("Rebuilt %s of %s.", ", ".join(rebuilt), self.path)
+        return rebuilt
+
+    def snapshot(self, index):
+        """Returns the threads in the index file, which the offset table
+        describes. Here that is the whole board, index, as loaded."""
+        return index
+
+    def offsets_match(self, index):
+        with self.mapped() as (i, table):
+            if table is None or table.threads != len(index):
+                return False
+            n = 0
+            for slot in range(0, len(index)):
+                thread = index[slot]
+                t = table.thread(slot)
+                if t[0] != thread[0] or t[3] != n or t[4] != len(thread) - 2 \
+                        or table.find(thread[0]) != slot:
+                    return False
+                for post in thread[2:]:
+                    p = table.post(n)
+                    if p[0] != post_id(post):
+                        return False
+                    try:
+                        if self.read_span(i, p[1], p[2]) != post:
+                            return False
+                    except ValueError: # Not even a whole post.
+                        return False
+                    n += 1
+            return n == table.posts
+
+    def postmap_matches(self, index):
+        if self.postmap.covered() is None:
+            return False
+        for thread in index:
+            if self.postmap.thread_size(thread[0]) != len(thread) - 2:
+                return False
+            for y in range(2, len(thread)):
+                if self.postmap.lookup(post_id(thread[y])) != (thread[0], y - 2):
+                    return False
+        return self.postmap.count() == sum(len(t) - 2 for t in index)
+
+    def find_thread(self, post_no):
+        """Returns the ID of the thread containing post_no, or None."""
+        location = self.locate(post_no)
+        if location is None:
+            return None
+        return location[0]
+
+    def add_thread(self, thread):
+        with fileio.locked(self.index_path):
+            index = self.load()
+            insert_bumped(index, thread)
+            self.write_index(index)
+            self.map_post(thread[0], thread[0], 0)
+        return True
+
+    def add_reply(self, thread_id, post):
+        with fileio.locked(self.index_path):
+            index = self.load()
+            for thread in index:
+                if thread[0] == thread_id:
+                    thread.append(post)
+                    rebump(index, thread)
+                    self.write_index(index)
+                    self.map_post(post_id(post), thread_id, len(thread) - 3)
+                    return True
+        return False
+
+    def remove_threads(self, threads):
+        """Removes whole threads, given in list form, in one write. Threads
+        that changed since they were read are left alone. Returns the IDs
+        of the removed threads."""
+        gone = dict((t[0], t) for t in threads)
+        with fileio.locked(self.index_path):
+            index = self.load()
+            removed = [t[0] for t in index if gone.get(t[0]) == t]
+            if removed:
+                self.save([t for t in index if gone.get(t[0]) != t])
+        return removed
+
+    def restore_threads(self, threads):
+        """Puts threads in list form back on the board, in their place in
+        the bump order. Threads already on the board are skipped. Returns
+        the IDs of the restored threads."""
+        with fileio.locked(self.index_path):
+            index = self.load()
+            live = set(t[0] for t in index)
+            restored = [t for t in threads if t[0] not in live]
+            for thread in restored:
+                insert_bumped(index, thread)
+            if restored:
+                self.save(index)
+        return [t[0] for t in restored]
+
+    def remove_post(self, post_no):
+        """Removes a post; removing the OP removes the whole thread."""
+        with fileio.locked(self.index_path):
+            index = self.load()
+            for x in range(0, len(index)):
+                thread = index[x]
+                for y in range(2, len(thread)):
+                    if post_id(thread[y]) == post_no:
+                        before = list(thread)
+                        if y == 2:
+                            del index[x]
+                        else:
+                            del thread[y]
+                            # The thread may have lost its latest post.
+                            rebump(index, thread)
+                        self.write_index(index)
+                        self.postmap.remove(before, post_no)
+                        return True
+        return False
+
+
+class LogStore(IndexStore):
+    """Append-only storage.
+
+    Every write is one JSON record on its own line in boards/<name>/log:
+        ["T", [thread_id, subject, op]]   a new thread
+        ["R", thread_id, post]            a reply
+        ["D", post_no, thread_id]         a deletion
+    boards/<name>/index is only a snapshot. Readers load the snapshot and
+    replay the log on top of it. Replay is idempotent, so records that
+    already made it into the snapshot are skipped. Deletions written by
+    older versions lack the thread ID.
+
+    The snapshot has an offset table like the index engine's, so single
+    threads and pages are read from the threads the log touched plus the
+    ones they need from the snapshot, instead of the whole board.
+
+    Compaction first rotates the log to log.old (new appends go to a fresh
+    log), then writes a new snapshot and finally drops log.old. A reader
+    that raced with it notices that the snapshot was replaced and reads
+    again.
+    """
+
+    def __init__(self, path, config=None):
+        super(LogStore, self).__init__(path, config)
+        self.log_path = os.path.join(path, "log")
+        self.old_log_path = os.path.join(path, "log.old")
+        self.writer_path = self.log_path
+        # The offset table describes the snapshot alone, so the methods of
+        # IndexStore that read the board through it are overridden. The
+        # whole board is only shared through a view, see shared.py.
+        self.view = shared.View(self, IndexStore(os.path.join(path, "view")))
+        # Only one compaction at a time; see compact().
+        self.compact_path = os.path.join(path, "compact")
+        self.compact_bytes = 1048576
+        if config is not None:
+            self.compact_bytes = int(config.get_cfg_opt(
+                "log_compact_bytes", self.compact_bytes))
+
+    def stamp_paths(self):
+        return [self.index_path, self.old_log_path, self.log_path]
+
+    def page(self, start, count):
+        """Merges the threads the log changed into the bump order of the
+        snapshot. Of the snapshot threads before the page only the last
+        post is read, for its bump time."""
+        if start < 0:
+            raise ValueError("negative start {0}".format(start))
+        while True:
+            with self.mapped() as (i, table):
+                records = self.records_on(i)
+                if records is None:
+                    continue
+                ids = self.changed_threads(records)
+                if table is None or ids is None:
+                    break
+                slots = sorted(s for s in map(table.find, ids) if s is not None)
+                changed = self.replay(
+                    [self.read_span(i, *table.thread(s)[1:3]) for s in slots],
+                    records)
+                skip = set(slots)
+
+                def rest():
+                    for slot in range(0, table.threads):
+                        if slot not in skip:
+                            _, _, _, first, posts = table.thread(slot)
+                            last = table.post(first + posts - 1)
+                            yield post_time(self.read_span(i, *last[1:])), slot
+                merged = heapq.merge(((thread_bump(t), t) for t in changed),
+                                     rest(), key=lambda e: e[0], reverse=True)
+                threads = []
+                for _, thread in itertools.islice(merged, start, start + count):
+                    if not isinstance(thread, list):
+                        thread = self.read_span(i, *table.thread(thread)[1:3])
+                    threads.append(thread)
+                return threads, table.threads - len(skip) + len(changed)
+        # No offset table (yet), or deletions without their thread.
+        index = self.load()
+        return index[start:start + count], len(index)
+
+    def get_thread(self, thread_id):
+        """Reads the thread from the snapshot and replays the log on
+        it."""
+        while True:
+            with self.mapped() as (i, table):
+                records = self.records_on(i)
+                if records is None:
+                    continue
+                if table is None:
+                    break
+                slot = table.find(thread_id)
+                threads = [] if slot is None else \
+                    [self.read_span(i, *table.thread(slot)[1:3])]
+            for thread in self.replay(threads, records):
+                if thread[0] == thread_id:
+                    return thread
+            return None
+        for thread in self.iter_threads():
+            if thread[0] == thread_id:
+                return thread
+        return None
+
+    def get_thread_tail(self, thread_id, replies):
+        thread = self.get_thread(thread_id)
+        if thread is None:
+            return None, 0
+        return cut_thread(thread, replies)
+
+    def get_posts_after(self, thread_id, post_no):
+        thread = self.get_thread(thread_id)
+        if thread is None:
+            return None
+        return posts_after(thread, post_no)
+
+    def shared_index(self):
+        return self.view.refresh().shared_index()
+
+    def snapshot(self, index=None):
+        """Returns the threads in the snapshot, without the log."""
+        return super(LogStore, self).load()
+
+    def verify(self):
+        # The snapshot is only replaced under the compaction lock.
+        with fileio.locked(self.compact_path):
+            return super(LogStore, self).verify()
+
+    def records_on(self, index_file):
+        """Returns the log records on top of the snapshot open as
+        index_file, or None if the snapshot was compacted meanwhile and
+        has to be opened again."""
+        records = self.read_log(self.old_log_path) + \
+            self.read_log(self.log_path)
+        if os.stat(self.index_path).st_ino != os.fstat(index_file.fileno()).st_ino:
+            return None
+        return records
+
+    def changed_threads(self, records):
+        """Returns the IDs of the threads records change, or None if
+        there is a deletion that doesn't say its thread."""
+        ids = set()
+        for record in records:
+            if record[0] == "T":
+                ids.add(record[1][0])
+            elif record[0] == "R":
+                ids.add(record[1])
+            elif len(record) > 2:
+                ids.add(record[2])
+            else:
+                return None
+        return ids
+
+    def read_log(self, path):
+        """Returns the records stored in the log file at path.
+
+        The log is only appended to, so the records read before are kept
+        (see _logs) and only the lines written since are parsed. Don't
+        change the records, they are shared."""
+        try:
+            l = open(path, 'rb')
+        except FileNotFoundError:
+            _logs.pop(path, None)
+            return []
+        with l:
+            ino = os.fstat(l.fileno()).st_ino
+            cached_ino, head, offset, records = \
+                _logs.get(path, (None, b"", 0, []))
+            # A new log can get the inode of a removed one back; its first
+            # line tells them apart.
+            if cached_ino != ino or l.read(len(head)) != head:
+                head, offset, records = b"", 0, []
+            l.seek(offset)
+            data = l.read()
+        # A half-written last line means a writer is still busy with it;
+        # it will be picked up next time.
+        end = data.rfind(b"\n") + 1
+        if end:
+            records = records + [json.loads(line) for line in
+                                 data[:end].decode().splitlines()]
+            if not head:
+                head = data[:data.find(b"\n") + 1]
+        _logs[path] = (ino, head, offset + end, records)
+        return list(records)
+
+    def replay(self, index, records):
+        """Applies log records on top of the snapshot index, keeping it in
+        bump order."""
+        threads = {}
+        owner = {}
+        for thread in index:
+            threads[thread[0]] = thread
+            for post in thread[2:]:
+                owner[post_id(post)] = thread[0]
+
+        for record in records:
+            if record[0] == "T":
+                # A copy, the records are shared (see read_log()).
+                thread = list(record[1])
+                if thread[0] not in threads:
+                    insert_bumped(index, thread)
+                    threads[thread[0]] = thread
+                    # Restored threads come with their replies.
+                    for post in thread[2:]:
+                        owner[post_id(post)] = thread[0]
+            elif record[0] == "R":
+                post = record[2]
+                thread = threads.get(record[1])
+                if thread is not None and post_id(post) not in owner:
+                    thread.append(post)
+                    rebump(index, thread)
+                    owner[post_id(post)] = record[1]
+            elif record[0] == "D":
+                thread_id = owner.pop(record[1], None)
+                if thread_id is None:
+                    continue
+                thread = threads[thread_id]
+                if thread_id == record[1]:
+                    index.remove(thread)
+                    del threads[thread_id]
+                    for post in thread[3:]:
+                        owner.pop(post_id(post), None)
+                else:
+                    for y in range(3, len(thread)):
+                        if post_id(thread[y]) == record[1]:
+                            del thread[y]
+                            break
+                    rebump(index, thread)
+        return index
+
+    def load(self):
+        while True:
+            before = os.stat(self.index_path).st_ino
+            index = super(LogStore, self).load()
+            records = self.read_log(self.old_log_path) + \
+                self.read_log(self.log_path)
+            if os.stat(self.index_path).st_ino == before:
+                return self.replay(index, records)
+
+    def iter_threads(self):
+        """Streams the snapshot and merges in the threads the log changed.
+
+        Only those threads are held in memory: a first pass over the
+        snapshot picks them out and the log is replayed on them, a second
+        pass yields the untouched threads around them in bump order."""
+        while True:
+            with open(self.index_path, 'r') as i:
+                records = self.read_log(self.old_log_path) + \
+                    self.read_log(self.log_path)
+                if os.stat(self.index_path).st_ino != os.fstat(i.fileno()).st_ino:
+                    # Compacted meanwhile, the records may be gone.
+                    continue
+                if not records:
+                    yield from self.read_threads(i)
+                    return
+
+                touched = set()
+                deleted = set()
+                for record in records:
+                    if record[0] == "T":
+                        touched.add(record[1][0])
+                    elif record[0] == "R":
+                        touched.add(record[1])
+                    else:
+                        deleted.add(record[1])
+                changed = [t for t in self.read_threads(i)
+                           if t[0] in touched or
+                           any(post_id(p) in deleted for p in t[2:])]
+                skip = set(t[0] for t in changed)
+                changed = self.replay(changed, records)
+                skip.update(t[0] for t in changed)
+
+                i.seek(0)
+                rest = (t for t in self.read_threads(i) if t[0] not in skip)
+                yield from heapq.merge(changed, rest, key=thread_bump,
+                                       reverse=True)
+                return
+
+    def append(self, *records):
+        """Appends records to the log in a single write."""
+        lines = "".join(json.dumps(record, separators=(',', ':')) + "\n"
+                        for record in records)
+        with fileio.locked(self.log_path):
+            with open(self.log_path, 'a') as l:
+                l.write(lines)
+                size = l.tell()
+        if size >= self.compact_bytes:
+            threading.Thread(target=self.compact, daemon=True).start()
+        return True
+
+    def add_thread(self, thread):
+        with fileio.locked(self.log_path):
+            self.append(["T", thread])
+            self.map_post(thread[0], thread[0], 0)
+        return True
+
+    def add_reply(self, thread_id, post):
+        with fileio.locked(self.log_path):
+            # The post map tells whether the thread exists and how long
+            # it is without replaying the log.
+            if self.locate(thread_id) != (thread_id, 0):
+                return False
+            position = self.postmap.thread_size(thread_id)
+            self.append(["R", thread_id, post])
+            self.map_post(post_id(post), thread_id, position)
+        return True
+
+    def add_posts(self, entries):
+        with fileio.locked(self.log_path):
+            records = []
+            added = []
+            # Thread sizes, including posts of this batch.
+            sizes = {}
+            for thread_id, subject, post in entries:
+                if self.stored(post_id(post)):
+                    continue
+                if thread_id == post_id(post):
+                    records.append(["T", [thread_id, subject, post]])
+                    sizes[thread_id] = 0
+                else:
+                    if thread_id not in sizes:
+                        sizes[thread_id] = self.postmap.thread_size(thread_id)
+                    if sizes[thread_id] == 0:
+                        continue
+                    records.append(["R", thread_id, post])
+                added.append((post_id(post), thread_id, sizes[thread_id]))
+                sizes[thread_id] += 1
+            if records:
+                self.append(*records)
+                for post_no, thread_id, position in added:
+                    self.map_post(post_no, thread_id, position)
+        return len(added)
+
+    def remove_post(self, post_no):
+        with fileio.locked(self.log_path):
+            location = self.locate(post_no)
+            if location is None:
+                return False
+            for thread in self.load():
+                if thread[0] == location[0]:
+                    self.append(["D", post_no, location[0]])
+                    self.postmap.remove(thread, post_no)
+                    return True
+        return False
+
+    def remove_threads(self, threads):
+        gone = dict((t[0], t) for t in threads)
+        with fileio.locked(self.log_path):
+            removed = [t for t in self.load() if gone.get(t[0]) == t]
+            if removed:
+                self.append(*[["D", t[0], t[0]] for t in removed])
+                for thread in removed:
+                    self.postmap.remove(thread, thread[0])
+        return [t[0] for t in removed]
+
+    def restore_threads(self, threads):
+        with fileio.locked(self.log_path):
+            live = set(t[0] for t in self.load())
+            restored = [t for t in threads if t[0] not in live]
+            if restored:
+                self.append(*[["T", t] for t in restored])
+                for thread in restored:
+                    for y in range(2, len(thread)):
+                        self.map_post(post_id(thread[y]), thread[0], y - 2)
+        return [t[0] for t in restored]
+
+    def save(self, index):
+        """Replaces the snapshot and empties the log."""
+        with fileio.locked(self.log_path):
+            self.write_index(index)
+            for p in (self.old_log_path, self.log_path):
+                if os.path.exists(p):
+                    os.remove(p)
+            self.postmap.rebuild(index, self.allocated())
+        return True
+
+    def compact(self):
+        """Folds the log into a new snapshot of the index.
+
+        Returns False if another process is already compacting."""
+        try:
+            with fileio.locked(self.compact_path, blocking=False):
+                with fileio.locked(self.log_path):
+                    # A leftover log.old means an earlier compaction died
+                    # half-way; it is still part of the board, so keep it.
+                    if not os.path.exists(self.old_log_path) \
+                            and os.path.exists(self.log_path):
+                        os.rename(self.log_path, self.old_log_path)
+                index = super(LogStore, self).load()
+                index = self.replay(index, self.read_log(self.old_log_path))
+                self.write_index(index)
+                if os.path.exists(self.old_log_path):
+                    os.remove(self.old_log_path)
+        except BlockingIOError:
+            return False
+        logging.info("Compacted board log in %s.", self.path)
+        return True
+
+
+class ShardStore(IndexStore):
+    """One file per thread.
+
+    boards/<name>/threads/<id> holds a thread in the usual list form and
+    boards/<name>/manifest lists [thread ID, subject, bump time, posts] for
+    every thread, most recently bumped first. Writers lock the thread they
+    change (threads/<id>.lock), so replies to different threads don't wait
+    on each other; only the short manifest update is board-wide.
+
+    A board that only has an index file is split into thread files the
+    first time it is opened with this engine.
+    """
+
+    paged = True
+
+    def __init__(self, path, config=None):
+        super(ShardStore, self).__init__(path, config)
+        self.threads_path = os.path.join(path, "threads")
+        self.manifest_path = os.path.join(path, "manifest")
+        # Threads are separate files already; whole-board reads are
+        # shared through a view, see shared.py.
+        self.offsets = None
+        self.view = shared.View(self, IndexStore(os.path.join(path, "view")))
+        if not os.path.exists(self.manifest_path) \
+                and os.path.exists(self.index_path):
+            self.split()
+
+    def split(self):
+        """Converts a board from the index or log layout. The old files go
+        once the thread files and the manifest are written, so nothing
+        reads the board as it was before the split (see file_store())."""
+        with fileio.locked(self.manifest_path):
+            if os.path.exists(self.manifest_path):
+                # Split by another process in the meantime.
+                return
+            old = LogStore(self.path)
+            index = old.load()
+            # Boards from before schema 3 aren't in bump order yet.
+            index.sort(key=thread_bump, reverse=True)
+            self.write_index(index)
+            for path in (old.index_path, old.log_path, old.old_log_path,
+                         os.path.join(self.path, "offsets")):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        logging.info("Split board %s into %d thread files.",
+                     self.path, len(index))
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def stamp_paths(self):
+        # Every change to a thread also updates the manifest.
+        return [self.manifest_path]
+
+    def thread_path(self, thread_id):
+        return os.path.join(self.threads_path, str(thread_id))
+
+    def thread_lock(self, thread_id):
+        return fileio.locked(self.thread_path(thread_id))
+
+    def upgrade(self):
+        # Thread by thread, so replies to other threads can go on. The
+        # manifest has always been in bump order.
+        if not self.exists() or self.schema() >= SCHEMA:
+            return 0
+        old = 0
+        for entry in self.read_manifest():
+            with self.thread_lock(entry[0]):
+                thread = self.get_thread(entry[0])
+                if thread is None:
+                    continue
+                legacy = sum(1 for p in thread[2:] if len(p) == 3)
+                if legacy:
+                    fileio.write_json(
+                        self.thread_path(entry[0]), thread[:2] +
+                        [Post.decode(p).encode() for p in thread[2:]])
+                    old += legacy
+        fileio.atomic_write(self.schema_path, str(SCHEMA))
+        logging.info("Upgraded %d old posts in %s.", old, self.path)
+        return old
+
+    def summary(self, thread):
+        return [thread[0], thread[1], post_time(thread[-1]), len(thread) - 2]
+
+    def read_manifest(self):
+        with open(self.manifest_path, 'r') as m:
+            return json.load(m)
+
+    def update_manifest(self, thread_id, summary):
+        """Puts the new summary of a thread in its place in the bump order,
+        or drops the thread if summary is None."""
+        with fileio.locked(self.manifest_path):
+            manifest = [e for e in self.read_manifest() if e[0] != thread_id]
+            if summary is not None:
+                insert_bumped(manifest, summary, key=lambda e: e[2])
+            fileio.write_json(self.manifest_path, manifest)
+
+    def shared_index(self):
+        return self.view.refresh().shared_index()
+
+    def get_thread(self, thread_id):
+        try:
+            with open(self.thread_path(thread_id), 'r') as t:
+                return json.load(t)
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        return list(self.iter_threads())
+
+    def iter_threads(self):
+        for entry in self.read_manifest():
+            thread = self.get_thread(entry[0])
+            if thread is not None:
+                yield thread
+
+    def page(self, start, count):
+        if start < 0:
+            raise ValueError("negative start {0}".format(start))
+        # Only the threads on the page are opened.
+        manifest = self.read_manifest()
+        threads = []
+        for entry in manifest[start:start + count]:
+            thread = self.get_thread(entry[0])
+            if thread is not None:
+                threads.append(thread)
+        return threads, len(manifest)
+
+    def write_index(self, index):
+        with fileio.locked(self.manifest_path):
+            os.makedirs(self.threads_path, exist_ok=True)
+            keep = set()
+            for thread in index:
+                fileio.write_json(self.thread_path(thread[0]), thread)
+                keep.add(str(thread[0]))
+            for f in os.listdir(self.threads_path):
+                if f.split(".")[0] not in keep:
+                    os.remove(os.path.join(self.threads_path, f))
+            fileio.write_json(self.manifest_path,
+                          [self.summary(thread) for thread in index])
+        return True
+
+    def add_thread(self, thread):
+        with self.thread_lock(thread[0]):
+            fileio.write_json(self.thread_path(thread[0]), thread)
+        self.update_manifest(thread[0], self.summary(thread))
+        self.map_post(thread[0], thread[0], 0)
+        return True
+
+    def add_reply(self, thread_id, post):
+        with self.thread_lock(thread_id):
+            thread = self.get_thread(thread_id)
+            if thread is None:
+                return False
+            thread.append(post)
+            fileio.write_json(self.thread_path(thread_id), thread)
+        self.update_manifest(thread_id, self.summary(thread))
+        self.map_post(post_id(post), thread_id, len(thread) - 3)
+        return True
+
+    def add_posts(self, entries):
+        # Threads are separate files anyway, so there is nothing to gain
+        # from batching across them.
+        added = 0
+        for thread_id, subject, post in entries:
+            if self.stored(post_id(post)):
+                continue
+            if thread_id == post_id(post):
+                self.add_thread([thread_id, subject, post])
+            elif not self.add_reply(thread_id, post):
+                continue
+            added += 1
+        return added
+
+    def remove_post(self, post_no):
+        # A post never changes threads, but its place in the thread does
+        # when an earlier reply goes: it is looked up again under the
+        # thread's lock.
+        location = self.locate(post_no)
+        if location is None:
+            return False
+        thread_id = location[0]
+        with self.thread_lock(thread_id):
+            thread = self.get_thread(thread_id)
+            if thread is None:
+                return False
+            ids = [post_id(p) for p in thread[2:]]
+            if post_no not in ids:
+                # Removed by somebody else in the meantime.
+                return False
+            before = list(thread)
+            if post_no == thread_id:
+                os.remove(self.thread_path(thread_id))
+                summary = None
+            else:
+                del thread[2 + ids.index(post_no)]
+                fileio.write_json(self.thread_path(thread_id), thread)
+                summary = self.summary(thread)
+            # Still under the lock, so removals from the same thread update
+            # the manifest and the post map in the order they happened.
+            self.update_manifest(thread_id, summary)
+            self.postmap.remove(before, post_no)
+        return True
+
+    def remove_threads(self, threads):
+        removed = []
+        for thread in threads:
+            with self.thread_lock(thread[0]):
+                if self.get_thread(thread[0]) != thread:
+                    continue
+                os.remove(self.thread_path(thread[0]))
+            removed.append(thread)
+        if removed:
+            ids = set(t[0] for t in removed)
+            with fileio.locked(self.manifest_path):
+                fileio.write_json(self.manifest_path,
+                                  [e for e in self.read_manifest()
+                                   if e[0] not in ids])
+            for thread in removed:
+                self.postmap.remove(thread, thread[0])
+        return [t[0] for t in removed]
+
+    def restore_threads(self, threads):
+        restored = []
+        for thread in threads:
+            with self.thread_lock(thread[0]):
+                if self.get_thread(thread[0]) is not None:
+                    continue
+                fileio.write_json(self.thread_path(thread[0]), thread)
+            self.update_manifest(thread[0], self.summary(thread))
+            for y in range(2, len(thread)):
+                self.map_post(post_id(thread[y]), thread[0], y - 2)
+            restored.append(thread[0])
+        return restored
+
+
+stores = {"index": IndexStore, "log": LogStore, "sharded": ShardStore,
+          "sqlite": sqlite_store.SQLiteStore}
+
+
+def file_store(path, config):
+    """Returns the file storage engine a board was written with, going by
+    the files in its directory rather than the config."""
+    if os.path.exists(os.path.join(path, "manifest")):
+        return ShardStore(path, config)
+    # Reads the index of the index engine as well, and the log if any.
+    return LogStore(path, config)
+
+
+def get_store(path, config, local=False):
+    """Returns the storage engine selected in the config for a board.
+
+    With the daemon option on, that is a remote.RemoteStore talking to
+    sshchand, unless local is set (as in the daemon itself) or the daemon
+    can't be reached."""
+    if not local and config.get_cfg_opt("daemon", "False") in ("True", "true"):
+        try:
+            return remote.RemoteStore(
+                path, config, remote.open_connection(config.daemon_socket))
+        except OSError as e:
+            logging.warning("sshchand isn't reachable at %s (%s), reading "
+                            "boards directly.", config.daemon_socket, e)
+    name = config.storage
+    if name not in stores:
+        logging.error("Unknown storage engine \"%s\", using index.", name)
+        name = "index"
+    return stores[name](path, config)
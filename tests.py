@@ -3,125 +3,1062 @@
 # various tests
 
 import unittest
+import builtins
+import contextlib
+import io
 import os
 import json
-from sys import exit
+import shutil
+import tempfile
+import threading
 
+import archive
 import boards as b
-import global_vars as g
-import post as p
+import catalog
+import chan_mark
+import config as c
+import display_legacy
+import dl_cmdline
+import fileio
+import journal
+import search
+import sqlite_store
+import watch
 
 
-class BoardlistTests(unittest.TestCase):
-    root = os.getcwd()
-    blist = root + '/boardlist'
-    postn = root + '/postnums'
+class ChanTestCase(unittest.TestCase):
+    '''Sets up a fresh sshchan root in a temporary directory for every
+    test, using the storage engine in the engine attribute and the other
+    settings in options.'''
+    engine = "index"
+    options = {}
 
     def setUp(self):
-        '''Creates a dummy setup for every test.'''
-        g.write_new_settings(self.blist, {})
-        g.write_new_settings(self.postn, {})
-        try:
-            os.mkdir(self.root + '/boards')
-        except OSError:
-            pass
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp(prefix="sshchan-test")
+        os.mkdir(os.path.join(self.root, "boards"))
+        conf = {"rootdir": self.root,
+                "boardlist_path": os.path.join(self.root, "boardlist"),
+                "postnums_path": os.path.join(self.root, "postnums"),
+                "motd_path": os.path.join(self.root, "motd"),
+                "version": "0.1", "name": "test",
+                "storage": self.engine, "journal_window_ms": "0"}
+        conf.update(self.options)
+        with open(os.path.join(self.root, "sshchan.conf"), 'w') as f:
+            json.dump(conf, f)
+        for name in ("boardlist", "postnums"):
+            with open(os.path.join(self.root, name), 'w') as f:
+                f.write("{}")
+        # Keeps the board's files, and anything left behind, in the root.
+        os.chdir(self.root)
+        self.cfg = c.Config(os.path.join(self.root, "sshchan.conf"))
 
     def tearDown(self):
-        '''Removes dummy files after test is done.'''
-        os.remove(self.blist)
-        os.remove(self.postn)
-        try:
-            os.remove(self.root + '/boards/a/index')
-            os.rmdir(self.root + '/boards/a')
-            os.rmdir(self.root + '/boards')
-        except OSError:
-            pass
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def contents(self, board):
+        '''The post texts of every thread of board, most recently bumped
+        thread first.'''
+        return [[post.text for post in thread.posts]
+                for thread in board.iter_threads()]
+
+
+class BoardlistTests(ChanTestCase):
 
-    # actual tests
     def testAddValidBoard(self):
-        '''Just adds a valid board name (a string for now).
-        Should evaluate to True.'''
-        self.assertTrue(b.add_board('a', 'Anime & Manga',
-                                    self.blist, self.root, self.postn))
-
-    def testAddInvalidIntegerBoard(self):
-        '''Tries to add an invalid board name (an integer).
-        Should evaluate to False.'''
-        self.assertFalse(b.add_board(5, '', self.blist, self.root, self.postn))
-
-    def testAddInvalidListBoard(self):
-        '''Same as above, but tries to add a list with string - just really
-        making sure the checks work.'''
-        self.assertFalse(b.add_board(
-            ['a', ], '', self.blist, self.root, self.postn))
+        '''Creating a Board adds it to the boardlist.'''
+        b.Board('a', 'Anime & Manga', self.cfg)
+        self.assertEqual(self.cfg.get_boardlist(), {'a': 'Anime & Manga'})
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'boards', 'a')))
 
     def testAddSameBoardTwice(self):
-        '''Tries to add the same board twice. First try should success and
-        evaluate to True, second should fail.'''
-        # This will work:
-        self.assertTrue(b.add_board(
-            'a', '', self.blist, self.root, self.postn))
-        # This won't, since we just added a board named like that:
-        self.assertFalse(b.add_board(
-            'a', '', self.blist, self.root, self.postn))
-
-    def testGetBoardlist(self):
-        '''Tests if getting function works properly. Also tests the custom
-        description setting in add_board().'''
-        self.assertTrue(b.add_board('a', 'Anime & Manga',
-                                    self.blist, self.root, self.postn))
-        self.assertEqual(b.get_boardlist(self.blist), {'a': 'Anime & Manga'})
-
-
-class PostingTests(unittest.TestCase):
-    root = os.getcwd()
-    blist = root + '/boardlist'
-    postn = root + '/postnums'
+        '''Adding a board that is already on the boardlist fails and keeps
+        the old description.'''
+        board = b.Board('a', 'Anime & Manga', self.cfg)
+        self.assertFalse(board.add_board())
+        b.Board('a', 'Something else', self.cfg)
+        self.assertEqual(self.cfg.get_boardlist(), {'a': 'Anime & Manga'})
+
+    def testAddEmptyBoardName(self):
+        '''A board without a name is never added.'''
+        board = b.Board('', '', self.cfg)
+        self.assertFalse(board.add_board())
+        self.assertEqual(self.cfg.get_boardlist(), {})
+
+    def testDeleteBoard(self):
+        board = b.Board('a', '', self.cfg)
+        self.assertTrue(board.del_board())
+        self.assertEqual(self.cfg.get_boardlist(), {})
+        self.assertFalse(board.board_exists('a'))
+
+
+class EngineTests(ChanTestCase):
+    '''Posting, removing, paging and locating posts. Runs against the
+    index engine here, and against every other storage engine in the
+    subclasses below.'''
 
     def setUp(self):
+        super().setUp()
+        self.board = b.Board("a", "Anime", self.cfg)
+
+    def testValidPost(self):
+        thread_id = self.board.add_post("test post", subject="test subject")
+        self.assertEqual(thread_id, 1)
+        thread = self.board.get_thread(1)
+        self.assertEqual(thread.id, 1)
+        self.assertEqual(thread.subject, "test subject")
+        self.assertEqual(thread.posts[0].text, "test post")
+
+    def testValidReply(self):
+        self.board.add_post("test post", subject="test subject")
+        self.assertEqual(self.board.add_post("reply", thread_id=1), 2)
+        thread = self.board.get_thread(1)
+        self.assertEqual([post.id for post in thread.posts], [1, 2])
+        self.assertEqual(thread.posts[1].text, "reply")
+
+    def testReplyBumpsThread(self):
+        self.board.add_post("one")
+        self.board.add_post("two")
+        self.board.add_post("reply", thread_id=1)
+        self.assertEqual([t.id for t in self.board.iter_threads()], [1, 2])
+
+    def testSameSecondOrder(self):
+        '''Threads bumped within the same second are listed in the order
+        they were bumped, whatever the engine.'''
+        for n in range(4):
+            self.board.store.add_post(str(n), "Anonymous", "", -1, 1000)
+        self.board.store.add_post("reply", "Anonymous", "", 2, 1000)
+        self.assertEqual([t.id for t in self.board.iter_threads()],
+                         [2, 4, 3, 1])
+
+    def testRemoveReply(self):
+        self.board.add_post("op")
+        self.board.add_post("reply", thread_id=1)
+        self.assertTrue(self.board.store.remove_post(2))
+        self.assertEqual(self.contents(self.board), [["op"]])
+        self.assertIsNone(self.board.store.locate(2))
+
+    def testRemoveThread(self):
+        self.board.add_post("one")
+        self.board.add_post("reply", thread_id=1)
+        self.board.add_post("two")
+        self.assertTrue(self.board.store.remove_post(1))
+        self.assertEqual(self.contents(self.board), [["two"]])
+        self.assertIsNone(self.board.get_thread(1))
+        self.assertIsNone(self.board.store.locate(2))
+
+    def testRemoveMissingPost(self):
+        self.board.add_post("op")
+        self.assertFalse(self.board.store.remove_post(5))
+        self.assertEqual(self.contents(self.board), [["op"]])
+
+    def testRmPost(self):
+        '''rm_post() asks before removing, and says so when the post is
+        missing.'''
+        self.board.add_post("op")
+        self.board.add_post("reply", thread_id=1)
+        answers = iter(["n", "y"])
+        old_input = builtins.input
+        builtins.input = lambda *args: next(answers)
         try:
-            os.mkdir(self.root + '/boards')
-        except OSError:
-            pass
-        g.write_new_settings(self.blist, {})
-        b.add_board("a", "Anime", self.blist, self.root, self.postn)
+            self.assertFalse(self.board.rm_post("a", 2))
+            self.assertEqual(self.contents(self.board), [["op", "reply"]])
+            self.assertTrue(self.board.rm_post("a", 2))
+            self.assertEqual(self.contents(self.board), [["op"]])
+            self.assertFalse(self.board.rm_post("a", 2))
+        finally:
+            builtins.input = old_input
 
-    def tearDown(self):
-        os.remove(self.blist)
-        os.remove(self.postn)
+    def testLocate(self):
+        self.board.add_post("one")
+        self.board.add_post("two")
+        self.board.add_post("reply", thread_id=1)
+        self.board.add_post("reply", thread_id=2)
+        self.assertEqual(self.board.store.locate(1), (1, 0))
+        self.assertEqual(self.board.store.locate(3), (1, 1))
+        self.assertEqual(self.board.store.locate(4), (2, 1))
+        self.assertIsNone(self.board.store.locate(5))
+        self.assertEqual(self.board.thread_exists(4, return_id=True), 2)
+
+    def testPage(self):
+        for n in range(5):
+            self.board.add_post(str(n))
+        threads, pages = self.board.get_page(1, 2)
+        self.assertEqual(pages, 3)
+        self.assertEqual([t.id for t in threads], [5, 4])
+        threads, pages = self.board.get_page(3, 2)
+        self.assertEqual([t.id for t in threads], [1])
+        threads, pages = self.board.get_page(4, 2)
+        self.assertEqual(threads, [])
+
+    def testPageBeforeFirst(self):
+        '''Pages before the first are the first.'''
+        for n in range(3):
+            self.board.add_post(str(n))
+        first = [t.id for t in self.board.get_page(1, 2)[0]]
+        for page in (0, -1):
+            threads, pages = self.board.get_page(page, 2)
+            self.assertEqual([t.id for t in threads], first)
+            self.assertEqual(pages, 2)
+        if self.board.store.paged:
+            self.assertRaises(ValueError, self.board.store.page, -1, 2)
+
+    def testPagePreview(self):
+        self.board.add_post("op")
+        for n in range(4):
+            self.board.add_post(str(n), thread_id=1)
+        thread = self.board.get_page(1, 10, preview_replies=2)[0][0]
+        self.assertEqual([post.text for post in thread.posts],
+                         ["op", "2", "3"])
+        self.assertEqual(thread.omitted, 2)
+
+    def testChangesSince(self):
+        version = self.board.version()
+        self.board.add_post("op")
+        self.board.add_post("reply", thread_id=1)
+        current, changed = self.board.changes_since(version)
+        self.assertEqual(current, version + 2)
+        self.assertEqual([(ch.kind, ch.thread, ch.post) for ch in changed],
+                         [("created", 1, 1), ("added", 1, 2)])
+
+
+class LogEngineTests(EngineTests):
+    engine = "log"
+
+
+class ShardedEngineTests(EngineTests):
+    engine = "sharded"
+
+    def testRemoveAfterEarlierReplyWent(self):
+        '''A post whose place in the thread changed between locating it
+        and locking the thread is still the one removed.'''
+        self.board.add_post("op")
+        for text in ("two", "three", "four"):
+            self.board.add_post(text, thread_id=1)
+        store = self.board.store
+        stale = store.locate(4)
+        self.assertTrue(store.remove_post(2))
+        store.locate = lambda post_no: stale
+        self.assertTrue(store.remove_post(4))
+        del store.locate
+        self.assertEqual(self.contents(self.board), [["op", "three"]])
+        self.assertEqual(store.locate(3), (1, 1))
+        self.assertFalse(store.remove_post(4))
+
+
+class SQLiteEngineTests(EngineTests):
+    engine = "sqlite"
+
+
+class OffsetTests(ChanTestCase):
+    '''Reads through the offset table of the index engine, and verify
+    rebuilding a table that doesn't describe the index.'''
+
+    def setUp(self):
+        super().setUp()
+        self.board = b.Board("a", "Anime", self.cfg)
+        self.store = self.board.store
+        for n in range(4):
+            self.board.add_post(str(n))
+        for n in range(3):
+            self.board.add_post("reply " + str(n), thread_id=2)
+
+    def table(self):
+        '''Whether reads go through the offset table.'''
+        with self.store.mapped() as (i, table):
+            return table is not None
+
+    def assertReadsMatch(self):
+        board = self.store.load()
+        for start in range(0, len(board) + 1):
+            self.assertEqual(self.store.page(start, 2),
+                             (board[start:start + 2], len(board)))
+        for thread in board:
+            self.assertEqual(self.store.get_thread(thread[0]), thread)
+            for replies in range(0, len(thread) - 1):
+                self.assertEqual(self.store.get_thread_tail(thread[0],
+                                                            replies),
+                                 b.storage.cut_thread(thread, replies))
+            self.assertEqual(self.store.get_posts_after(thread[0], 5),
+                             [p for p in thread[2:] if p[2] > 5])
+        self.assertIsNone(self.store.get_thread(5))
+        self.assertEqual(self.store.get_thread_tail(5, 1), (None, 0))
+
+    def testReadsThroughTable(self):
+        self.assertTrue(self.table())
+        self.assertReadsMatch()
+        self.assertEqual(self.store.verify(), [])
+
+    def testIndexEditedByHand(self):
+        '''A table left over from another version of the index is
+        ignored until verify rebuilds it.'''
+        with open(self.store.index_path, 'r') as i:
+            text = i.read()
+        fileio.atomic_write(self.store.index_path,
+                            text.replace('"3"]]', '"edited"]]'))
+        self.assertFalse(self.table())
+        self.assertEqual(self.store.get_thread(4)[2][3], "edited")
+        self.assertReadsMatch()
+        self.assertEqual(self.store.verify(), ["offset table"])
+        self.assertTrue(self.table())
+        self.assertReadsMatch()
+
+    def testBrokenTable(self):
+        with open(os.path.join(self.board.path, "offsets"), 'wb') as f:
+            f.write(b"SCOF")
+        self.assertFalse(self.table())
+        self.assertReadsMatch()
+        self.assertEqual(self.store.verify(), ["offset table"])
+        self.assertTrue(self.table())
+
+    def testWrongOffsets(self):
+        '''verify also catches a table whose header matches the index but
+        whose offsets don't.'''
+        with open(self.store.index_path, 'rb') as i:
+            st = os.fstat(i.fileno())
+        posts = [(p[2], 0, 1) for t in self.store.load() for p in t[2:]]
+        threads = []
+        for t in self.store.load():
+            threads.append((t[0], 0, 1, len(threads) and
+                            threads[-1][3] + threads[-1][4], len(t) - 2))
+        self.store.offsets.write(st, threads, posts)
+        self.assertTrue(self.table())
+        self.assertEqual(self.store.verify(), ["offset table"])
+        self.assertReadsMatch()
+
+
+class LogStoreTests(ChanTestCase):
+    '''Reads of the log engine served from its snapshot and log.'''
+    engine = "log"
+
+    def setUp(self):
+        super().setUp()
+        self.board = b.Board("a", "Anime", self.cfg)
+        self.store = self.board.store
+        for n in range(6):
+            self.board.add_post(str(n))
+        self.board.add_post("reply", thread_id=2)
+        self.board.add_post("reply", thread_id=4)
+        self.store.compact()
+        # On top of the snapshot: a new thread, replies and deletions.
+        self.board.add_post("new")
+        self.board.add_post("late reply", thread_id=1)
+        self.store.remove_post(8)
+        self.store.remove_post(3)
+
+    def assertReadsMatch(self):
+        board = self.store.load()
+        for per in (1, 2, 4):
+            for start in range(0, len(board) + 1):
+                self.assertEqual(self.store.page(start, per),
+                                 (board[start:start + per], len(board)))
+        for thread in board:
+            self.assertEqual(self.store.get_thread(thread[0]), thread)
+            self.assertEqual(self.store.get_posts_after(thread[0], thread[0]),
+                             thread[3:])
+        self.assertIsNone(self.store.get_thread(3))
+
+    def testReadsMatchBoard(self):
+        self.assertReadsMatch()
+
+    def testReadsDontBuildView(self):
+        self.board.get_page(1, 3)
+        self.board.get_thread(1)
+        self.board.get_thread(2, replies=1)
+        self.assertFalse(os.path.exists(os.path.join(self.board.path,
+                                                     "view")))
+
+    def testOldDeletionRecords(self):
+        '''Deletions logged without their thread are still replayed.'''
+        self.store.append(["D", 7])
+        self.assertEqual([p[3] for p in self.store.get_thread(2)[2:]], ["1"])
+        self.assertReadsMatch()
+
+    def testReadsAfterCompaction(self):
+        self.store.compact()
+        self.assertReadsMatch()
+        self.assertEqual(self.store.verify(), [])
+
+
+class CmdlineTests(ChanTestCase):
+    '''The commands of the legacy command line.'''
+    options = {"threads_per_page": "1"}
+
+    def setUp(self):
+        super().setUp()
+        self.board = b.Board("a", "Anime", self.cfg)
+        marker = chan_mark.Marker()
+        self.dl = display_legacy.DisplayLegacy(self.cfg, self.board,
+                                               self.board.c, marker)
+        self.cmd = dl_cmdline.DisplayLegacyCmdline(
+            self.board, self.board.c, self.cfg, self.dl, marker)
+
+    def run_quietly(self, function, *args):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            result = function(*args)
+        return result, out.getvalue()
+
+    def testViewThread(self):
+        self.board.add_post("op")
+        self.board.add_post("reply", thread_id=1)
+        self.run_quietly(self.cmd.cmdline_view, ["v", "2"])
+        self.assertEqual(self.board.thread, 1)
+
+    def testViewArchivedThread(self):
+        '''An archived thread is shown, but the command line stays on the
+        board, so 're' and 'rt' don't act on it.'''
+        for n in range(3):
+            self.board.add_post(str(n))
+        self.board.thread = 3
+        archive.set_retention(self.board.path, pages=1)
+        self.assertEqual(self.board.archive(), 2)
+        shown, out = self.run_quietly(self.dl.display_thread, "1")
+        self.assertEqual(shown, display_legacy.ARCHIVED)
+        self.assertIn("archived", out)
+        self.run_quietly(self.cmd.cmdline_view, ["v", "1"])
+        self.assertEqual(self.board.thread, 0)
+
+    def testViewMissingThread(self):
+        shown, out = self.run_quietly(self.dl.display_thread, "5")
+        self.assertFalse(shown)
+        self.assertIn("Thread not found.", out)
+
+    def follow(self, *steps):
+        '''Runs the follow command on thread 1, calling the next of steps
+        each time it waits for the board to change; ^C once they run
+        out.'''
+        steps = iter(steps)
+
+        class Watcher():
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                pass
+
+            def wait(self, timeout=None):
+                step = next(steps, None)
+                if step is None:
+                    raise KeyboardInterrupt
+                step()
+                return True
+
+        self.board.watch = Watcher
         try:
-            os.remove(self.root + '/boards/a/index')
-            os.rmdir(self.root + '/boards/a')
-            os.rmdir(self.root + '/boards')
-        except OSError:
-            pass
+            return self.run_quietly(self.cmd.cmdline_follow, ["f", "1"])
+        finally:
+            del self.board.watch
 
-    def testValidPost(self):
-        p.post("a", "test post", "test subject", -1, self.postn, self.root)
-        index = b.get_index("a", self.root)
-        self.assertEqual(index[0][0], 1)  # assert thread/post ID is correct
-        self.assertEqual(index[0][1], "test subject")
-        self.assertEqual(index[0][2][2], "test post")
+    def testFollow(self):
+        '''follow shows the last replies, then every new post once.'''
+        self.board.add_post("op")
+        for n in range(dl_cmdline.FOLLOW_CONTEXT + 1):
+            self.board.add_post("old " + str(n), thread_id=1)
+        context = dl_cmdline.FOLLOW_CONTEXT
+        followed, out = self.follow(
+            lambda: self.board.add_post("new one", thread_id=1),
+            lambda: None,
+            lambda: self.board.add_post("new two", thread_id=1))
+        self.assertTrue(followed)
+        self.assertEqual(self.board.thread, 1)
+        self.assertNotIn("old 0", out)
+        self.assertIn("old " + str(context), out)
+        self.assertEqual(out.count("new one"), 1)
+        self.assertEqual(out.count("new two"), 1)
+        self.assertLess(out.index("new one"), out.index("new two"))
+
+    def testFollowGoneThread(self):
+        self.board.add_post("op")
+        followed, out = self.follow(
+            lambda: self.board.store.remove_post(1))
+        self.assertFalse(followed)
+        self.assertIn("The thread is gone.", out)
+
+    def testFollowMissingThread(self):
+        followed, out = self.follow()
+        self.assertFalse(followed)
+        self.assertIn("Thread not found.", out)
+
+
+class ArchiveTests(ChanTestCase):
+    '''Moving threads past the retention window into the archive.'''
+    options = {"threads_per_page": "2"}
+
+    def setUp(self):
+        super().setUp()
+        self.board = b.Board("a", "Anime", self.cfg)
+        archive.set_retention(self.board.path, pages=1)
+
+    def testRetention(self):
+        '''Only the threads past the retention window are archived, and
+        they are taken off the board.'''
+        for n in range(5):
+            self.board.add_post(str(n))
+        self.assertEqual([t.id for t in self.board.iter_threads()], [5, 4])
+        entries, total = self.board.get_archive().browse(0, 10)
+        self.assertEqual(total, 3)
+        self.assertEqual([e[0] for e in entries], [3, 2, 1])
+        self.assertEqual(self.board.archive(), 0)
+
+    def testKeptAndRestoredThreads(self):
+        for n in range(4):
+            self.board.add_post(str(n))
+        self.assertTrue(self.board.restore(1))
+        self.assertFalse(self.board.restore(1))
+        self.assertIn(1, [t.id for t in self.board.iter_threads()])
+        self.assertIsNone(self.board.get_archive().get_thread(1))
+        self.board.add_post("new")
+        self.assertIn(1, [t.id for t in self.board.iter_threads()])
+
+    def testSegmentsFill(self):
+        '''Archiver runs add to the newest segment until it is full, so
+        lookups don't go through a segment per run.'''
+        for n in range(60):
+            self.board.add_post("post %d" % n)
+        board_archive = self.board.get_archive()
+        self.assertEqual(board_archive.segments(), [1])
+        self.assertEqual(board_archive.browse(0, 0)[1], 58)
+        for thread_id in (1, 30, 58):
+            self.assertEqual(board_archive.find_thread(thread_id), thread_id)
+            self.assertEqual(board_archive.get_thread(thread_id)[2][3],
+                             "post %d" % (thread_id - 1))
+
+    def testSegmentLimit(self):
+        old_limit = archive.SEGMENT_BYTES
+        archive.SEGMENT_BYTES = 200
+        try:
+            for n in range(20):
+                self.board.add_post("post %d" % n)
+        finally:
+            archive.SEGMENT_BYTES = old_limit
+        board_archive = self.board.get_archive()
+        segments = board_archive.segments()
+        self.assertGreater(len(segments), 1)
+        self.assertLess(len(segments), 18)
+        for thread_id in range(1, 19):
+            self.assertEqual(board_archive.find_thread(thread_id), thread_id)
+        # Segments whose threads are all restored go.
+        first = min(segments)
+        for entry in board_archive.read_catalog():
+            if entry[4] == first:
+                self.board.restore(entry[0])
+        self.assertNotIn(first, board_archive.segments())
+
+    def testReadArchivedThread(self):
+        '''Archived threads and their posts are found again.'''
+        self.board.add_post("op")
+        self.board.add_post("reply", thread_id=1)
+        for n in range(2):
+            self.board.add_post(str(n))
+        thread = self.board.get_archived(2)
+        self.assertEqual([post.text for post in thread.posts],
+                         ["op", "reply"])
+        self.assertEqual(self.board.get_archived(2, replies=0).omitted, 1)
+        self.assertIsNone(self.board.get_archived(3))
+        self.assertIsNone(self.board.get_archived(9))
+
+    def testCompression(self):
+        for codec, (name, _, _) in archive.CODECS.items():
+            path = os.path.join(self.root, name + ".seg")
+            threads = [[n, "s", ["A", 0, n, "text " * 50]]
+                       for n in (3, 1, 2)]
+            archive.write_segment(path, threads, codec)
+            self.assertLess(os.path.getsize(path), 3 * 250)
+            with open(path, 'rb') as f:
+                m = f.read()
+            segment = archive.Segment(path, m, 0)
+            self.assertEqual(segment.get_thread(2), threads[2])
+            self.assertEqual(segment.find_post(3), 3)
+            self.assertIsNone(segment.find_post(4))
+
+
+class JournalTests(ChanTestCase):
+    '''Replaying the journal and the journal_fsync policies.'''
+
+    def setUp(self):
+        super().setUp()
+        self.board = b.Board("a", "", self.cfg)
+        self.board.add_post("op")
+        self.journal = self.board.journal
+
+    def append(self, thread_id, text):
+        '''Journals a post the way a session that crashed before
+        committing it would have. Returns its post number.'''
+        post_no = self.cfg.reserve_postnums("a")
+        if thread_id == -1:
+            thread_id = post_no
+        with open(self.journal.path, 'a') as j:
+            j.write(json.dumps([thread_id, "", ["Anonymous", 1000, post_no,
+                                                text]]) + "\n")
+        return post_no
+
+    def fsyncs(self, run):
+        '''Calls run and returns how many times the journal file itself
+        was fsynced meanwhile.'''
+        synced = []
+        fsync = os.fsync
+        def counting(fd):
+            synced.append(os.fstat(fd).st_ino)
+            fsync(fd)
+        journal.os.fsync = counting
+        try:
+            run()
+        finally:
+            journal.os.fsync = fsync
+        return synced.count(os.stat(self.journal.path).st_ino)
+
+    def testReplayOnOpen(self):
+        '''Posts left in the journal are on the board once it's opened
+        again, and the journal starts a new generation.'''
+        generation = self.journal.read_head()[0]
+        self.append(1, "reply")
+        self.append(-1, "thread")
+        self.assertTrue(self.journal.pending())
+        board = b.Board("a", "", self.cfg)
+        self.assertEqual(self.contents(board), [["thread"], ["op", "reply"]])
+        self.assertFalse(board.journal.pending())
+        self.assertEqual(board.journal.read_head(), (generation + 1, 0))
+        self.assertEqual(os.path.getsize(self.journal.path), 0)
+
+    def testReplayTwice(self):
+        '''Replaying entries that are already on the board, as after a
+        crash between storing them and writing the head, skips them.'''
+        self.append(1, "reply")
+        entries = [json.loads(line) for line in open(self.journal.path)]
+        self.board.store.add_posts(entries)
+        self.assertEqual(self.journal.replay(), 0)
+        self.assertEqual(self.contents(self.board), [["op", "reply"]])
+        self.assertFalse(self.journal.pending())
+
+    def testReplaySkipsMissingThread(self):
+        self.append(7, "orphan")
+        self.assertEqual(self.journal.replay(), 0)
+        self.assertEqual(self.contents(self.board), [["op"]])
+
+    def testReplayAll(self):
+        other = b.Board("b", "", self.cfg)
+        self.append(1, "reply")
+        post_no = self.cfg.reserve_postnums("b")
+        with open(other.journal.path, 'a') as j:
+            j.write(json.dumps([post_no, "", ["Anonymous", 1000, post_no,
+                                              "b op"]]) + "\n")
+        journal.replay_all(self.cfg)
+        self.assertEqual(self.contents(b.Board("a", "", self.cfg)),
+                         [["op", "reply"]])
+        self.assertEqual(self.contents(b.Board("b", "", self.cfg)),
+                         [["b op"]])
+
+    def testPolicies(self):
+        '''"always" fsyncs every entry as it is journaled, "batch" once
+        per commit however many entries it holds, "never" not at
+        all.'''
+        for policy, per_post, per_batch in (("always", 1, 0),
+                                            ("batch", 1, 1),
+                                            ("never", 0, 0)):
+            self.journal.fsync = policy
+            self.assertEqual(self.fsyncs(
+                lambda: self.journal.add_post("reply", "Anonymous", "", 1,
+                                              1000)), per_post, policy)
+            for n in range(3):
+                self.append(1, "replayed")
+            self.assertEqual(self.fsyncs(self.journal.replay), per_batch,
+                             policy)
+        self.assertEqual(len(self.board.get_thread(1).posts), 13)
+
+    def testUnknownPolicy(self):
+        self.cfg.get_cfg_opt = lambda key, default, fatal=False: \
+            "sometimes" if key == "journal_fsync" else default
+        try:
+            self.assertEqual(journal.Journal(self.board.store, self.cfg).fsync,
+                             "batch")
+        finally:
+            del self.cfg.get_cfg_opt
+
+
+class CatalogTests(ChanTestCase):
+    '''Paged board listings and the figures the catalog keeps.'''
+    options = {"boards_per_page": "2"}
+
+    def setUp(self):
+        super().setUp()
+        for name in ("b", "ab", "a", "abc", "c"):
+            b.Board(name, name.upper(), self.cfg)
+        self.catalog = catalog.get_catalog(self.cfg)
+
+    def names(self, prefix="", page=1):
+        boards, pages = self.catalog.listing(prefix, page)
+        return [info.name for info in boards], pages
+
+    def testPages(self):
+        self.assertEqual(self.names(), (["a", "ab"], 3))
+        self.assertEqual(self.names(page=2), (["abc", "b"], 3))
+        self.assertEqual(self.names(page=3), (["c"], 3))
+        self.assertEqual(self.names(page=4), ([], 3))
+
+    def testPrefix(self):
+        self.assertEqual(self.names("ab"), (["ab", "abc"], 1))
+        self.assertEqual(self.names("a", 2), (["abc"], 2))
+        self.assertEqual(self.names("x"), ([], 1))
+
+    def testListingArgs(self):
+        self.assertEqual(catalog.listing_args([]), ("", 1))
+        self.assertEqual(catalog.listing_args(["/AB/", "2"]), ("ab", 2))
+        self.assertEqual(catalog.listing_args(["0"]), ("", 1))
+
+    def testFigures(self):
+        info = self.catalog.info("a")
+        self.assertEqual((info.desc, info.posts, info.threads, info.bump),
+                         ("A", 0, 0, None))
+        board = b.Board("a", "", self.cfg)
+        board.add_post("one")
+        board.add_post("two")
+        board.add_post("reply", thread_id=1)
+        info = self.catalog.info("a")
+        self.assertEqual((info.posts, info.threads), (3, 2))
+        self.assertEqual(info.bump, board.get_thread(1).bump)
+        self.assertIsNone(self.catalog.info("x"))
+
+    def testBoardlistChanges(self):
+        b.Board("aa", "", self.cfg)
+        b.Board("ab", "", self.cfg).del_board()
+        self.assertEqual(self.catalog.names("a"), ["a", "aa", "abc"])
+        self.assertNotIn("ab", self.catalog)
+        self.assertEqual(len(self.catalog), 5)
+
+
+class SearchTests(ChanTestCase):
+    '''Queries against a board's search index.'''
+
+    def setUp(self):
+        super().setUp()
+        self.board = b.Board("a", "", self.cfg)
+        self.board.add_post("The quick brown fox", subject="Animals")
+        self.board.add_post("A lazy dog")
+        self.board.add_post("quick, dog!", thread_id=1)
+        self.board.add_post("dog " + "and many other words " * 5)
+        self.index = search.SearchIndex(self.board.store)
+
+    def found(self, query):
+        hits, total = self.index.search(query, "a")
+        self.assertEqual(total, len(hits))
+        return [hit.post for hit in hits]
+
+    def testWords(self):
+        '''A post has to contain every word, in any case and order.'''
+        self.assertEqual(sorted(self.found("QUICK")), [1, 3])
+        self.assertEqual(self.found("dog quick"), [3])
+        self.assertEqual(self.found("cat"), [])
+        self.assertEqual(self.found("  "), [])
+
+    def testPhrase(self):
+        self.assertEqual(self.found('"brown fox"'), [1])
+        self.assertEqual(self.found('"fox brown"'), [])
+        self.assertEqual(self.found("brown-fox"), [1])
+
+    def testSubject(self):
+        '''The subject is searched as part of the OP.'''
+        self.assertEqual(self.found("animals"), [1])
+
+    def testRanking(self):
+        '''A word counts for more in a short post than in a long one.'''
+        self.assertEqual(self.found("dog"), [3, 2, 4])
+
+    def testHits(self):
+        hit = self.index.search("lazy", "a")[0][0]
+        self.assertEqual((hit.board, hit.post, hit.thread), ("a", 2, 2))
+        thread, post = search.find_post(self.cfg, hit)
+        self.assertEqual((thread.id, post.text), (2, "A lazy dog"))
+        self.assertEqual(search.find_post(self.cfg, hit._replace(post=9)),
+                         (None, None))
+
+    def testSearchBoards(self):
+        other = b.Board("b", "", self.cfg)
+        other.add_post("another fox")
+        hits, total = search.search_boards(self.cfg, "fox", ["a", "b"])
+        self.assertEqual(total, 2)
+        self.assertEqual(sorted((h.board, h.post) for h in hits),
+                         [("a", 1), ("b", 1)])
+
+    def testResultsPage(self):
+        hits = list(range(25))
+        self.assertEqual(search.results_page(hits, 1), (hits[:10], 3))
+        self.assertEqual(search.results_page(hits, 3), (hits[20:], 3))
+        self.assertEqual(search.results_page([], 1), ([], 1))
+
+    def testSnippet(self):
+        text = "word " * 30 + "needle " + "word " * 30
+        part = search.snippet(text, "needle", width=30)
+        self.assertIn("needle", part)
+        self.assertTrue(part.startswith("...") and part.endswith("..."))
+        self.assertEqual(search.snippet("short", "x"), "short")
+
+
+class SearchIndexTests(ChanTestCase):
+    '''Keeping the search index up to date as posts come and go.'''
+
+    def setUp(self):
+        super().setUp()
+        self.board = b.Board("a", "", self.cfg)
+        for n in range(3):
+            self.board.add_post("word " + str(n))
+        self.index = search.SearchIndex(self.board.store)
+        # The first search builds the index.
+        self.assertEqual(len(self.found("word")), 3)
+
+    def found(self, query):
+        return sorted(hit.post for hit in self.index.search(query, "a")[0])
+
+    def remove(self, post_id):
+        '''Removes a reply the way Board.rm_post() does.'''
+        self.assertTrue(self.board.store.remove_post(post_id))
+        self.index.remove([post_id])
+
+    def wait_for_merges(self):
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and thread.daemon:
+                thread.join()
+
+    def testNewPostSegment(self):
+        '''Every new post goes into a segment of its own.'''
+        segments = len(self.index.manifest()["segments"])
+        self.board.add_post("word new")
+        manifest = self.index.manifest()
+        self.assertEqual(len(manifest["segments"]), segments + 1)
+        self.assertEqual(manifest["covered"], 4)
+        self.assertEqual(self.found("new"), [4])
+
+    def testRemovedPost(self):
+        self.board.add_post("word reply", thread_id=1)
+        self.remove(4)
+        self.assertEqual(self.index.manifest()["deleted"], [4])
+        self.assertEqual(self.found("word"), [1, 2, 3])
+        self.assertEqual(self.found("reply"), [])
+
+    def testMerge(self):
+        '''FANOUT segments of the same level are merged into one, and the
+        deleted posts are left out of it.'''
+        self.board.add_post("word reply", thread_id=1)
+        self.remove(4)
+        for n in range(search.FANOUT):
+            self.board.add_post("later " + str(n))
+        self.wait_for_merges()
+        # A merge started while another ran is left to the next post.
+        self.assertTrue(self.index.merge())
+        manifest = self.index.manifest()
+        self.assertIsNone(search.merge_due(manifest))
+        self.assertLess(len(manifest["segments"]), search.FANOUT)
+        self.assertEqual(manifest["deleted"], [])
+        self.assertEqual(sorted(self.index.segment_files()),
+                         sorted(s[0] for s in manifest["segments"]))
+        self.assertEqual(self.found("later"),
+                         list(range(5, 5 + search.FANOUT)))
+        self.assertEqual(self.found("word"), [1, 2, 3])
+
+    def testLevels(self):
+        self.assertEqual(search.level(1), 0)
+        self.assertEqual(search.level(search.FANOUT), 1)
+        self.assertEqual(search.level(search.FANOUT ** 2 - 1), 1)
+        self.assertIsNone(search.merge_due({"segments": [["1.idx", 100]] +
+                                            [["2.idx", 1]] * 7}))
+
+    def testCatchUp(self):
+        '''Posts that never made it into the index are indexed by the
+        next search.'''
+        self.board.store.add_post("word missed", "Anonymous", "", 2, 1000)
+        self.assertEqual(self.found("missed"), [4])
+        self.assertEqual(self.index.manifest()["covered"], 4)
+
+    def testVerify(self):
+        self.assertFalse(self.index.verify())
+        # Removed from the board, but not from the index.
+        self.board.store.remove_post(3)
+        self.assertTrue(self.index.verify())
+        self.assertEqual(self.found("word"), [1, 2])
+        self.assertFalse(self.index.verify())
+
+    def testBrokenSegment(self):
+        name = self.index.manifest()["segments"][0][0]
+        with open(os.path.join(self.index.path, name), 'wb') as f:
+            f.write(b"broken")
+        search.forget_segments(self.index.path)
+        self.assertEqual(self.found("word"), [1, 2, 3])
+
+
+class WatchTests(ChanTestCase):
+    '''Waiting for a board to change, through inotify and by polling.'''
+
+    def setUp(self):
+        super().setUp()
+        self.board = b.Board("a", "Anime", self.cfg)
+        self.board.add_post("op")
+
+    def assertWakes(self, watcher):
+        self.assertFalse(watcher.wait(0.05))
+        self.board.add_post("reply", thread_id=1)
+        self.assertTrue(watcher.wait(5))
+        self.assertFalse(watcher.changed())
+        self.board.add_post("thread")
+        self.assertTrue(watcher.wait(5))
+
+    def testInotify(self):
+        with self.board.watch() as watcher:
+            if watcher.fileno() is None:
+                self.skipTest("no inotify here")
+            self.assertWakes(watcher)
+
+    def testPolling(self):
+        libc = watch.libc
+        watch.libc = lambda: None
+        try:
+            watcher = watch.Watcher(self.board.store.stamp_paths(),
+                                    interval=0.01)
+        finally:
+            watch.libc = libc
+        with watcher:
+            self.assertIsNone(watcher.fileno())
+            self.assertWakes(watcher)
+
+    def testPostsAfter(self):
+        self.board.add_post("one", thread_id=1)
+        self.board.add_post("two", thread_id=1)
+        self.assertEqual([p.text for p in self.board.get_posts_after(1, 2)],
+                         ["two"])
+        self.assertEqual(self.board.get_posts_after(1, 3), [])
+        self.assertIsNone(self.board.get_posts_after(9, 0))
+
+
+class LogWatchTests(WatchTests):
+    engine = "log"
+
+
+class ShardedWatchTests(WatchTests):
+    engine = "sharded"
+
+
+class SQLiteWatchTests(WatchTests):
+    engine = "sqlite"
+
+
+class CounterTests(ChanTestCase):
+    '''The per-board post counters.'''
+
+    def testBoardsCountApart(self):
+        a = b.Board("a", "", self.cfg)
+        other = b.Board("b", "", self.cfg)
+        a.add_post("one")
+        a.add_post("two")
+        self.assertEqual(other.add_post("one"), 1)
+        self.assertEqual(self.cfg.get_postnums(), {"a": 2, "b": 1})
+
+    def testAddBoardKeepsOtherCounters(self):
+        '''Adding a board while another session posts doesn't roll the
+        other boards' counters back to a snapshot read before.'''
+        a = b.Board("a", "", self.cfg)
+        a.add_post("one")
+        a.add_post("two")
+        stale = self.cfg.get_postnums()
+        # Another session posts after the snapshot was read.
+        self.assertEqual(a.add_post("three"), 3)
+        self.cfg.get_postnums = lambda: dict(stale)
+        try:
+            b.Board("b", "", self.cfg)
+        finally:
+            del self.cfg.get_postnums
+        self.assertEqual(self.cfg.get_postnum("a"), 3)
+        self.assertEqual(a.add_post("four"), 4)
+        self.assertEqual(self.contents(a), [["four"], ["three"], ["two"],
+                                            ["one"]])
+
+    def testDeleteBoardKeepsOtherCounters(self):
+        a = b.Board("a", "", self.cfg)
+        a.add_post("one")
+        b.Board("b", "", self.cfg).del_board()
+        self.assertEqual(self.cfg.get_postnums(), {"a": 1})
+        self.assertFalse(os.path.exists(self.cfg.counters.counter_path("b")))
+
+    def testTakenPostNumber(self):
+        '''A post whose number is already on the board fails instead of
+        being dropped.'''
+        a = b.Board("a", "", self.cfg)
+        a.add_post("one")
+        a.add_post("two")
+        self.cfg.counters.set("a", 1)
+        self.assertFalse(a.add_post("lost"))
+        self.assertEqual(self.contents(a), [["two"], ["one"]])
+
+    def testReserveBlock(self):
+        b.Board("a", "", self.cfg)
+        self.assertEqual(self.cfg.reserve_postnums("a", 10), 1)
+        self.assertEqual(self.cfg.reserve_postnums("a"), 11)
+
+    def testLegacyPostnums(self):
+        '''Boards without a counter file start from the old postnums
+        file.'''
+        with open(self.cfg.postnums_path, 'w') as f:
+            json.dump({"a": 41}, f)
+        self.assertEqual(self.cfg.counters.read("a"), 41)
+        self.assertEqual(self.cfg.reserve_postnums("a"), 42)
+
+
+class MigrationTests(ChanTestCase):
+    '''Copying boards from the file engines into the SQLite database.'''
+
+    def migrate(self, names):
+        before = {n: self.contents(b.Board(n, "", self.cfg)) for n in names}
+        self.assertEqual(sqlite_store.migrate(self.cfg), sorted(names))
+        self.cfg.storage = "sqlite"
+        after = {n: self.contents(b.Board(n, "", self.cfg)) for n in names}
+        self.assertEqual(after, before)
+        # The post counters come along too.
+        board = b.Board(names[0], "", self.cfg)
+        last = max(post.id for post in board.iter_posts())
+        self.assertEqual(board.add_post("new"), last + 1)
+
+    def fill(self, board):
+        board.add_post("one")
+        board.add_post("reply", thread_id=1)
+        board.add_post("two")
+        board.add_post("three")
+        board.add_post("bump", thread_id=2)
+
+    def testMigrateIndexBoard(self):
+        self.fill(b.Board("a", "", self.cfg))
+        self.migrate(["a"])
+
+    def testMigrateLogBoard(self):
+        self.cfg.storage = "log"
+        self.fill(b.Board("a", "", self.cfg))
+        self.migrate(["a"])
+
+    def testMigrateShardedBoard(self):
+        self.cfg.storage = "sharded"
+        self.fill(b.Board("a", "", self.cfg))
+        self.migrate(["a"])
+
+    def testMigrateSplitBoard(self):
+        '''A board kept in an index first and split into thread files
+        later.'''
+        self.fill(b.Board("a", "", self.cfg))
+        self.cfg.storage = "sharded"
+        board = b.Board("a", "", self.cfg)
+        board.add_post("after split", thread_id=1)
+        board.add_post("four")
+        self.migrate(["a"])
+
+    def testMigrateSeveralBoards(self):
+        self.fill(b.Board("a", "", self.cfg))
+        self.cfg.storage = "sharded"
+        self.fill(b.Board("b", "", self.cfg))
+        self.migrate(["a", "b"])
+
+    def testMigrateKeepsSameSecondOrder(self):
+        board = b.Board("a", "", self.cfg)
+        for n in range(4):
+            board.store.add_post(str(n), "Anonymous", "", -1, 1000)
+        board.store.add_post("reply", "Anonymous", "", 2, 1000)
+        self.migrate(["a"])
 
-    def testValidReply(self):
-        p.post("a", "test post", "test subject", -1, self.postn, self.root)
-        p.post("a", "reply", '', 1, self.postn, self.root)
-        index = b.get_index("a", self.root)
-        self.assertEqual(index[0][3][1], 2)  # assert post ID
-        self.assertEqual(index[0][3][2], "reply")
-
-    def testPostWithInvalidArguments(self):
-        '''Tries to add a post with integer and list as post_text
-        and subject arguments. It should be converted to str and
-        added without problem.'''
-        p.post("a", 78, 69, -1, self.postn, self.root)
-        p.post("a", ["hello", "world"], [
-               "sub", "ject"], -1, self.postn, self.root)
-        index = b.get_index("a", self.root)
-        self.assertEqual(index[0][1], "69")  # subject
-        self.assertEqual(index[0][2][2], "78")  # post
-        self.assertEqual(index[1][1], "['sub', 'ject']")  # subject
-        self.assertEqual(index[1][2][2], "['hello', 'world']")  # post
 
 if __name__ == '__main__':
     # run tests
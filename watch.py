@@ -0,0 +1,202 @@
+"""
+Waiting for a board to change, without reading it over and over.
+
+A Watcher is given the files that make up a board (a store's
+stamp_paths()) and tells when one of them changed. On Linux it asks the
+kernel through inotify, called with ctypes, so a session that is waiting
+costs nothing until someone posts. Elsewhere, or if inotify can't be set
+up (say, the user ran out of watches), it falls back to comparing the
+stat() of the files every POLL_INTERVAL seconds.
+
+The files are watched for writes, and the directories holding them for
+files being created, removed or renamed over them, as most of them are
+replaced that way (see fileio.atomic_write()); a file that is replaced is
+watched again. Writes to the other files in those directories (the log,
+say) are not asked for, so they don't wake anyone up. A change only means
+the board may have changed; readers still compare the store's stamp() or
+ask for what's new.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+# Seconds between two looks at the files when polling.
+POLL_INTERVAL = 1.0
+# Seconds a change is given to be finished before wait() reports it: a
+# writer may touch more than one file, and SQLite makes a commit visible
+# (in its shared memory file, which inotify doesn't see) just after
+# writing it to the WAL.
+SETTLE = 0.02
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+FILE_MASK = IN_MODIFY
+DIRECTORY_MASK = IN_MOVED_TO | IN_CREATE | IN_DELETE
+# watch descriptor, mask, cookie, length of the name that follows
+EVENT = struct.Struct("iIII")
+
+_libc = None
+
+
+def libc():
+    """The C library, if it has inotify; None otherwise."""
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith("linux"):
+            try:
+                lib = ctypes.CDLL(ctypes.util.find_library("c"),
+                                  use_errno=True)
+                lib.inotify_init1.argtypes = [ctypes.c_int]
+                lib.inotify_add_watch.argtypes = [
+                    ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                _libc = lib
+            except (OSError, AttributeError):
+                pass
+    return _libc or None
+
+
+class Watcher():
+    """Tells when any of the files at paths changes."""
+
+    def __init__(self, paths, interval=POLL_INTERVAL):
+        self.paths = list(paths)
+        self.interval = interval
+        # {watch descriptor of a directory: {name of a watched file in it:
+        #  its path}}
+        self.names = {}
+        # Watch descriptors of the files themselves.
+        self.files = set()
+        self.fd = self.start_inotify()
+        self._stamp = self.stamp()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start_inotify(self):
+        """Returns the inotify descriptor watching the files, or None."""
+        lib = libc()
+        if lib is None:
+            return None
+        fd = lib.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            logging.warning("inotify_init1: %s; polling instead.",
+                            os.strerror(ctypes.get_errno()))
+            return None
+        directories = {}
+        for path in self.paths:
+            path = os.path.abspath(path)
+            directories.setdefault(os.path.dirname(path), {})[
+                os.fsencode(os.path.basename(path))] = path
+        for directory, names in directories.items():
+            wd = lib.inotify_add_watch(fd, os.fsencode(directory),
+                                       DIRECTORY_MASK)
+            if wd < 0:
+                logging.warning("inotify_add_watch %s: %s; polling instead.",
+                                directory, os.strerror(ctypes.get_errno()))
+                os.close(fd)
+                self.names = {}
+                self.files = set()
+                return None
+            self.names[wd] = names
+            for path in names.values():
+                self.watch_file(fd, path)
+        return fd
+
+    def watch_file(self, fd, path):
+        """Watches the file now at path for writes. One that isn't there
+        yet is watched once its directory says it was created."""
+        wd = libc().inotify_add_watch(fd, os.fsencode(path), FILE_MASK)
+        if wd >= 0:
+            self.files.add(wd)
+
+    def fileno(self):
+        """The descriptor that becomes readable when the files change, to
+        wait on together with others; None when polling."""
+        return self.fd
+
+    def stamp(self):
+        stamp = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except FileNotFoundError:
+                stamp.append(None)
+        return stamp
+
+    def changed(self):
+        """Whether the files changed since the last call. Doesn't wait."""
+        if self.fd is None:
+            stamp = self.stamp()
+            changed = stamp != self._stamp
+            self._stamp = stamp
+            return changed
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:
+                            offset + EVENT.size + length].rstrip(b"\0")
+                offset += EVENT.size + length
+                if mask & IN_IGNORED:
+                    # The file went away; its directory tells about that.
+                    self.files.discard(wd)
+                elif wd in self.files or mask & IN_Q_OVERFLOW:
+                    changed = True
+                elif name in self.names.get(wd, ()):
+                    changed = True
+                    if not mask & IN_DELETE:
+                        # A new file at the path: watch that one now.
+                        self.watch_file(self.fd, self.names[wd][name])
+
+    def wait(self, timeout=None):
+        """Waits up to timeout seconds, or for good if None, for the files
+        to change. Returns whether they did."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while not self.changed():
+            left = None if end is None else end - time.monotonic()
+            if left is not None and left <= 0:
+                return False
+            if self.fd is None:
+                time.sleep(self.interval if left is None
+                           else min(self.interval, left))
+            else:
+                select.select([self.fd], [], [], left)
+        # Until the writer is done.
+        time.sleep(SETTLE)
+        self.changed()
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
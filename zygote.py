@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+"""
+The sshchan zygote: a process that has already started up, so logins
+don't have to.
+
+Most of the time a login takes goes into starting Python, importing
+urwid and the rest of sshchan and reading the boards for the first time.
+The zygote does all of that once, then waits on a Unix socket
+("zygote_socket"). sshd runs login.py for every user instead of
+sshchan.py; login.py passes its terminal (stdin, stdout and stderr) to the
+zygote, which forks a session on it. The session starts with everything
+already imported and the board indexes loaded, shared copy-on-write with
+the zygote and every other session.
+
+login.py stays behind for the length of the session: it passes the
+signals it gets (^C, window resizes, the hangup when the connection
+drops) on to the session and exits with its exit status. When the zygote
+isn't running, login.py runs sshchan.py itself.
+
+Start it as the user owning the boards, from the directory logins would
+otherwise run in:
+    python3 zygote.py [config path]
+SIGHUP re-reads the config file, SIGTERM stops it. Restart it after
+upgrading sshchan: sessions run the code the zygote imported.
+
+Copyright (c) 2015
+makos <https://github.com/makos>, chibi <http://neetco.de/chibi>
+under GNU GPL v2, see LICENSE for details
+"""
+
+import atexit
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+
+import catalog
+import config
+import journal
+import sshchan
+from boards import Board
+
+logging.basicConfig(
+    filename="log",
+    format="[%(lineno)d]%(asctime)s:%(levelname)s:%(message)s",
+    level=logging.DEBUG)
+
+# Seconds between reloads of the board indexes while no one logs in.
+WARM_INTERVAL = 60
+
+
+class Zygote():
+
+    def __init__(self, cfg):
+        self.config = cfg
+        # {session pid: connection to its login.py}
+        self.sessions = {}
+        self.listener = None
+        # Written to by the signal handlers, so select() wakes up.
+        self.wakeup, self.wakeup_w = socket.socketpair()
+        self.stopping = False
+
+    def warm(self):
+        """Loads the index and catalog entry of every board, to be
+        inherited by the sessions. Boards that didn't change since the
+        last time are only stat()ed (see Board.get_index())."""
+        boards = catalog.get_catalog(self.config)
+        for name in boards.names():
+            try:
+                Board(name, config=self.config).get_index()
+                boards.info(name)
+            except Exception:
+                logging.exception("zygote: could not load /%s/.", name)
+
+    def serve(self):
+        path = self.config.zygote_socket
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(64)
+        self.wakeup_w.setblocking(False)
+        signal.set_wakeup_fd(self.wakeup_w.fileno())
+        # Handlers that do nothing but wake up select().
+        signal.signal(signal.SIGCHLD, lambda *a: None)
+        signal.signal(signal.SIGTERM, self.stop)
+        self.warm()
+        logging.info("zygote listening on %s.", path)
+        try:
+            while not self.stopping:
+                ready = select.select(
+                    [self.listener, self.wakeup], [], [], WARM_INTERVAL)[0]
+                if self.wakeup in ready:
+                    self.wakeup.recv(4096)
+                    self.reap()
+                if self.listener in ready:
+                    self.accept()
+                if not ready:
+                    self.warm()
+        finally:
+            self.listener.close()
+            os.remove(path)
+            logging.info("zygote stopped.")
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def accept(self):
+        conn, _ = self.listener.accept()
+        # A login that doesn't say anything mustn't hold up the others.
+        conn.settimeout(5)
+        try:
+            message, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+            if not message:
+                # Someone checking whether the zygote is up.
+                conn.close()
+                return
+            if not message.endswith(b"\n"):
+                message += conn.makefile('rb').readline()
+            request = json.loads(message.decode())
+        except (OSError, ValueError):
+            logging.exception("zygote: bad request.")
+            conn.close()
+            return
+        if len(fds) != 3:
+            logging.error("zygote: login passed %d descriptors.", len(fds))
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            return
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.session(conn, fds, request)
+        for fd in fds:
+            os.close(fd)
+        try:
+            send(conn, {"pid": pid})
+            self.sessions[pid] = conn
+        except OSError:
+            # login.py is gone already; the session gets a hangup.
+            conn.close()
+        logging.info("zygote: session %d started.", pid)
+
+    def reap(self):
+        """Tells login.py how the sessions that ended did."""
+        while self.sessions:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            conn = self.sessions.pop(pid, None)
+            if conn is None:
+                continue
+            try:
+                send(conn, {"status": os.waitstatus_to_exitcode(status)})
+            except OSError:
+                pass
+            conn.close()
+
+    def session(self, conn, fds, request):
+        """Runs in the forked child: takes over login.py's terminal and
+        environment and runs sshchan on it. Never returns."""
+        status = 1
+        try:
+            self.listener.close()
+            self.wakeup.close()
+            self.wakeup_w.close()
+            conn.close()
+            for other in self.sessions.values():
+                other.close()
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            # Out of the zygote's session, so signals meant for it (say,
+            # ^C in the terminal it was started from) don't reach us.
+            os.setsid()
+
+            for n, fd in enumerate(fds):
+                if fd != n:
+                    os.dup2(fd, n)
+                    os.close(fd)
+            sys.stdin = open(0, 'r', closefd=False)
+            sys.stdout = open(1, 'w', buffering=1, closefd=False)
+            sys.stderr = open(2, 'w', buffering=1, closefd=False)
+            os.environ.clear()
+            os.environ.update(request["env"])
+
+            # Loaded again for the terminal size of this session.
+            cfg = config.Config(self.config.path)
+            sshchan.main(cfg)
+            status = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+        except BaseException:
+            logging.exception("zygote: session %d failed.", os.getpid())
+        finally:
+            try:
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                # Don't run into the zygote's own code on the way out.
+                os._exit(status)
+
+
+def send(conn, message):
+    conn.sendall(json.dumps(message).encode() + b"\n")
+
+
+def serve(cfg):
+    path = cfg.zygote_socket
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            print("The zygote is already running at " + path)
+            return 1
+        except OSError:
+            os.remove(path) # Left behind by a crash.
+        finally:
+            probe.close()
+    # Once, before any session is forked; a board opened later replays
+    # its own journal (see Board.open_store()).
+    journal.replay_all(cfg)
+    Zygote(cfg).serve()
+    return 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(serve(config.Config(args[0] if args else "",
+                                 reload_on_hup=True)))